@@ -0,0 +1,200 @@
+import sys
+import threading
+import weakref
+import numpy as np
+from numba import cuda
+import Backend as backend
+
+try:
+    from numba.cuda.cudadrv.devicearray import DeviceNDArray
+except ImportError:
+    # CUDA simulator: device arrays wrap NumPy arrays (and their views refer to base arrays)
+    DeviceNDArray = None
+
+mem = {'CPU': 0, 'GPU': 1}
+
+# -------------------------------------------------------------------
+
+class ArrayPool:
+    '''Pool of host and device arrays kept by (memory type, shape, dtype).
+    Arrays returned with Release() (or released by images which do not need them anymore) are reused
+    by next Get() calls instead of being allocated (and on GPU uploaded as zeros) again.
+    At most maxBytesHeld bytes of free arrays are kept for each memory type.'''
+
+    def __init__(self, maxBytesHeld=1 << 30):
+        self.maxBytesHeld = maxBytesHeld
+        self.freeArrays = {}
+        # arrays given by the pool and not released yet (for each memory type)
+        self.issued = [weakref.WeakValueDictionary(), weakref.WeakValueDictionary()]
+        # reentrant, because garbage collection inside the lock can release arrays of deleted images (__del__)
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.releases = 0
+        self.drops = 0
+        self.bytesHeld = [0, 0]
+        # reference count of array which is referenced only by local variable (it depends on Python version)
+        self.unusedRefCount = CountUnusedReferences()
+
+    def Get(self, shape, dtype, memType=mem['CPU'], zero=False):
+        dtype = np.dtype(dtype)
+        shape = tuple(int(dim) for dim in np.atleast_1d(shape))
+        key = (memType, shape, dtype.str)
+        with self.lock:
+            freeList = self.freeArrays.get(key)
+            arr = freeList.pop() if freeList else None
+            if arr is not None:
+                self.hits += 1
+                self.bytesHeld[memType] -= arr.nbytes
+            else:
+                self.misses += 1
+
+        if arr is None:
+            if memType == mem['CPU']:
+                arr = np.empty(shape, dtype=dtype)
+            else:
+                arr = AllocDeviceArray(shape, dtype)
+        if zero:
+            ZeroArray(arr, memType)
+
+        with self.lock:
+            self.issued[memType][id(arr)] = arr
+        return arr
+
+    # returns memory type of array given by the pool (None if array does not come from the pool);
+    # it must be called with the lock held
+    def FindIssued(self, arr):
+        for memType in mem.values():
+            if self.issued[memType].get(id(arr)) is arr:
+                return memType
+        return None
+
+    def Release(self, arr):
+        if arr is None:
+            return
+        key = None
+        with self.lock:
+            memType = self.FindIssued(arr)
+            if memType is None:
+                return
+            del self.issued[memType][id(arr)]
+            key = (memType, arr.shape, arr.dtype.str)
+            if self.bytesHeld[memType] + arr.nbytes > self.maxBytesHeld:
+                self.drops += 1
+                return
+            self.freeArrays.setdefault(key, []).append(arr)
+            self.bytesHeld[memType] += arr.nbytes
+            self.releases += 1
+
+    # releases array holder[idx] if nothing else refers to it (e.g. array of image which is being deleted);
+    # views of arrays from the pool (also device ones, see PoolDeviceArray) refer to their base arrays
+    def ReleaseIfUnused(self, holder, idx):
+        arr = holder[idx]
+        holder[idx] = None
+        if arr is not None and sys.getrefcount(arr) <= self.unusedRefCount:
+            self.Release(arr)
+
+    def Clear(self):
+        with self.lock:
+            self.freeArrays = {}
+            self.bytesHeld = [0, 0]
+
+    def GetStats(self):
+        with self.lock:
+            nHeld = sum(len(freeList) for freeList in self.freeArrays.values())
+            return {'hits': self.hits, 'misses': self.misses, 'releases': self.releases, 'drops': self.drops,
+                    'arraysHeld': nHeld, 'bytesHeldCPU': self.bytesHeld[mem['CPU']],
+                    'bytesHeldGPU': self.bytesHeld[mem['GPU']]}
+
+# -------------------------------------------------------------------
+
+def CountUnusedReferences():
+    holder = [np.empty(0)]
+    arr = holder[0]
+    holder[0] = None
+    return sys.getrefcount(arr)
+
+# -------------------------------------------------------------------
+
+if DeviceNDArray is not None:
+    class PoolDeviceArray(DeviceNDArray):
+        '''Device array given by the pool. Views of Numba device arrays (reshape(), slices etc.) only share memory
+        with their base array, so here every view refers to its base, as NumPy views do
+        (otherwise the base could be released to the pool while a view is still used).'''
+
+        def KeepBase(self, view):
+            if view is not self and hasattr(view, 'gpu_data'):
+                view.poolBase = self
+            return view
+
+        def reshape(self, *newshape, **kws):
+            return self.KeepBase(super().reshape(*newshape, **kws))
+
+        def ravel(self, order='C', stream=0):
+            return self.KeepBase(super().ravel(order, stream))
+
+        def squeeze(self, axis=None, stream=0):
+            return self.KeepBase(super().squeeze(axis, stream))
+
+        def view(self, dtype):
+            return self.KeepBase(super().view(dtype))
+
+        def split(self, section, stream=0):
+            for part in super().split(section, stream):
+                yield self.KeepBase(part)
+
+        # used by __getitem__() and getitem()
+        def _do_getitem(self, item, stream=0):
+            return self.KeepBase(super()._do_getitem(item, stream))
+
+# -------------------------------------------------------------------
+
+def AllocDeviceArray(shape, dtype):
+    arr = backend.DeviceArray(shape, dtype)
+    if DeviceNDArray is not None and isinstance(arr, DeviceNDArray):
+        arr = PoolDeviceArray(arr.shape, arr.strides, arr.dtype, gpu_data=arr.gpu_data)
+    return arr
+
+# -------------------------------------------------------------------
+
+def ZeroArray(arr, memType=mem['CPU']):
+    if memType == mem['GPU'] and backend.UseGPU():
+        # zeroing on device (instead of uploading zeros from host)
+        arrFlat = arr.reshape(arr.size)
+        blockDim = 256
+        gridDim = (arr.size + blockDim - 1) // blockDim
+        ZeroArray_dev[gridDim, blockDim](arrFlat)
+    else:
+        arr.fill(0)
+
+# -------------------------------------------------------------------
+
+@backend.jit()
+def ZeroArray_dev(arr):
+    x = cuda.grid(1)
+    if x >= arr.shape[0]:
+        return
+    arr[x] = 0
+
+@ZeroArray_dev.numpy
+def ZeroArray_cpu(arr):
+    arr.fill(0)
+
+# -------------------------------------------------------------------
+
+pool = ArrayPool()
+
+def Get(shape, dtype, memType=mem['CPU'], zero=False):
+    return pool.Get(shape, dtype, memType, zero)
+
+def Release(arr):
+    pool.Release(arr)
+
+def ReleaseIfUnused(holder, idx):
+    pool.ReleaseIfUnused(holder, idx)
+
+def GetStats():
+    return pool.GetStats()
+
+def Clear():
+    pool.Clear()
@@ -1,57 +1,180 @@
 import numpy as np
+import numba
 import CudaConfig as ccfg
+import Backend as backend
+import ArrayPool as apool
 from numba import cuda
 import math
 
 # -------------------------------------------------------------------
 
-def AddTwoArrays(arr1, arr2):
-    blockDim, gridDim = ccfg.DetermineCudaConfig(arr1.shape[0])
+# out can be one of the input arrays (operation is done element by element)
+def AddTwoArrays(arr1, arr2, out=None):
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(arr1.shape)
     # arrSum = cuda.device_array(arr1.shape, dtype=arr1.dtype)
-    arrSum = cuda.to_device(np.zeros(arr1.shape, dtype=arr1.dtype))
+    arrSum = apool.Get(arr1.shape, arr1.dtype, apool.mem['GPU']) if out is None else out
     AddTwoArrays_dev[gridDim, blockDim](arr1, arr2, arrSum)
     return arrSum
 
+# arrAcc += arr
+def AddToArray(arrAcc, arr):
+    return AddTwoArrays(arrAcc, arr, out=arrAcc)
+
 # -------------------------------------------------------------------
 
 # @cuda.jit('void(float32[:, :], float32[:, :], float32[:, :])')
-@cuda.jit()
+@backend.jit()
 def AddTwoArrays_dev(arr1, arr2, arrSum):
     x, y = cuda.grid(2)
     if x >= arr1.shape[0] or y >= arr1.shape[1]:
         return
     arrSum[x, y] = arr1[x, y] + arr2[x, y]
 
+@AddTwoArrays_dev.numpy
+def AddTwoArrays_cpu(arr1, arr2, arrSum):
+    np.add(arr1, arr2, out=arrSum)
+
 # -------------------------------------------------------------------
 
-def MultArrayByScalar(arr, scalar):
-    blockDim, gridDim = ccfg.DetermineCudaConfig(arr.shape[0])
-    arrRes = cuda.device_array(arr.shape, dtype=arr.dtype)
+def MultArrayByScalar(arr, scalar, out=None):
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(arr.shape)
+    arrRes = apool.Get(arr.shape, arr.dtype, apool.mem['GPU']) if out is None else out
     MultArrayByScalar_dev[gridDim, blockDim](arr, scalar, arrRes)
     return arrRes
 
+# arr *= scalar
+def ScaleArray(arr, scalar):
+    return MultArrayByScalar(arr, scalar, out=arr)
+
 # -------------------------------------------------------------------
 
-@cuda.jit()
+@backend.jit()
 def MultArrayByScalar_dev(arr, scalar, arrRes):
     x, y = cuda.grid(2)
     if x >= arr.shape[0] or y >= arr.shape[1]:
         return
     arrRes[x, y] = arr[x, y] * scalar
 
+@MultArrayByScalar_dev.numpy
+def MultArrayByScalar_cpu(arr, scalar, arrRes):
+    np.multiply(arr, scalar, out=arrRes)
+
 # -------------------------------------------------------------------
 
-def CalcSqrtOfArray(arr):
-    blockDim, gridDim = ccfg.DetermineCudaConfig(arr.shape[0])
-    arrSqrt = cuda.device_array(arr.shape, dtype=arr.dtype)
+def CalcSqrtOfArray(arr, out=None):
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(arr.shape)
+    arrSqrt = apool.Get(arr.shape, arr.dtype, apool.mem['GPU']) if out is None else out
     CalcSqrtOfArray_dev[gridDim, blockDim](arr, arrSqrt)
     return arrSqrt
 
 # -------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], float32[:, :])')
+@backend.jit('void(float32[:, :], float32[:, :])')
 def CalcSqrtOfArray_dev(arr, arrSqrt):
     x, y = cuda.grid(2)
     if x >= arr.shape[0] or y >= arr.shape[1]:
         return
-    arrSqrt[x, y] = math.sqrt(arr[x, y])
\ No newline at end of file
+    arrSqrt[x, y] = math.sqrt(arr[x, y])
+
+@CalcSqrtOfArray_dev.numba
+def CalcSqrtOfArray_cpu(arr, arrSqrt):
+    for x in numba.prange(arr.shape[0]):
+        for y in range(arr.shape[1]):
+            arrSqrt[x, y] = math.sqrt(arr[x, y])
+
+# -------------------------------------------------------------------
+
+reduceBlocks = 256
+reduceThreads = 256
+
+# max, min and their positions (index tuples) in array of any shape, found in one pass
+# (only partial results of blocks are transferred to host);
+# NaN values are skipped, for array with only NaN values max and min are NaN at the first position
+# (blocks without any other values have index -1)
+def FindExtrema(arr):
+    arrFlat = arr.reshape(arr.size)
+    onDevice = backend.IsDeviceArray(arr)
+    memType = apool.mem['GPU'] if onDevice else apool.mem['CPU']
+    nBlocks = max(1, min(reduceBlocks, (arr.size + reduceThreads - 1) // reduceThreads))
+    blockMax = apool.Get(nBlocks, np.float32, memType)
+    blockArgMax = apool.Get(nBlocks, np.int64, memType)
+    blockMin = apool.Get(nBlocks, np.float32, memType)
+    blockArgMin = apool.Get(nBlocks, np.int64, memType)
+    if onDevice:
+        FindExtrema_dev[nBlocks, reduceThreads](arrFlat, blockMax, blockArgMax, blockMin, blockArgMin)
+    else:
+        FindExtrema_dev.GetCpuKernel()(arrFlat, blockMax, blockArgMax, blockMin, blockArgMin)
+
+    partials = [ backend.ToHost(partial) for partial in (blockMax, blockArgMax, blockMin, blockArgMin) ]
+    for partial in (blockMax, blockArgMax, blockMin, blockArgMin):
+        apool.Release(partial)
+    maxVals, maxIndices, minVals, minIndices = partials
+    maxVal, argMax = ReduceBlockExtrema(maxVals, maxIndices, np.max)
+    minVal, argMin = ReduceBlockExtrema(minVals, minIndices, np.min)
+    return maxVal, np.unravel_index(argMax, arr.shape), minVal, np.unravel_index(argMin, arr.shape)
+
+# -------------------------------------------------------------------
+
+# extremum of partial results of blocks; ties are resolved as in np.argmax() (first position)
+def ReduceBlockExtrema(vals, indices, extremumFunc):
+    valid = indices >= 0
+    if not valid.any():
+        return np.float32(np.nan), 0
+    val = extremumFunc(vals[valid])
+    return val, indices[valid & (vals == val)].min()
+
+# -------------------------------------------------------------------
+
+@backend.jit('void(float32[:], float32[:], int64[:], float32[:], int64[:])')
+def FindExtrema_dev(arr, blockMax, blockArgMax, blockMin, blockArgMin):
+    sMax = cuda.shared.array(reduceThreads, numba.float32)
+    sArgMax = cuda.shared.array(reduceThreads, numba.int64)
+    sMin = cuda.shared.array(reduceThreads, numba.float32)
+    sArgMin = cuda.shared.array(reduceThreads, numba.int64)
+    tid = cuda.threadIdx.x
+
+    vMax, iMax = -math.inf, -1
+    vMin, iMin = math.inf, -1
+    for i in range(cuda.grid(1), arr.shape[0], cuda.gridsize(1)):
+        # first value which is not NaN is taken even if it is -inf (max) or inf (min)
+        if arr[i] > vMax or (iMax < 0 and arr[i] == arr[i]):
+            vMax, iMax = arr[i], i
+        if arr[i] < vMin or (iMin < 0 and arr[i] == arr[i]):
+            vMin, iMin = arr[i], i
+    sMax[tid], sArgMax[tid] = vMax, iMax
+    sMin[tid], sArgMin[tid] = vMin, iMin
+    cuda.syncthreads()
+
+    s = cuda.blockDim.x // 2
+    while s > 0:
+        if tid < s:
+            j = tid + s
+            if sArgMax[j] >= 0 and (sArgMax[tid] < 0 or sMax[j] > sMax[tid] or
+                                    (sMax[j] == sMax[tid] and sArgMax[j] < sArgMax[tid])):
+                sMax[tid], sArgMax[tid] = sMax[j], sArgMax[j]
+            if sArgMin[j] >= 0 and (sArgMin[tid] < 0 or sMin[j] < sMin[tid] or
+                                    (sMin[j] == sMin[tid] and sArgMin[j] < sArgMin[tid])):
+                sMin[tid], sArgMin[tid] = sMin[j], sArgMin[j]
+        cuda.syncthreads()
+        s //= 2
+
+    if tid == 0:
+        b = cuda.blockIdx.x
+        blockMax[b], blockArgMax[b] = sMax[0], sArgMax[0]
+        blockMin[b], blockArgMin[b] = sMin[0], sArgMin[0]
+
+@FindExtrema_dev.numba
+def FindExtrema_cpu(arr, blockMax, blockArgMax, blockMin, blockArgMin):
+    nBlocks = blockMax.shape[0]
+    chunk = (arr.shape[0] + nBlocks - 1) // nBlocks
+    for b in numba.prange(nBlocks):
+        vMax, iMax = -math.inf, -1
+        vMin, iMin = math.inf, -1
+        for i in range(b * chunk, min((b + 1) * chunk, arr.shape[0])):
+            # first value which is not NaN is taken even if it is -inf (max) or inf (min)
+            if arr[i] > vMax or (iMax < 0 and arr[i] == arr[i]):
+                vMax, iMax = arr[i], i
+            if arr[i] < vMin or (iMin < 0 and arr[i] == arr[i]):
+                vMin, iMin = arr[i], i
+        blockMax[b], blockArgMax[b] = vMax, iMax
+        blockMin[b], blockArgMin[b] = vMin, iMin
@@ -0,0 +1,159 @@
+import os
+import numpy as np
+import numba
+from numba import cuda
+
+# -------------------------------------------------------------------
+# Array backend: 'cuda' (GPU kernels) or 'cpu' (NumPy and parallel Numba versions of the same kernels).
+# Backend is taken from LA_BACKEND environment variable (default: 'cuda' if CUDA device is available, 'cpu' otherwise)
+# and can be changed with SelectBackend() before any images are created.
+# On CPU backend 'GPU' memory type still exists, but "device" arrays are ordinary NumPy arrays.
+# -------------------------------------------------------------------
+
+backends = ('cuda', 'cpu')
+backendEnvVar = 'LA_BACKEND'
+
+def DetectBackend():
+    name = os.environ.get(backendEnvVar, '').strip().lower()
+    if name in backends:
+        return name
+    if name:
+        print('Unknown backend "{0}" in {1} (available: {2})'.format(name, backendEnvVar, ', '.join(backends)))
+    return 'cuda' if cuda.is_available() else 'cpu'
+
+current = DetectBackend()
+
+# -------------------------------------------------------------------
+
+def SelectBackend(name):
+    global current
+    if name not in backends:
+        raise ValueError('Unknown backend "{0}" (available: {1})'.format(name, ', '.join(backends)))
+    if name == 'cuda' and not cuda.is_available():
+        raise RuntimeError('CUDA backend was selected, but no CUDA device is available')
+    current = name
+
+# -------------------------------------------------------------------
+
+def GetBackend():
+    return current
+
+# -------------------------------------------------------------------
+
+def UseGPU():
+    return current == 'cuda'
+
+# -------------------------------------------------------------------
+
+def GetNumberOfThreads():
+    return numba.get_num_threads()
+
+# -------------------------------------------------------------------
+
+class Kernel:
+    '''Kernel which can be launched on both backends with the same syntax: Kernel[gridDim, blockDim](args).
+    CUDA version is compiled on first launch on CUDA backend (so that modules can be imported on machines without GPU).
+    CPU version is registered with .numpy (plain NumPy function) or .numba (compiled with numba.njit(parallel=True)
+    using the signature of CUDA kernel, so that scalar arguments are converted in the same way); launch configuration
+    is ignored on CPU.'''
+
+    def __init__(self, cudaFunc, signature=None):
+        self.cudaFunc = cudaFunc
+        self.signature = signature
+        self.cudaKernel = None
+        self.cpuFunc = None
+        self.cpuKernel = None
+        self.cpuParallel = True
+        self.__name__ = cudaFunc.__name__
+        self.__doc__ = cudaFunc.__doc__
+
+    def numpy(self, cpuFunc):
+        self.cpuFunc = cpuFunc
+        self.cpuKernel = cpuFunc
+        return self
+
+    # @kernel.numba or @kernel.numba(parallel=False) (for kernels which scatter data and must run serially)
+    def numba(self, cpuFunc=None, parallel=True):
+        if cpuFunc is None:
+            return lambda func: self.numba(func, parallel)
+        self.cpuFunc = cpuFunc
+        self.cpuKernel = None
+        self.cpuParallel = parallel
+        return self
+
+    def GetCudaKernel(self):
+        if self.cudaKernel is None:
+            if self.signature is None:
+                self.cudaKernel = cuda.jit()(self.cudaFunc)
+            else:
+                self.cudaKernel = cuda.jit(self.signature)(self.cudaFunc)
+        return self.cudaKernel
+
+    def GetCpuKernel(self):
+        if self.cpuFunc is None:
+            raise NotImplementedError('Kernel {0} has no CPU version'.format(self.__name__))
+        if self.cpuKernel is None:
+            # error_model='numpy': division by zero gives inf/nan as on GPU instead of raising exception
+            jitOptions = {'parallel': self.cpuParallel, 'error_model': 'numpy'}
+            if self.signature is None:
+                self.cpuKernel = numba.njit(**jitOptions)(self.cpuFunc)
+            else:
+                self.cpuKernel = numba.njit(self.signature, **jitOptions)(self.cpuFunc)
+        return self.cpuKernel
+
+    def __getitem__(self, launchConfig):
+        if current == 'cuda':
+            return self.GetCudaKernel()[launchConfig]
+        return self.GetCpuKernel()
+
+# -------------------------------------------------------------------
+
+# replacement for @cuda.jit(signature)
+def jit(signature=None):
+    def Decorator(cudaFunc):
+        return Kernel(cudaFunc, signature)
+    return Decorator
+
+# -------------------------------------------------------------------
+# memory management (replacements for cuda.to_device(), cuda.device_array(), copy_to_host() and copy_to_device())
+# -------------------------------------------------------------------
+
+def ToDevice(arr):
+    if current == 'cuda':
+        return cuda.to_device(arr)
+    # copy, as cuda.to_device() does (host and "device" arrays must not share memory)
+    return np.array(arr)
+
+# -------------------------------------------------------------------
+
+def ToHost(arr):
+    if current == 'cuda' and cuda.is_cuda_array(arr):
+        return arr.copy_to_host()
+    return np.asarray(arr)
+
+# -------------------------------------------------------------------
+
+def IsDeviceArray(arr):
+    return current == 'cuda' and cuda.is_cuda_array(arr)
+
+# -------------------------------------------------------------------
+
+def DeviceArray(shape, dtype):
+    if current == 'cuda':
+        return cuda.device_array(shape, dtype=dtype)
+    return np.empty(shape, dtype=dtype)
+
+# -------------------------------------------------------------------
+
+def Zeros(shape, dtype):
+    if current == 'cuda':
+        return cuda.to_device(np.zeros(shape, dtype=dtype))
+    return np.zeros(shape, dtype=dtype)
+
+# -------------------------------------------------------------------
+
+def CopyInto(dst, src):
+    if current == 'cuda':
+        dst.copy_to_device(src)
+    else:
+        np.copyto(dst, src)
@@ -7,6 +7,9 @@ idxInFocus = numInFocus - 1
 refIdx = 10
 predefDfStep = 2.0e-9
 nIterations = 20
+iwfrTolerance = 1e-4        # relative change of exit wave
+nCoarseIterations = 5       # IWFR iterations on each level of pyramid
+nIncrementalIterations = 5  # IWFR iterations after adding or removing images
 # pxWidth = 20.5144e-12       # 380kx
 pxWidth = 10.3935e-12     # 720kx
 # pxWidth = 718.243e-12
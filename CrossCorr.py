@@ -1,35 +1,44 @@
 import numpy as np
-from accelerate.cuda import fft as cufft
+import numba
 from numba import cuda
 
 import Constants as const
 import CudaConfig as ccfg
+import Backend as backend
+import FFTEngine as ffteng
 import ImageSupport as imsup
 import ArraySupport as arrsup
 import Propagation as prop
+import ResultWriter as rwriter
+
+# normalization of cross-power spectrum (exponent of its magnitude): cross-correlation, mutual correlation, phase correlation
+corrNorm = {'CCF': 0.0, 'MCF': 0.5, 'PCF': 1.0}
 
 #-------------------------------------------------------------------
 
-def FFT(img):
+# out: image for result (e.g. reused between calls)
+def FFT(img, out=None):
     mt = img.memType
     dt = img.cmpRepr
     img.MoveToGPU()
     img.AmPh2ReIm()
-    fft = imsup.Image(img.height, img.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU'])
-    cufft.fft(img.reIm, fft.reIm)
+    fft = imsup.Image(img.height, img.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU']) if out is None else out
+    fft.MoveToGPU()
+    ffteng.FFT2(img.reIm, fft.GetReImForWrite())
     img.ChangeComplexRepr(dt)
     img.ChangeMemoryType(mt)
     return fft
 
 #-------------------------------------------------------------------
 
-def IFFT(fft):
+def IFFT(fft, out=None):
     mt = fft.memType
     dt = fft.cmpRepr
     fft.MoveToGPU()
     fft.AmPh2ReIm()
-    ifft = imsup.Image(fft.height, fft.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU'])
-    cufft.ifft(fft.reIm, ifft.reIm)
+    ifft = imsup.Image(fft.height, fft.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU']) if out is None else out
+    ifft.MoveToGPU()
+    ffteng.IFFT2(fft.reIm, ifft.GetReImForWrite())
     fft.ChangeComplexRepr(dt)
     fft.ChangeMemoryType(mt)
     return ifft
@@ -43,7 +52,7 @@ def FFT2Diff(fft):
     fft.AmPh2ReIm()
     diff = imsup.Image(fft.height, fft.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU'])
     blockDim, gridDim = ccfg.DetermineCudaConfig(fft.width)
-    FFT2Diff_dev[gridDim, blockDim](fft.reIm, diff.reIm, fft.width)
+    FFT2Diff_dev[gridDim, blockDim](fft.reIm, diff.GetReImForWrite(), fft.width)
     diff.defocus = fft.defocus
     fft.ChangeComplexRepr(dt)
     fft.ChangeMemoryType(mt)
@@ -56,27 +65,25 @@ def Diff2FFT(diff):
 
 # -------------------------------------------------------------------
 
-@cuda.jit('void(complex64[:, :], complex64[:, :], int32)')
+@backend.jit('void(complex64[:, :], complex64[:, :], int32)')
 def FFT2Diff_dev(fft, diff, dim):
     x, y = cuda.grid(2)
     if x >= fft.shape[0] or y >= fft.shape[1]:
         return
     diff[x, y] = fft[(x + dim // 2) % dim, (y + dim // 2) % dim]
 
+@FFT2Diff_dev.numpy
+def FFT2Diff_cpu(fft, diff, dim):
+    rows = (np.arange(fft.shape[0]) + dim // 2) % dim
+    cols = (np.arange(fft.shape[1]) + dim // 2) % dim
+    diff[...] = fft[np.ix_(rows, cols)]
+
 #-------------------------------------------------------------------
 
-def CalcCrossCorrFun(img1, img2):
+def CalcCrossCorrFun(img1, img2, norm=corrNorm['MCF']):
     fft1 = FFT(img1)
     fft2 = FFT(img2)
 
-    fft1.ReIm2AmPh()
-    fft2.ReIm2AmPh()
-
-    fft3 = imsup.Image(fft1.height, fft1.width, imsup.Image.cmp['CAP'], imsup.Image.mem['GPU'])
-    fft1.amPh = imsup.ConjugateAmPhMatrix(fft1.amPh)
-    fft3.amPh = imsup.MultAmPhMatrices(fft1.amPh, fft2.amPh)
-    fft3.amPh.am = arrsup.CalcSqrtOfArray(fft3.amPh.am)			# mcf ON
-
     # ---- ccf ----
     # fft3.amPh.am = fft1.amPh.am * fft2.amPh.am
     # fft3.amPh.ph = -fft1.amPh.ph + fft2.amPh.ph
@@ -84,6 +91,10 @@ def CalcCrossCorrFun(img1, img2):
     # fft3.amPh.am = np.sqrt(fft1.amPh.am * fft2.amPh.am)
     # fft3.amPh.ph = -fft1.amPh.ph + fft2.amPh.ph
 
+    fft3 = imsup.Image(fft1.height, fft1.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU'])
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(fft1.reIm.shape)
+    ConjMultSpectra_dev[gridDim, blockDim](fft1.reIm, fft2.reIm, fft3.GetReImForWrite(), norm)
+
     ccf = IFFT(fft3)
     ccf = FFT2Diff(ccf)
     ccf.ReIm2AmPh()
@@ -91,27 +102,72 @@ def CalcCrossCorrFun(img1, img2):
 
 #-------------------------------------------------------------------
 
-def CalcAverageCrossCorrFun(img1, img2, nDiv):
-    roiNR, roiNC  = img1.height // nDiv, img1.width // nDiv
-    fragsToCorrelate1 = []
-    fragsToCorrelate2 = []
+# cross-correlation functions of all pairs of images from two stacks (batched transforms)
+def CalcCrossCorrFunStack(stack1, stack2, norm=corrNorm['MCF']):
+    fft1 = stack1.FFT()
+    fft2 = stack2.FFT()
+
+    crossSpec = imsup.ImageStack(stack1.nImages, stack1.height, stack1.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU'])
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(fft1.data.reIm.shape)
+    ConjMultSpectra_dev[gridDim, blockDim](fft1.data.reIm, fft2.data.reIm, crossSpec.data.GetReImForWrite(), norm)
+    ccfs = crossSpec.IFFT()
+
+    ccfsDiff = imsup.ImageStack(stack1.nImages, stack1.height, stack1.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU'])
+    diffs = ccfsDiff.data.GetReImForWrite().reshape(ccfsDiff.shape)
+    ccfsReIm = ccfs.reIm
+    blockDim, gridDim = ccfg.DetermineCudaConfig(stack1.width)
+    for idx in range(stack1.nImages):
+        FFT2Diff_dev[gridDim, blockDim](ccfsReIm[idx], diffs[idx], stack1.width)
+    ccfsDiff.ReIm2AmPh()
+    return ccfsDiff
 
-    # mozna to wszystko urownoleglic (tak jak w CreateFragment())
-    for y in range(0, nDiv):
-        for x in range(0, nDiv):
-            frag1 = imsup.CropImageROI(img1, (y * roiNR, x * roiNC), (roiNR, roiNC), 1)
-            fragsToCorrelate1.append(frag1)
+#-------------------------------------------------------------------
 
-            frag2 = imsup.CropImageROI(img2, (y * roiNR, x * roiNC), (roiNR, roiNC), 1)
-            fragsToCorrelate2.append(frag2)
+# sum of amplitudes of cross-correlation functions of corresponding fragments of two images
+def CalcSumOfFragmentsCrossCorrFun(img1, img2, fragOrigs, fragDims):
+    ccfAvg = imsup.Image(fragDims[0], fragDims[1], imsup.Image.cmp['CAP'], imsup.Image.mem['GPU'])
+    if len(fragOrigs) == 0:
+        return ccfAvg
+    frags1 = imsup.CropImageROIsToStack(img1, fragOrigs, fragDims)
+    frags2 = imsup.CropImageROIsToStack(img2, fragOrigs, fragDims)
+    ccfs = CalcCrossCorrFunStack(frags1, frags2)
+    ccfsAm = ccfs.am
+    for idx in range(ccfs.nImages):
+        arrsup.AddToArray(ccfAvg.amPh.am, ccfsAm[idx])
+    return ccfAvg
 
-    ccfAvg = imsup.Image(roiNR, roiNC, imsup.Image.cmp['CAP'], imsup.Image.mem['GPU'])
+#-------------------------------------------------------------------
 
-    for frag1, frag2 in zip(fragsToCorrelate1, fragsToCorrelate2):
-        ccf = CalcCrossCorrFun(frag1, frag2)
-        ccfAvg.amPh.am = arrsup.AddTwoArrays(ccfAvg.amPh.am, ccf.amPh.am)
+# conj(fft1) * fft2 / |conj(fft1) * fft2| ** norm (in one pass, without conversion to amplitude and phase)
+@backend.jit('void(complex64[:, :], complex64[:, :], complex64[:, :], float32)')
+def ConjMultSpectra_dev(fft1, fft2, crossSpec, norm):
+    x, y = cuda.grid(2)
+    if x >= fft1.shape[0] or y >= fft1.shape[1]:
+        return
+    z = complex(fft1[x, y].real, -fft1[x, y].imag) * fft2[x, y]
+    if norm != 0.0:
+        zAbs = abs(z)
+        if zAbs > 0.0:
+            z /= zAbs ** norm
+    crossSpec[x, y] = z
+
+@ConjMultSpectra_dev.numba
+def ConjMultSpectra_cpu(fft1, fft2, crossSpec, norm):
+    for x in numba.prange(fft1.shape[0]):
+        for y in range(fft1.shape[1]):
+            z = complex(fft1[x, y].real, -fft1[x, y].imag) * fft2[x, y]
+            if norm != 0.0:
+                zAbs = abs(z)
+                if zAbs > 0.0:
+                    z /= zAbs ** norm
+            crossSpec[x, y] = z
 
-    return ccfAvg
+#-------------------------------------------------------------------
+
+def CalcAverageCrossCorrFun(img1, img2, nDiv):
+    roiNR, roiNC  = img1.height // nDiv, img1.width // nDiv
+    fragOrigs = [ (y * roiNR, x * roiNC) for y in range(0, nDiv) for x in range(0, nDiv) ]
+    return CalcSumOfFragmentsCrossCorrFun(img1, img2, fragOrigs, (roiNR, roiNC))
 
 #-------------------------------------------------------------------
 
@@ -123,62 +179,23 @@ def frange(x, y, jump):
 # -------------------------------------------------------------------
 
 def FindMaxInImage(img):
-    dimSize = img.width
-    arrReduced = img.amPh.am
-    blockDim, gridDim = ccfg.DetermineCudaConfigNew((dimSize // 2, dimSize // 2))
-    while dimSize > 2:
-        dimSize //= 2
-        # arrReducedNew = cuda.device_array((dimSize, dimSize), dtype=np.float32)
-        arrReducedNew = cuda.to_device(np.zeros((dimSize, dimSize), dtype=np.float32))
-        ReduceArrayToFindMax_dev[gridDim, blockDim](arrReduced, arrReducedNew)
-        arrReduced = arrReducedNew
-        if gridDim[0] > 1:
-            gridDim = [gridDim[0] // 2] * 2
-        else:
-            blockDim = [blockDim[0] // 2] * 2
-    imgMax = np.max(arrReduced.copy_to_host())
-    # imgMax = arrReduced.copy_to_host()[0, 0]
-    return imgMax
-
-# -------------------------------------------------------------------
-
-# @cuda.jit()
-@cuda.jit('void(float32[:, :], float32[:, :])')
-def ReduceArrayToFindMax_dev(arr, arrRed):
-    x, y = cuda.grid(2)
-    if x >= arrRed.shape[0] or y >= arrRed.shape[1]:
-        return
-    arrRed[x, y] = max(arr[2*x, 2*y], max(arr[2*x, 2*y+1], max(arr[2*x+1, 2*y], arr[2*x+1, 2*y+1])))
+    return arrsup.FindExtrema(img.amPh.am)[0]
 
 # -------------------------------------------------------------------
 
 def FindMinInImage(img):
-    dimSize = img.width
-    arrReduced = img.amPh.am
-    blockDim, gridDim = ccfg.DetermineCudaConfig(dimSize // 2)
-    while dimSize > 2:
-        dimSize //= 2
-        # arrReducedNew = cuda.device_array((dimSize, dimSize), dtype=np.float32)
-        arrReducedNew = cuda.to_device(np.zeros((dimSize, dimSize), dtype=np.float32))
-        ReduceArrayToFindMin_dev[gridDim, blockDim](arrReduced, arrReducedNew)
-        arrReduced = arrReducedNew
-        if gridDim[0] > 1:
-            gridDim = [gridDim[0] // 2] * 2
-        else:
-            blockDim = [blockDim[0] // 2] * 2
-    imgMin = np.min(arrReduced.copy_to_host())
-    # imgMin = arrReduced.copy_to_host()[0, 0]
-    return imgMin
+    return arrsup.FindExtrema(img.amPh.am)[2]
 
 # -------------------------------------------------------------------
 
-# @cuda.jit()
-@cuda.jit('void(float32[:, :], float32[:, :])')
-def ReduceArrayToFindMin_dev(arr, arrRed):
-    x, y = cuda.grid(2)
-    if x >= arrRed.shape[0] or y >= arrRed.shape[1]:
-        return
-    arrRed[x, y] = min(arr[2*x, 2*y], min(arr[2*x, 2*y+1], min(arr[2*x+1, 2*y], arr[2*x+1, 2*y+1])))
+# value and shift (from the centre) of maximum of correlation function (whole map is not transferred to host)
+def FindPeak(ccf):
+    dt = ccf.cmpRepr
+    ccf.ReIm2AmPh()
+    ccfMax, ccfMaxXY = arrsup.FindExtrema(ccf.amPh.am)[:2]
+    ccfMidXY = np.array(ccf.amPh.am.shape) // 2
+    ccf.ChangeComplexRepr(dt)
+    return ccfMax, tuple(ccfMidXY - np.array(ccfMaxXY))
 
 # -------------------------------------------------------------------
 
@@ -205,14 +222,12 @@ def MaximizeMCFCore(img1, img2, nDiv, fragCoords, dfStepMin, dfStepMax, dfStepCh
     # mcfMaxFile = open(mcfMaxPath, 'w')
 
     for dfStep in frange(dfStepMin, dfStepMax, dfStepChange):
-        ctf = prop.CalcTransferFunction(img1.width, img1.pxWidth, dfStep)
-        # ctf.AmPh2ReIm()
-        # ctf = Diff2FFT(ctf)
-        img1Prop = prop.PropagateWave(img1, ctf)
+        # CTFs of the sweep are not reused, so they are not calculated (nor cached)
+        img1Prop = prop.PropagateWaveByDefocus(img1, dfStep)
         # mcf = CalcCrossCorrFun(img1Prop, img2)
         # mcf = CalcPartialCrossCorrFun(img1, img2, nDiv, fragCoords)
         mcf = CalcPartialCrossCorrFun(img1Prop, img2, nDiv, fragCoords)
-        mcfMaxCurr = FindMaxInImage(mcf)
+        mcfMaxCurr, mcfShift = FindPeak(mcf)
         # mcf.MoveToCPU()
         # mcfMaxCurr = np.max(mcf.amPh.am)
         # mcf.MoveToGPU()
@@ -221,6 +236,7 @@ def MaximizeMCFCore(img1, img2, nDiv, fragCoords, dfStepMin, dfStepMax, dfStepCh
             mcfMax = mcfMaxCurr
             dfStepBest = dfStep
             mcfBest = mcf
+            mcfBest.shift = mcfShift
 
     # mcfMaxFile.close()
     mcfBest.defocus = dfStepBest
@@ -263,18 +279,7 @@ def MaximizeMCFvsRotation(img1, img2, angleMin, angleMax):
 #-------------------------------------------------------------------
 
 def GetShift(ccf):
-    dt = ccf.cmpRepr
-    mt = ccf.memType
-    ccf.ReIm2AmPh()
-    ccf.MoveToCPU()
-
-    ccfMidXY = np.array(ccf.amPh.am.shape) // 2
-    ccfMaxXY = np.array(np.unravel_index(np.argmax(ccf.amPh.am), ccf.amPh.am.shape))
-    shift = tuple(ccfMidXY - ccfMaxXY)
-
-    ccf.ChangeMemoryType(mt)
-    ccf.ChangeComplexRepr(dt)
-    return shift
+    return FindPeak(ccf)[1]
 
 #-------------------------------------------------------------------
 
@@ -282,7 +287,7 @@ def ShiftImage(img, shift):
     dt = img.cmpRepr
     img.AmPh2ReIm()
     imgShifted = imsup.Image(img.height, img.width, img.cmpRepr, imsup.Image.mem['GPU'])
-    shift_d = cuda.to_device(np.array(shift))
+    shift_d = backend.ToDevice(np.array(shift))
     blockDim, gridDim = ccfg.DetermineCudaConfigNew(img.reIm.shape)
     ShiftImage_dev[gridDim, blockDim](img.reIm, imgShifted.reIm, shift_d, 0.0)
     img.ChangeComplexRepr(dt)
@@ -305,10 +310,10 @@ def ShiftImageAmpBuffer(img, shift):
     fillValue = np.max(img.amPh.am)
     img.MoveToGPU()
     imgShifted = imsup.Image(img.height, img.width, imsup.Image.cmp['CAP'], imsup.Image.mem['GPU'])
-    shift_d = cuda.to_device(np.array(img.shift))
+    shift_d = backend.ToDevice(np.array(img.shift))
     blockDim, gridDim = ccfg.DetermineCudaConfigNew(img.buffer.shape)
     ShiftImage_dev[gridDim, blockDim](img.amPh.am, imgShifted.amPh.am, shift_d, fillValue)
-    img.buffer.copy_to_device(imgShifted.amPh.am)
+    backend.CopyInto(img.buffer, imgShifted.amPh.am)
     img.MoveToCPU()
 
 #-------------------------------------------------------------------
@@ -324,7 +329,7 @@ def ShiftImageAmpBuffer(img, shift):
 # -------------------------------------------------------------------
 
 # @cuda.jit('void(complex64[:, :], complex64[:, :], int32[:])')
-@cuda.jit()
+@backend.jit()
 def ShiftImage_dev(img, imgShifted, shift, fillValue=0.0):
     x, y = cuda.grid(2)
     if x >= img.shape[0] or y >= img.shape[1]:
@@ -337,47 +342,36 @@ def ShiftImage_dev(img, imgShifted, shift, fillValue=0.0):
         # imgShifted[x, y] = 0.0
         imgShifted[x, y] = fillValue
 
+@ShiftImage_dev.numba
+def ShiftImage_cpu(img, imgShifted, shift, fillValue=0.0):
+    dx, dy = shift[0], shift[1]
+    for x in numba.prange(img.shape[0]):
+        for y in range(img.shape[1]):
+            if 0 <= x - dx < img.shape[0] and 0 <= y - dy < img.shape[1]:
+                imgShifted[x, y] = img[x-dx, y-dy]
+            else:
+                imgShifted[x, y] = fillValue
+
 # -------------------------------------------------------------------
 
 def CalcPartialCrossCorrFun(img1, img2, nDiv, fragCoords):
     roiNR, roiNC = img1.height // nDiv, img1.width // nDiv
-    fragsToCorrelate1 = []
-    fragsToCorrelate2 = []
-
-    for x, y in fragCoords:
-        frag1 = imsup.CropImageROI(img1, (y * roiNR, x * roiNC), (roiNR, roiNC), 1)
-        fragsToCorrelate1.append(frag1)
-
-        frag2 = imsup.CropImageROI(img2, (y * roiNR, x * roiNC), (roiNR, roiNC), 1)
-        fragsToCorrelate2.append(frag2)
-
-    ccfAvg = imsup.Image(roiNR, roiNC, imsup.Image.cmp['CAP'], imsup.Image.mem['GPU'])
-
-    for frag1, frag2 in zip(fragsToCorrelate1, fragsToCorrelate2):
-        ccf = CalcCrossCorrFun(frag1, frag2)
-        ccfAvg.amPh.am = arrsup.AddTwoArrays(ccfAvg.amPh.am, ccf.amPh.am)
-
-    return ccfAvg
+    fragOrigs = [ (y * roiNR, x * roiNC) for x, y in fragCoords ]
+    return CalcSumOfFragmentsCrossCorrFun(img1, img2, fragOrigs, (roiNR, roiNC))
 
 # -------------------------------------------------------------------
 
 def CalcPartialCrossCorrFunUW(img1, img2, nDiv, fragCoords):
     roiNR, roiNC = img1.height // nDiv, img1.width // nDiv
-    fragsToCorrelate1 = []
-    fragsToCorrelate2 = []
-
-    for x, y in fragCoords:
-        frag1 = imsup.CropImageROI(img1, (y * roiNR, x * roiNC), (roiNR, roiNC), 1)
-        fragsToCorrelate1.append(frag1)
-
-        frag2 = imsup.CropImageROI(img2, (y * roiNR, x * roiNC), (roiNR, roiNC), 1)
-        fragsToCorrelate2.append(frag2)
+    fragOrigs = [ (y * roiNR, x * roiNC) for x, y in fragCoords ]
+    frags1 = imsup.CropImageROIsToStack(img1, fragOrigs, (roiNR, roiNC))
+    frags2 = imsup.CropImageROIsToStack(img2, fragOrigs, (roiNR, roiNC))
+    ccfs = CalcCrossCorrFunStack(frags1, frags2)
 
     shifts = np.zeros((nDiv, nDiv), dtype=np.complex)
     # fragsToJoin = imsup.ImageList()
-    for (x, y), frag1, frag2 in zip(fragCoords, fragsToCorrelate1, fragsToCorrelate2):
-        ccf = CalcCrossCorrFun(frag1, frag2)
-        shift = GetShift(ccf)
+    for idx, (x, y) in enumerate(fragCoords):
+        shift = GetShift(ccfs[idx])
         shifts[y, x] = np.complex(shift[1], shift[0])
         # frag2Shifted = ShiftImage(frag2, shift)
         # fragsToJoin.append(frag2Shifted)
@@ -400,8 +394,9 @@ def AlignTwoImages(img1, img2, dfPars):
     # mcfBest.amPh.am[:, mcfBest.width // 2] = 0
     # mcfBest.MoveToGPU()
     # ---
-    imsup.SaveAmpImage(mcfBest, 'mcf.png')
-    shift = GetShift(mcfBest)
+    rwriter.Submit(mcfBest, {'am': 'mcf'})
+    # position of the peak was found in MaximizeMCFCore()
+    shift = tuple(mcfBest.shift)
     img2Shifted = ShiftImage(img2, shift)
     cropCoords = imsup.DetermineCropCoords(img2.height, img2.width, shift)
     commonCoords = imsup.GetCommonArea(commonCoords, cropCoords)
@@ -0,0 +1,135 @@
+import os
+import json
+import atexit
+import threading
+import numpy as np
+import Dm3Reader3 as dm3
+
+# index file stored in every directory with dm3 files
+indexFileName = '.dm3index.json'
+indexVersion = 2
+
+# -------------------------------------------------------------------
+
+class Dm3Index:
+    '''Cache of dm3 header information (data offset, dtype, dimensions, pixel width,
+    defocus and magnification) for all dm3 files in one directory.
+    Entry of a file is valid as long as size and modification time of the file do not change.
+    New entries are written to the index file by Flush() (called after loading a series and on exit).'''
+
+    def __init__(self, dirPath):
+        self.dirPath = dirPath
+        self.fPath = os.path.join(dirPath, indexFileName)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.Load()
+
+    def Load(self):
+        try:
+            with open(self.fPath, 'r') as indexFile:
+                index = json.load(indexFile)
+        except (OSError, ValueError):
+            return
+        if index.get('version') == indexVersion:
+            self.entries = index.get('files', {})
+
+    def Save(self):
+        index = {'version': indexVersion, 'files': self.entries}
+        tmpPath = self.fPath + '.tmp{0}'.format(os.getpid())
+        try:
+            with open(tmpPath, 'w') as indexFile:
+                json.dump(index, indexFile, indent=1, sort_keys=True)
+            os.replace(tmpPath, self.fPath)
+        except OSError:
+            # directory is read-only: cache works only in memory
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    def GetImageInfo(self, fPath):
+        fName = os.path.basename(fPath)
+        fStat = os.stat(fPath)
+        with self.lock:
+            entry = self.entries.get(fName)
+        if entry is not None and entry['size'] == fStat.st_size and entry['mtime'] == fStat.st_mtime_ns:
+            return EntryToImageInfo(entry)
+
+        imgInfo = dm3.FindDm3ImageData(fPath)
+        entry = ImageInfoToEntry(imgInfo)
+        entry['size'] = fStat.st_size
+        entry['mtime'] = fStat.st_mtime_ns
+        with self.lock:
+            self.entries[fName] = entry
+            self.dirty = True
+        return imgInfo
+
+    # saves index file if there are new entries
+    def Flush(self):
+        with self.lock:
+            if self.dirty:
+                self.Save()
+                self.dirty = False
+
+# -------------------------------------------------------------------
+
+def ImageInfoToEntry(imgInfo):
+    entry = dict(imgInfo)
+    entry['dtype'] = imgInfo['dtype'].str
+    entry['shape'] = list(imgInfo['shape'])
+    return entry
+
+# -------------------------------------------------------------------
+
+def EntryToImageInfo(entry):
+    imgInfo = {key: val for key, val in entry.items() if key not in ('size', 'mtime')}
+    imgInfo['dtype'] = np.dtype(entry['dtype'])
+    imgInfo['shape'] = tuple(entry['shape'])
+    return imgInfo
+
+# -------------------------------------------------------------------
+
+indexes = {}
+indexesLock = threading.Lock()
+
+def GetIndex(dirPath):
+    dirPath = os.path.abspath(dirPath)
+    with indexesLock:
+        if dirPath not in indexes:
+            indexes[dirPath] = Dm3Index(dirPath)
+        return indexes[dirPath]
+
+# -------------------------------------------------------------------
+
+# saves all modified indexes
+def Flush():
+    with indexesLock:
+        dirIndexes = list(indexes.values())
+    for index in dirIndexes:
+        index.Flush()
+
+atexit.register(Flush)
+
+# -------------------------------------------------------------------
+
+def GetImageInfo(fPath):
+    return GetIndex(os.path.dirname(fPath) or '.').GetImageInfo(fPath)
+
+# -------------------------------------------------------------------
+
+def ReadImageData(fPath, useMmap=True):
+    return dm3.ReadDm3ImageData(fPath, useMmap, GetImageInfo(fPath))
+
+# -------------------------------------------------------------------
+
+def ReadImageDataInto(fPath, out):
+    return dm3.ReadDm3ImageDataInto(fPath, out, GetImageInfo(fPath))
+
+# -------------------------------------------------------------------
+
+def ReadFrameInto(fPath, frameIdx, out):
+    return dm3.ReadDm3ImageDataInto(fPath, out, dm3.GetDm3FrameInfo(GetImageInfo(fPath), frameIdx))
+
+# -------------------------------------------------------------------
+
+def IterFrames(fPath, out=None):
+    return dm3.IterDm3Frames(fPath, out, GetImageInfo(fPath))
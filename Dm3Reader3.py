@@ -1,11 +1,35 @@
 # '<i' == little endian byte ordering
 # stworzyc klase tag_group, tag itp.
 
+import struct
+import numpy as np
+
 # sizes of different datatypes in bytes
-type_size = { 'char': 1, 'bool': 1, 'i8': 1, 'i16': 2, 'i32': 4, 'float': 4, 'double': 8 }
+type_size = { 'char': 1, 'bool': 1, 'i8': 1, 'i16': 2, 'i32': 4, 'i64': 8, 'float': 4, 'double': 8 }
 
 # format strings for different datatypes to be used inside the struct.unpack() function
-type_format = { 'char': 'c', 'uchar': 'B', 'bool': '?', 'i16': 'h', 'ui16': 'H', 'i32': 'i', 'ui32': 'I', 'float': 'f', 'double': 'd' }
+type_format = { 'char': 'c', 'uchar': 'B', 'bool': '?', 'i16': 'h', 'ui16': 'H', 'i32': 'i', 'ui32': 'I', 'i64': 'q', 'ui64': 'Q', 'float': 'f', 'double': 'd' }
+
+# format of header fields (file size, number of tags, tag sizes, info arrays) which are 32-bit in dm3 and 64-bit in dm4
+header_type = { 3: 'i32', 4: 'i64' }
+
+# numpy dtypes (without byte order character) for dm3 datatype ids
+np_type_format = { 2: 'i2', 3: 'i4', 4: 'u2', 5: 'u4', 6: 'f4', 7: 'f8', 8: 'b1', 9: 'i1', 10: 'u1', 11: 'i8', 12: 'u8' }
+
+# labels of microscope tags (in 'ImageTags' / 'Microscope Info' group) read together with image data
+defocus_labels = [ 'Defocus', 'Defocus (um)', 'Focus' ]
+# units of defocus tags (in meters)
+defocus_units = { 'Defocus': 1e-9, 'Defocus (um)': 1e-6, 'Focus': 1e-9 }
+magnification_labels = [ 'Indicated Magnification', 'Actual Magnification' ]
+
+# length units of image calibration (in meters)
+length_units = { 'm': 1.0, 'mm': 1e-3, 'um': 1e-6, '\u00b5m': 1e-6, 'nm': 1e-9, 'A': 1e-10, '\u00c5': 1e-10, 'pm': 1e-12 }
+
+# struct.unpack() format characters for dm3 datatype ids
+struct_type_format = { 2: 'h', 3: 'i', 4: 'H', 5: 'I', 6: 'f', 7: 'd', 8: '?', 9: 'c', 10: 'B', 11: 'q', 12: 'Q' }
+
+# image data is read in chunks of this size (in bytes) when it is streamed into preallocated array
+read_chunk_size = 64 * 1024 * 1024
 
 #-----------------------------------------------------------------------------------
 
@@ -41,70 +65,119 @@ def GetTypeSize(type_id):
     return type_size['char']
   elif type_id == 10:
     return type_size['i8']
+  elif type_id == 11 or type_id == 12:
+    return type_size['i64']
 
 #------------------------------------------------------------------------------------
 
-def ReadDm3File(dm3_fpath):
+def ReadDm3File(dm3_fpath, log=False):
   '''Reads dm3 file byte after byte to get the image data.
-  Then saves the image in png format.
-  Possible future developments: reading and storing values of all dm3 tags.
+  Only dm3 files are supported (use ReadDm3ImageData() for dm4 files and large images).
   Keyword arguments:
   dm3_fpath (string) -- path of the dm3 file to be read
-  Returns: None
+  log (boolean) -- if True the structure of the file (tag labels) is written to the '_log.txt' file
+  Returns: list of image data values
   '''
 
-  import sys
-  import struct
+  with open(dm3_fpath, 'rb') as dm3_file:
+    dm3_items = ReadDm3Header(dm3_file)
+    if dm3_items['dm_version'] != 3:
+      raise ValueError('"%s" is not a dm3 file, use ReadDm3ImageData() instead' % dm3_fpath)
+
+    log_file = OpenLogFile(dm3_fpath) if log else None
+    Log(log_file, 'Reading DM3 File...')
+
+    Log(log_file, 'DM version: ' + str(dm3_items['dm_version']) + '\n' \
+                  'File size: ' + str(dm3_items['file_size']) + ' bytes')
+
+    image_data = []
+    ReadTagGroup(dm3_file, image_data, log_file)
+    #SaveDm3AsPng(image_data, dm3_fpath)
+    Log(log_file, '\nAll done')
+
+  if log_file is not None:
+    log_file.close()
 
-  sys.stdout = open(dm3_fpath.replace('.dm3', '_log.txt'), 'w')
-  dm3_file = open(dm3_fpath, 'rb')
-  print('Reading DM3 File...')
+  return image_data
 
-  header_size = 3 * type_size['i32']
-  header = dm3_file.read(header_size)
-  header = Reverse(header)
-  # zamiast Reverse() mozna wczytac stringa w odpowiednim formacie, np.
-  # header = struct.unpack('>i', dm3_file.read(size))
+#-----------------------------------------------------------------------------------
 
-  header_format = '%di' % (len(header) // 4)
-  header_list = list(struct.unpack(header_format, header))
+def ReadDm3Header(dm3_file):
+  '''Reads header of dm3 (or dm4) file.
+  Header fields are stored in big endian byte order; file size is 32-bit in dm3 and 64-bit in dm4.
+  Keyword arguments:
+  dm3_file (file) -- dm3 file object
+  Returns: dictionary with keys 'dm_version', 'file_size' and 'byte_order'
+  '''
 
-  dm3_items = { 'dm_version': 0, 'file_size': 0, 'byte_order': 0, 'tag_group': 0 }
+  dm3_items = { 'dm_version': 0, 'file_size': 0, 'byte_order': 0 }
 
-  dm3_items['dm_version'] = header_list[2]
-  dm3_items['file_size'] = header_list[1]
-  dm3_items['byte_order'] = header_list[0]
+  dm3_items['dm_version'] = ReadHeaderValue(dm3_file, 'i32')
+  if dm3_items['dm_version'] not in header_type:
+    raise ValueError('Unsupported DM version: %d' % dm3_items['dm_version'])
+  dm3_items['file_size'] = ReadHeaderValue(dm3_file, header_type[dm3_items['dm_version']])
+  dm3_items['byte_order'] = ReadHeaderValue(dm3_file, 'i32')
 
-  print('DM version: ' + str(dm3_items['dm_version']) + '\n' \
-        'File size: ' + str(dm3_items['file_size']) + ' bytes')
+  return dm3_items
 
-  image_data = []
+#-----------------------------------------------------------------------------------
 
-  main_tag_group_size = dm3_items['file_size'] - header_size
-  ReadTagGroup(dm3_file, image_data)
-  #SaveDm3AsPng(image_data, dm3_fpath)
-  print('\nAll done')
-  sys.stdout = sys.__stdout__
+def ReadHeaderValue(dm3_file, type_name):
+  '''Reads single big endian integer (header field) from dm3 file.
+  Keyword arguments:
+  dm3_file (file) -- dm3 file object
+  type_name (string) -- 'i32' or 'i64'
+  Returns: integer
+  '''
 
-  return image_data
+  import struct
+
+  return struct.unpack('>' + type_format[type_name], dm3_file.read(type_size[type_name]))[0]
 
 #-----------------------------------------------------------------------------------
 
-def ReadTagGroup(dm3_file, image_data):
+def OpenLogFile(dm3_fpath):
+  '''Opens log file for dm3 file (the file with '_log.txt' suffix in place of extension).
+  Keyword arguments:
+  dm3_fpath (string) -- path of the dm3 file
+  Returns: file
+  '''
+
+  import os
+
+  return open(os.path.splitext(dm3_fpath)[0] + '_log.txt', 'w')
+
+#-----------------------------------------------------------------------------------
+
+def Log(log_file, text):
+  '''Writes text to the log file (if logging is enabled).
+  Keyword arguments:
+  log_file (file) -- log file object or None (logging disabled)
+  text (string) -- text to be written
+  Returns: None
+  '''
+
+  if log_file is not None:
+    log_file.write(text + '\n')
+
+#-----------------------------------------------------------------------------------
+
+def ReadTagGroup(dm3_file, image_data, log_file=None):
   '''Reads group of dm3 tags.
   For every single tag in a group it calls ReadTag() function.
   Keyword arguments:
   dm3_file (file) -- dm3 file object
   image_data (list) -- empty container for the image data
   (image data will be stored in this list when tag with 'Data' label will be found)
+  log_file (file) -- log file object or None (logging disabled)
   Returns: None
   '''
 
   import struct
 
-  print('\n----------------------------------------\n' + \
-        'Tag Group' + \
-        '\n----------------------------------------')
+  Log(log_file, '\n----------------------------------------\n' + \
+                'Tag Group' + \
+                '\n----------------------------------------')
 
   tgroup_header_size = 2 * type_size['bool'] + type_size['i32']
   tgroup_header = dm3_file.read(tgroup_header_size)
@@ -117,17 +190,18 @@ def ReadTagGroup(dm3_file, image_data):
   tgroup_items['is_sorted'] = struct.unpack('?', tgroup_header[5:6])[0]
 
   for tag_idx in range(0, tgroup_items['n_tags']):    # moze byc tez range(tgroup_items['n_tags'])
-    ReadTag(dm3_file, image_data)
+    ReadTag(dm3_file, image_data, log_file)
 
 #-----------------------------------------------------------------------------------
 
-def ReadTag(dm3_file, image_data):
+def ReadTag(dm3_file, image_data, log_file=None):
   '''Reads single tag.
   If a tag turns out to be a tag group it calls ReadTagGroup() function.
   If a tag is a single tag then it calls ReadTagType() function.
   Keyword arguments:
   dm3_file (file) -- dm3 file object
   image_data (list) -- container for the image data
+  log_file (file) -- log file object or None (logging disabled)
   Returns: None
   '''
 
@@ -147,7 +221,7 @@ def ReadTag(dm3_file, image_data):
   label_format = '%ds' % tag_items['label_length']
   tag_items['label'] = (struct.unpack(label_format, dm3_file.read(tag_items['label_length']))[0]).decode('utf-8', 'ignore')
 
-  print('"%s"' % (tag_items['label']))
+  Log(log_file, '"%s"' % (tag_items['label']))
   #print(str(tag_items['label'])[1:])
 
   has_data = False
@@ -155,7 +229,7 @@ def ReadTag(dm3_file, image_data):
     has_data = True
 
   if tag_items['is_group']:
-    ReadTagGroup(dm3_file, image_data)
+    ReadTagGroup(dm3_file, image_data, log_file)
   else:
     ReadTagType(dm3_file, has_data, image_data)
 
@@ -184,40 +258,54 @@ def ReadTagType(dm3_file, has_data, image_data):
   info_array_format = '>%di' % (ttype_items['info_array_length'])
   ttype_items['info_array'] = struct.unpack(info_array_format, dm3_file.read(info_array_size))
 
+  type_id, data_size = ParseTagInfoArray(ttype_items['info_array'])
+
+  n_elements = data_size / GetTypeSize(type_id)
+  ReadTagData(dm3_file, n_elements, type_id, has_data, image_data)
+
+#-----------------------------------------------------------------------------------
+
+def ParseTagInfoArray(info_array):
+  '''Determines datatype and size of the tag data from the info array of a tag.
+  Keyword arguments:
+  info_array (tuple) -- info array of a tag (sequence of integers given by dm3 format)
+  Returns: tuple (type_id, data_size)
+  '''
+
+  info_array_length = len(info_array)
   type_id = 0
   array_size = 0
   data_size = 0
 
   # array
-  if ttype_items['info_array'][0] == 20:    # array type id = 20
-    array_size = ttype_items['info_array'][ttype_items['info_array_length'] - 1]
+  if info_array[0] == 20:    # array type id = 20
+    array_size = info_array[info_array_length - 1]
 
     # simple array
-    if ttype_items['info_array_length'] == 3:      # length of simple array = 3
-      type_id = ttype_items['info_array'][1]
+    if info_array_length == 3:      # length of simple array = 3
+      type_id = info_array[1]
       data_size = GetTypeSize(type_id) * array_size
 
     # array of groups
-    elif ttype_items['info_array_length'] == 11:   # length of array of groups = 11
-      type_id = ttype_items['info_array'][5]
-      for i in range(0, ttype_items['info_array'][3]):
-        data_size += GetTypeSize(ttype_items['info_array'][5 + 2 * i]) * array_size
+    elif info_array[1] == 15:       # array of groups (structs)
+      type_id = info_array[5]
+      for i in range(0, info_array[3]):
+        data_size += GetTypeSize(info_array[5 + 2 * i]) * array_size
 
   # not array
   else:
     # struct
-    if ttype_items['info_array_length'] > 1:       # length of single entry = 1
-      type_id = ttype_items['info_array'][4]
-      for i in range(0, ttype_items['info_array'][2]):
-        data_size += GetTypeSize(ttype_items['info_array'][4 + 2 * i])
+    if info_array_length > 1:       # length of single entry = 1
+      type_id = info_array[4]
+      for i in range(0, info_array[2]):
+        data_size += GetTypeSize(info_array[4 + 2 * i])
 
     # single entry
     else:
-      type_id = ttype_items['info_array'][0]
-      data_size = GetTypeSize(ttype_items['info_array'][0])
+      type_id = info_array[0]
+      data_size = GetTypeSize(info_array[0])
 
-  n_elements = data_size / GetTypeSize(type_id)
-  ReadTagData(dm3_file, n_elements, type_id, has_data, image_data)
+  return type_id, data_size
 
 #-----------------------------------------------------------------------------------
 
@@ -267,6 +355,476 @@ def ReadTagData(dm3_file, n_elements, type_id, has_data, image_data):
 
 #------------------------------------------------------------------------------------
 
+class Tag:
+  '''Single dm3 tag (leaf of the tag tree).
+  Only position, datatype and size of the tag data are stored.
+  The value is decoded when it is accessed for the first time.
+  '''
+
+  def __init__(self, label, dm3_fpath, offset, info_array, endian, raw_data=None):
+    self.label = label
+    self.fpath = dm3_fpath
+    self.offset = offset
+    self.info_array = info_array
+    self.endian = endian
+    self.type_id, self.size = ParseTagInfoArray(info_array)
+    self.raw_data = raw_data
+    self.decoded = False
+    self.decoded_value = None
+
+  def __repr__(self):
+    return 'Tag(%r, type_id=%d, offset=%d, size=%d)' % (self.label, self.type_id, self.offset, self.size)
+
+  def IsArray(self):
+    return self.info_array[0] == 20
+
+  @property
+  def value(self):
+    if not self.decoded:
+      self.decoded_value = self.Decode()
+      self.decoded = True
+    return self.decoded_value
+
+  def ReadRawData(self):
+    if self.raw_data is not None:
+      return self.raw_data
+    with open(self.fpath, 'rb') as dm3_file:
+      dm3_file.seek(self.offset)
+      return dm3_file.read(self.size)
+
+  def Decode(self):
+    info_array = self.info_array
+
+    # simple array -> numpy array
+    if self.IsArray() and len(info_array) == 3:
+      n_elements = self.size // GetTypeSize(self.type_id)
+      return np.fromfile(self.fpath, dtype=self.endian + np_type_format[self.type_id], count=n_elements, offset=self.offset)
+
+    # array of groups -> numpy structured array
+    if self.IsArray():
+      n_fields = info_array[3]
+      fields = [ ('f%d' % i, self.endian + np_type_format[info_array[5 + 2 * i]]) for i in range(n_fields) ]
+      return np.fromfile(self.fpath, dtype=np.dtype(fields), count=info_array[-1], offset=self.offset)
+
+    # struct -> tuple
+    if len(info_array) > 1:
+      field_types = [ info_array[4 + 2 * i] for i in range(info_array[2]) ]
+      struct_format = self.endian + ''.join(struct_type_format[t] for t in field_types)
+      return struct.unpack(struct_format, self.ReadRawData())
+
+    # single entry
+    return struct.unpack(self.endian + struct_type_format[self.type_id], self.ReadRawData())[0]
+
+#------------------------------------------------------------------------------------
+
+class TagGroup:
+  '''Group of dm3 tags (node of the tag tree).
+  Tags can be accessed by label or by index, e.g. tags['ImageList'][1]['ImageData']['Calibrations'].
+  Subgroups are returned as TagGroup objects, single tags are returned as decoded values
+  (use GetTag() to get the Tag object itself).
+  '''
+
+  def __init__(self, label, offset, is_sorted=False, is_open=False):
+    self.label = label
+    self.offset = offset
+    self.size = 0
+    self.is_sorted = is_sorted
+    self.is_open = is_open
+    self.labels = []
+    self.tags = []
+
+  def __repr__(self):
+    return 'TagGroup(%r, n_tags=%d, offset=%d, size=%d)' % (self.label, len(self.tags), self.offset, self.size)
+
+  def __len__(self):
+    return len(self.tags)
+
+  def __iter__(self):
+    return iter(self.tags)
+
+  def __contains__(self, label):
+    return label in self.labels
+
+  def __getitem__(self, key):
+    tag = self.GetTag(key)
+    return tag if isinstance(tag, TagGroup) else tag.value
+
+  def keys(self):
+    return list(self.labels)
+
+  def get(self, key, default=None):
+    return self[key] if key in self.labels else default
+
+  def GetTag(self, key):
+    if isinstance(key, str):
+      if key not in self.labels:
+        raise KeyError(key)
+      return self.tags[self.labels.index(key)]
+    return self.tags[key]
+
+  def AddTag(self, tag):
+    self.labels.append(tag.label)
+    self.tags.append(tag)
+
+#------------------------------------------------------------------------------------
+
+def ReadDm3Tags(dm3_fpath, log=False):
+  '''Builds the tag tree of dm3 file without decoding values of tags.
+  Keyword arguments:
+  dm3_fpath (string) -- path of the dm3 file to be read
+  log (boolean) -- if True the labels of tags are written to the '_log.txt' file
+  Returns: TagGroup (root tag group) with additional attribute 'header' (dictionary)
+  '''
+
+  log_file = OpenLogFile(dm3_fpath) if log else None
+
+  with open(dm3_fpath, 'rb') as dm3_file:
+    dm3_items = ReadDm3Header(dm3_file)
+    file_info = { 'fpath': dm3_fpath, 'endian': '<' if dm3_items['byte_order'] == 1 else '>',
+                  'header_type': header_type[dm3_items['dm_version']] }
+    root = BuildTagGroup(dm3_file, file_info, '', log_file)
+
+  if log_file is not None:
+    log_file.close()
+
+  root.header = dm3_items
+  return root
+
+#------------------------------------------------------------------------------------
+
+def BuildTagGroup(dm3_file, file_info, label, log_file=None):
+  '''Reads header of a tag group and builds all of its tags.
+  Keyword arguments:
+  dm3_file (file) -- dm3 file object
+  file_info (dictionary) -- path of the file ('fpath'), byte order character of the data ('endian')
+  and type of header fields ('header_type': 'i32' for dm3, 'i64' for dm4)
+  label (string) -- label of the tag group
+  log_file (file) -- log file object or None (logging disabled)
+  Returns: TagGroup
+  '''
+
+  import struct
+
+  offset = dm3_file.tell()
+  tgroup_header = dm3_file.read(2 * type_size['bool'])
+  is_sorted = struct.unpack('?', tgroup_header[0:1])[0]
+  is_open = struct.unpack('?', tgroup_header[1:2])[0]
+  n_tags = ReadHeaderValue(dm3_file, file_info['header_type'])
+
+  tag_group = TagGroup(label, offset, is_sorted, is_open)
+  for tag_idx in range(n_tags):
+    tag_group.AddTag(BuildTag(dm3_file, file_info, log_file))
+
+  tag_group.size = dm3_file.tell() - offset
+  return tag_group
+
+#------------------------------------------------------------------------------------
+
+def BuildTag(dm3_file, file_info, log_file=None):
+  '''Reads header of a single tag and records where its data is stored.
+  Data of arrays is skipped, data of single entries and structs (few bytes) is kept undecoded.
+  Keyword arguments:
+  dm3_file (file) -- dm3 file object
+  file_info (dictionary) -- path of the file, byte order of the data and type of header fields
+  log_file (file) -- log file object or None (logging disabled)
+  Returns: Tag or TagGroup
+  '''
+
+  import struct
+
+  tag_header = Reverse(dm3_file.read(type_size['char'] + type_size['i16']))
+  label_length = struct.unpack('h', tag_header[:2])[0]
+  is_group = tag_header[2] == 20
+  label = dm3_file.read(label_length).decode('utf-8', 'ignore')
+  Log(log_file, '"%s"' % label)
+
+  # dm4: every tag starts with 64-bit size of the tag (not needed here)
+  if file_info['header_type'] == 'i64':
+    ReadHeaderValue(dm3_file, 'i64')
+
+  if is_group:
+    return BuildTagGroup(dm3_file, file_info, label, log_file)
+
+  field_type = file_info['header_type']
+  dm3_file.seek(4, 1)     # '%%%%' delimiter
+  info_array_length = ReadHeaderValue(dm3_file, field_type)
+  info_array_format = '>%d%s' % (info_array_length, type_format[field_type])
+  info_array = struct.unpack(info_array_format, dm3_file.read(info_array_length * type_size[field_type]))
+
+  tag = Tag(label, file_info['fpath'], dm3_file.tell(), info_array, file_info['endian'])
+  if tag.IsArray():
+    dm3_file.seek(tag.size, 1)
+  else:
+    tag.raw_data = dm3_file.read(tag.size)
+  return tag
+
+#------------------------------------------------------------------------------------
+
+def FindDm3ImageData(dm3_fpath):
+  '''Finds where the image data is stored in dm3 file (without reading the data).
+  If there is more than one image in a file (e.g. thumbnail + image) the last one is taken
+  (the same one which is returned by ReadDm3File()).
+  Keyword arguments:
+  dm3_fpath (string) -- path of the dm3 file to be read
+  Returns: dictionary with keys 'offset' (bytes), 'dtype' (numpy dtype), 'shape' (tuple),
+  'px_width' (m), 'defocus' (m) and 'magnification' (value of microscope tag); values are None if missing
+  '''
+
+  import numpy as np
+
+  tags = ReadDm3Tags(dm3_fpath)
+  image = None
+  for img in tags.get('ImageList', []):
+    if 'ImageData' in img and 'Data' in img['ImageData']:
+      image = img
+
+  if image is None:
+    raise ValueError('No image data found in "%s"' % dm3_fpath)
+
+  image_data = image['ImageData']
+
+  data_tag = image_data.GetTag('Data')
+  if data_tag.type_id not in np_type_format:
+    raise ValueError('Unsupported image datatype (id = %d) in "%s"' % (data_tag.type_id, dm3_fpath))
+
+  # dm3 dimensions are given as (x, y[, z]) while x index changes the fastest
+  n_elements = data_tag.size // GetTypeSize(data_tag.type_id)
+  dims = [ dim_tag.value for dim_tag in image_data.get('Dimensions', []) ]
+  shape = tuple(int(dim) for dim in reversed(dims))
+  if not shape or np.prod(shape) != n_elements:
+    shape = (n_elements,)
+
+  dtype = np.dtype(data_tag.endian + np_type_format[data_tag.type_id])
+  data_info = { 'offset': data_tag.offset, 'dtype': dtype, 'shape': shape }
+
+  data_info['px_width'] = GetPixelWidth(image_data)
+  microscope_info = image.get('ImageTags', {}).get('Microscope Info', {})
+  data_info['defocus'] = GetDefocus(microscope_info)
+  data_info['magnification'] = FindTagValue(microscope_info, magnification_labels)
+  return data_info
+
+#------------------------------------------------------------------------------------
+
+def GetPixelWidth(image_data):
+  '''Gets pixel width from the calibration of the first image dimension.
+  Keyword arguments:
+  image_data (TagGroup) -- 'ImageData' tag group
+  Returns: pixel width in meters (float) or None if the image is not calibrated
+  '''
+
+  try:
+    calibration = image_data['Calibrations']['Dimension'][0]
+    scale = float(calibration['Scale'])
+    units = TagString(calibration.get('Units', ''))
+  except (KeyError, IndexError, TypeError):
+    return None
+
+  if units not in length_units:
+    return None
+  return scale * length_units[units]
+
+#------------------------------------------------------------------------------------
+
+def GetDefocus(microscope_info):
+  '''Gets defocus from microscope tags.
+  Keyword arguments:
+  microscope_info (TagGroup) -- 'Microscope Info' tag group
+  Returns: defocus in meters (float) or None if there is no defocus tag
+  '''
+
+  for label in defocus_labels:
+    if label in microscope_info:
+      try:
+        return float(microscope_info[label]) * defocus_units[label]
+      except (TypeError, ValueError):
+        return None
+  return None
+
+#------------------------------------------------------------------------------------
+
+def FindTagValue(tag_group, labels):
+  '''Returns value of the first tag (from the list of labels) which is present in a tag group.
+  Keyword arguments:
+  tag_group (TagGroup) -- tag group to be searched
+  labels (list) -- labels of tags
+  Returns: value of the tag or None if none of the tags is present
+  '''
+
+  for label in labels:
+    if label in tag_group:
+      return tag_group[label]
+  return None
+
+#------------------------------------------------------------------------------------
+
+def TagString(value):
+  '''Converts value of a text tag (dm3 stores strings as arrays of 16-bit characters) to string.
+  Keyword arguments:
+  value -- decoded value of a tag
+  Returns: string
+  '''
+
+  if isinstance(value, str):
+    return value
+  return ''.join(chr(c) for c in value)
+
+#------------------------------------------------------------------------------------
+
+def ReadDm3ImageData(dm3_fpath, use_mmap=True, data_info=None):
+  '''Reads image data of dm3 file directly into numpy array (without decoding it value by value).
+  Keyword arguments:
+  dm3_fpath (string) -- path of the dm3 file to be read
+  use_mmap (boolean) -- if True the data is memory-mapped (nothing is read until pixels are accessed),
+  otherwise it is read with one sequential read
+  data_info (dictionary) -- position, dtype and shape of the data (as returned by FindDm3ImageData());
+  if None the tag tree of the file is searched
+  Returns: numpy array (or memmap) with the shape given by image dimensions
+  '''
+
+  import numpy as np
+
+  if data_info is None:
+    data_info = FindDm3ImageData(dm3_fpath)
+  if use_mmap:
+    return np.memmap(dm3_fpath, dtype=data_info['dtype'], mode='r', offset=data_info['offset'], shape=data_info['shape'])
+
+  n_elements = int(np.prod(data_info['shape']))
+  image_data = np.fromfile(dm3_fpath, dtype=data_info['dtype'], count=n_elements, offset=data_info['offset'])
+  return image_data.reshape(data_info['shape'])
+
+#------------------------------------------------------------------------------------
+
+def ReadDm3ImageDataInto(dm3_fpath, out, data_info=None):
+  '''Streams image data of dm3 (or dm4) file into preallocated array (or memmap) in chunks.
+  If datatype of the array differs from the datatype of the data, every chunk is converted separately,
+  so the whole image is never held in memory in its original datatype.
+  Keyword arguments:
+  dm3_fpath (string) -- path of the dm3 file to be read
+  out (numpy array) -- C-contiguous array with the same number of elements as the image
+  data_info (dictionary) -- position, dtype and shape of the data (as returned by FindDm3ImageData());
+  if None the tag tree of the file is searched
+  Returns: out (numpy array)
+  '''
+
+  import numpy as np
+
+  if data_info is None:
+    data_info = FindDm3ImageData(dm3_fpath)
+
+  n_elements = int(np.prod(data_info['shape']))
+  if out.size != n_elements or not out.flags['C_CONTIGUOUS']:
+    raise ValueError('Output array must be C-contiguous and have %d elements' % n_elements)
+
+  dtype = data_info['dtype']
+  out_flat = out.reshape(-1)
+  chunk_length = max(read_chunk_size // dtype.itemsize, 1)
+  same_dtype = out.dtype == dtype
+  chunk_buffer = None if same_dtype else np.empty(min(chunk_length, n_elements), dtype=dtype)
+
+  with open(dm3_fpath, 'rb') as dm3_file:
+    dm3_file.seek(data_info['offset'])
+    for start in range(0, n_elements, chunk_length):
+      stop = min(start + chunk_length, n_elements)
+      if same_dtype:
+        ReadExactly(dm3_file, out_flat[start:stop])
+      else:
+        chunk = chunk_buffer[:stop - start]
+        ReadExactly(dm3_file, chunk)
+        out_flat[start:stop] = chunk
+
+  return out
+
+#------------------------------------------------------------------------------------
+
+def GetDm3FrameInfo(data_info, frame_idx):
+  '''Gives position, datatype and shape of a single frame of the image data.
+  Image data of a stack is stored frame after frame (frames x height x width);
+  2D image is treated as a stack with one frame.
+  Keyword arguments:
+  data_info (dictionary) -- position, dtype and shape of the data (as returned by FindDm3ImageData())
+  frame_idx (integer) -- index of the frame
+  Returns: dictionary with keys 'offset', 'dtype' and 'shape' (height, width)
+  '''
+
+  n_frames = CountDm3Frames(data_info)
+  if not 0 <= frame_idx < n_frames:
+    raise IndexError('Frame index %d out of range (%d frames)' % (frame_idx, n_frames))
+
+  frame_shape = tuple(data_info['shape'][-2:])
+  frame_size = frame_shape[0] * frame_shape[1] * data_info['dtype'].itemsize
+  frame_info = dict(data_info)
+  frame_info['offset'] = data_info['offset'] + frame_idx * frame_size
+  frame_info['shape'] = frame_shape
+  return frame_info
+
+#------------------------------------------------------------------------------------
+
+def CountDm3Frames(data_info):
+  '''Gives number of frames in the image data (1 for 2D image).
+  Keyword arguments:
+  data_info (dictionary) -- position, dtype and shape of the data (as returned by FindDm3ImageData())
+  Returns: integer
+  '''
+
+  shape = data_info['shape']
+  if len(shape) < 2:
+    raise ValueError('Image data has no 2D frames (shape = %s)' % str(shape))
+
+  n_frames = 1
+  for dim in shape[:-2]:
+    n_frames *= dim
+  return n_frames
+
+#------------------------------------------------------------------------------------
+
+def IterDm3Frames(dm3_fpath, out=None, data_info=None):
+  '''Generator which yields frames of image data (e.g. of in-situ or dose-fractionated stack) one by one.
+  Only one frame at a time is held in memory.
+  Keyword arguments:
+  dm3_fpath (string) -- path of the dm3 file to be read
+  out (numpy array) -- buffer (height x width) reused for every frame;
+  if None the frames are yielded as views of memory-mapped data (read when pixels are accessed)
+  data_info (dictionary) -- position, dtype and shape of the data (as returned by FindDm3ImageData());
+  if None the tag tree of the file is searched
+  Returns: generator of numpy arrays (height x width)
+  '''
+
+  import numpy as np
+
+  if data_info is None:
+    data_info = FindDm3ImageData(dm3_fpath)
+  n_frames = CountDm3Frames(data_info)
+
+  if out is None:
+    frames = np.memmap(dm3_fpath, dtype=data_info['dtype'], mode='r', offset=data_info['offset'],
+                       shape=(n_frames,) + tuple(data_info['shape'][-2:]))
+    for frame_idx in range(n_frames):
+      yield frames[frame_idx]
+    return
+
+  for frame_idx in range(n_frames):
+    yield ReadDm3ImageDataInto(dm3_fpath, out, GetDm3FrameInfo(data_info, frame_idx))
+
+#------------------------------------------------------------------------------------
+
+def ReadExactly(dm3_file, arr):
+  '''Fills array with bytes read from file (without creating intermediate objects).
+  Keyword arguments:
+  dm3_file (file) -- dm3 file object
+  arr (numpy array) -- contiguous array to be filled
+  Returns: None
+  '''
+
+  buffer = memoryview(arr).cast('B')
+  n_read = 0
+  while n_read < len(buffer):
+    n = dm3_file.readinto(buffer[n_read:])
+    if not n:
+      raise EOFError('Unexpected end of file "%s"' % dm3_file.name)
+    n_read += n
+
+#------------------------------------------------------------------------------------
+
 def SaveDm3AsPng(image_data, dm3_fname):
   '''Saves image data as png file.
   Image data is a matrix of integer values. Each value corresponds to a single greyscale pixel.
@@ -0,0 +1,203 @@
+import os
+import pickle
+import atexit
+import threading
+import numpy as np
+import Backend as backend
+import ArrayPool as apool
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+try:
+    import scipy.fft as cpufft
+except ImportError:
+    cpufft = None
+
+# -------------------------------------------------------------------
+# 2D FFT of images (H x W) and batches of images (N x H x W), always over the last two axes.
+# CUDA backend: cuFFT plans (from CuPy), which work directly on Numba device arrays.
+# CPU backend: FFTW plans (pyfftw) if it is available, otherwise scipy.fft; both use many threads.
+# Without both of them numpy.fft is used, which is single-threaded (and much slower).
+# Plans are cached by (backend, shape, dtype, direction). FFTW plans can be kept between runs as wisdom
+# (LA_FFT_WISDOM environment variable or wisdomPath), cuFFT plans are only cached in memory.
+# Inverse transform is not normalized (like cuFFT).
+# -------------------------------------------------------------------
+
+direction = {'FORWARD': 0, 'INVERSE': 1}
+wisdomEnvVar = 'LA_FFT_WISDOM'
+
+# -------------------------------------------------------------------
+
+class FFTEngine:
+    def __init__(self, workers=None, wisdomPath=None, useFFTW=True):
+        self.workers = workers if workers is not None else backend.GetNumberOfThreads()
+        self.wisdomPath = wisdomPath
+        self.useFFTW = useFFTW and pyfftw is not None
+        self.plans = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.wisdomPath is not None:
+            self.LoadWisdom()
+            atexit.register(self.SaveWisdom)
+
+    def GetPlan(self, arr, out, fftDir):
+        key = (backend.GetBackend(), tuple(arr.shape), np.dtype(arr.dtype).str, fftDir, arr is out)
+        with self.lock:
+            plan = self.plans.get(key)
+            if plan is not None:
+                self.hits += 1
+                return plan
+            self.misses += 1
+
+        if backend.UseGPU():
+            plan = CreateCudaPlan(arr, fftDir)
+        elif self.useFFTW and arr is not out:
+            plan = CreateFFTWPlan(arr.shape, arr.dtype, fftDir, self.workers)
+        else:
+            plan = CreateCpuPlan(fftDir, self.workers)
+
+        with self.lock:
+            self.plans[key] = plan
+        return plan
+
+    def Transform(self, arr, out, fftDir):
+        self.GetPlan(arr, out, fftDir)(arr, out)
+        return out
+
+    def FFT2(self, arr, out):
+        return self.Transform(arr, out, direction['FORWARD'])
+
+    def IFFT2(self, arr, out):
+        return self.Transform(arr, out, direction['INVERSE'])
+
+    # equal-sized arrays are transformed as one batch (gathered into N x H x W array and scattered back)
+    def TransformMany(self, arrays, outs, fftDir):
+        if len(arrays) == 0:
+            return outs
+        memType = apool.mem['GPU'] if backend.IsDeviceArray(arrays[0]) else apool.mem['CPU']
+        shape = (len(arrays),) + tuple(arrays[0].shape)
+        batch = apool.Get(shape, arrays[0].dtype, memType)
+        batchOut = apool.Get(shape, arrays[0].dtype, memType)
+        for idx, arr in enumerate(arrays):
+            backend.CopyInto(batch[idx], arr)
+        self.Transform(batch, batchOut, fftDir)
+        for idx, out in enumerate(outs):
+            backend.CopyInto(out, batchOut[idx])
+        apool.Release(batch)
+        apool.Release(batchOut)
+        return outs
+
+    def FFT2Many(self, arrays, outs):
+        return self.TransformMany(arrays, outs, direction['FORWARD'])
+
+    def IFFT2Many(self, arrays, outs):
+        return self.TransformMany(arrays, outs, direction['INVERSE'])
+
+    def LoadWisdom(self):
+        if not self.useFFTW or not os.path.isfile(self.wisdomPath):
+            return
+        try:
+            with open(self.wisdomPath, 'rb') as wisdomFile:
+                pyfftw.import_wisdom(pickle.load(wisdomFile))
+        except (OSError, EOFError, pickle.UnpicklingError, TypeError, ValueError):
+            print('Could not load FFT wisdom from "{0}"'.format(self.wisdomPath))
+
+    def SaveWisdom(self):
+        if not self.useFFTW or self.wisdomPath is None:
+            return
+        with open(self.wisdomPath, 'wb') as wisdomFile:
+            pickle.dump(pyfftw.export_wisdom(), wisdomFile)
+
+    def ClearPlans(self):
+        with self.lock:
+            self.plans = {}
+
+    def GetStats(self):
+        with self.lock:
+            return {'plans': len(self.plans), 'hits': self.hits, 'misses': self.misses}
+
+# -------------------------------------------------------------------
+
+def CreateCudaPlan(arr, fftDir):
+    try:
+        import cupy
+        from cupy.cuda import cufft
+        from cupyx.scipy.fftpack import get_fft_plan
+    except ImportError:
+        raise ImportError('CuPy is needed for FFT on CUDA backend')
+    plan = get_fft_plan(cupy.asarray(arr), axes=(-2, -1), value_type='C2C')
+    cufftDir = cufft.CUFFT_FORWARD if fftDir == direction['FORWARD'] else cufft.CUFFT_INVERSE
+
+    def Execute(arr, out):
+        # CuPy arrays share memory with Numba device arrays
+        plan.fft(cupy.asarray(arr), cupy.asarray(out), cufftDir)
+
+    return Execute
+
+# -------------------------------------------------------------------
+
+def CreateFFTWPlan(shape, dtype, fftDir, workers):
+    # plan is made for temporary arrays (FFTW_MEASURE overwrites them) and then used for any arrays
+    arrTmp = pyfftw.empty_aligned(shape, dtype=dtype)
+    outTmp = pyfftw.empty_aligned(shape, dtype=dtype)
+    fftwDir = 'FFTW_FORWARD' if fftDir == direction['FORWARD'] else 'FFTW_BACKWARD'
+    plan = pyfftw.FFTW(arrTmp, outTmp, axes=(-2, -1), direction=fftwDir, threads=workers,
+                       flags=('FFTW_MEASURE', 'FFTW_UNALIGNED'))
+
+    # FFTW object keeps input and output arrays of the last call, so calls from many threads are serialized
+    planLock = threading.Lock()
+
+    def Execute(arr, out):
+        with planLock:
+            plan(arr, out, normalise_idft=False)
+
+    return Execute
+
+# -------------------------------------------------------------------
+
+numpyFFTWarned = False
+numpyFFTWarnLock = threading.Lock()
+
+def CreateCpuPlan(fftDir, workers):
+    global numpyFFTWarned
+    forward = fftDir == direction['FORWARD']
+    with numpyFFTWarnLock:
+        if cpufft is None and not numpyFFTWarned:
+            print('Neither pyfftw nor scipy is available: FFT runs on one thread (numpy.fft)')
+            numpyFFTWarned = True
+
+    def Execute(arr, out):
+        if cpufft is None:
+            out[...] = np.fft.fft2(arr) if forward else np.fft.ifft2(arr, norm='forward')
+        elif forward:
+            out[...] = cpufft.fft2(arr, workers=workers)
+        else:
+            out[...] = cpufft.ifft2(arr, norm='forward', workers=workers)
+
+    return Execute
+
+# -------------------------------------------------------------------
+
+engine = FFTEngine(wisdomPath=os.environ.get(wisdomEnvVar) or None)
+
+def FFT2(arr, out):
+    return engine.FFT2(arr, out)
+
+def IFFT2(arr, out):
+    return engine.IFFT2(arr, out)
+
+def FFT2Many(arrays, outs):
+    return engine.FFT2Many(arrays, outs)
+
+def IFFT2Many(arrays, outs):
+    return engine.IFFT2Many(arrays, outs)
+
+def GetStats():
+    return engine.GetStats()
+
+def SaveWisdom():
+    engine.SaveWisdom()
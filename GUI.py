@@ -6,6 +6,7 @@ import numpy as np
 from skimage import transform as tf
 from PyQt4 import QtGui, QtCore
 import Dm3Reader3 as dm3
+import SeriesLoader as sload
 import Constants as const
 import ImageSupport as imsup
 import CrossCorr as cc
@@ -319,32 +320,7 @@ class LatticeAnalyzerWidget(QtGui.QWidget):
 # --------------------------------------------------------
 
 def LoadImageSeriesFromFirstFile(imgPath):
-    imgList = imsup.ImageList()
-    imgNumMatch = re.search('([0-9]+).dm3', imgPath)
-    imgNumText = imgNumMatch.group(1)
-    imgNum = int(imgNumText)
-
-    while path.isfile(imgPath):
-        print('Reading file "' + imgPath + '"')
-        imgData = dm3.ReadDm3File(imgPath)
-        imgMatrix = imsup.PrepareImageMatrix(imgData, const.dimSize)
-        img = imsup.ImageWithBuffer(const.dimSize, const.dimSize, imsup.Image.cmp['CAP'], imsup.Image.mem['CPU'])
-        img.LoadAmpData(np.sqrt(imgMatrix).astype(np.float32))
-        # ---
-        # imsup.RemovePixelArtifacts(img, const.minPxThreshold, const.maxPxThreshold)
-        img.UpdateBuffer()
-        # ---
-        img.numInSeries = imgNum
-        imgList.append(img)
-
-        imgNum += 1
-        imgNumTextNew = imgNumText.replace(str(imgNum-1), str(imgNum))
-        if imgNum == 10:
-            imgNumTextNew = imgNumTextNew[1:]
-        imgPath = RReplace(imgPath, imgNumText, imgNumTextNew, 1)
-        imgNumText = imgNumTextNew
-
-    imgList.UpdateLinks()
+    imgList = sload.LoadImageSeries(imgPath, removeArtifacts=False)
     return imgList[0]
 
 # --------------------------------------------------------
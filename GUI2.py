@@ -5,6 +5,7 @@ from functools import partial
 import numpy as np
 from PyQt4 import QtGui, QtCore
 import Dm3Reader3 as dm3
+import SeriesLoader as sload
 import Constants as const
 import ImageSupport as imsup
 import CrossCorr as cc
@@ -363,34 +364,7 @@ class LatticeAnalyzerWidget(QtGui.QWidget):
 # --------------------------------------------------------
 
 def LoadImageSeriesFromFirstFile(imgPath):
-    imgList = imsup.ImageList()
-    imgNumMatch = re.search('([0-9]+).dm3', imgPath)
-    imgNumText = imgNumMatch.group(1)
-    imgNum = int(imgNumText)
-
-    while path.isfile(imgPath):
-        print('Reading file "' + imgPath + '"')
-        imgData = dm3.ReadDm3File(imgPath)
-        imgDimSize = np.sqrt(len(imgData))
-        imgMatrix = imsup.PrepareImageMatrix(imgData, imgDimSize)
-        img = imsup.ImageWithBuffer(imgDimSize, imgDimSize, imsup.Image.cmp['CAP'], imsup.Image.mem['CPU'])
-        img.LoadAmpData(np.sqrt(imgMatrix).astype(np.float32))
-        # ---
-        imsup.RemovePixelArtifacts(img, const.minPxThreshold, const.maxPxThreshold)
-        img.UpdateBuffer()
-        # ---
-        img.numInSeries = imgNum
-        imgList.append(img)
-
-        imgNum += 1
-        imgNumTextNew = imgNumText.replace(str(imgNum-1), str(imgNum))
-        if imgNum == 10:
-            imgNumTextNew = imgNumTextNew[1:]
-        imgPath = RReplace(imgPath, imgNumText, imgNumTextNew, 1)
-        print(imgPath)
-        imgNumText = imgNumTextNew
-
-    imgList.UpdateLinks()
+    imgList = sload.LoadImageSeries(imgPath, removeArtifacts=True)
     return imgList[0]
 
 # --------------------------------------------------------
@@ -1,31 +1,136 @@
 import numpy as np
 from PIL import Image as im
+import numba
 from numba import cuda
 import math, cmath
 import Constants as const
 import CudaConfig as ccfg
+import Backend as backend
+import ArrayPool as apool
+import ArraySupport as arrsup
+import FFTEngine as ffteng
 import CrossCorr as cc
 
 #-------------------------------------------------------------------
 
+class DualArray:
+    '''Array which can have copies in host (CPU) and device (GPU) memory.
+    Copy in the other memory is made only when array is accessed there. When array is accessed
+    for modification, copy in the other memory becomes stale and it is dropped.
+    Array without any copy (not allocated yet or dropped) is treated as array of zeros,
+    which is allocated when it is accessed for the first time.'''
+    __slots__ = ('shape', 'dtype', 'copies')
+    mem = {'CPU': 0, 'GPU': 1}
+
+    def __init__(self, shape, dtype, arr=None, memType=mem['CPU']):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.copies = [None, None]
+        if arr is not None:
+            self.Set(arr, memType)
+
+    def __del__(self):
+        self.Release()
+
+    # arrays from the pool which are not used anywhere else are returned to the pool
+    def Release(self):
+        apool.ReleaseIfUnused(self.copies, self.mem['CPU'])
+        apool.ReleaseIfUnused(self.copies, self.mem['GPU'])
+
+    def IsAllocated(self):
+        return self.copies[0] is not None or self.copies[1] is not None
+
+    def Set(self, arr, memType):
+        if backend.UseGPU():
+            memType = self.mem['GPU'] if backend.IsDeviceArray(arr) else self.mem['CPU']
+        self.Release()
+        self.copies[memType] = arr
+        self.shape = tuple(arr.shape)
+        self.dtype = np.dtype(arr.dtype)
+
+    def GetValidCopy(self):
+        return self.copies[0] if self.copies[0] is not None else self.copies[1]
+
+    def Get(self, memType, modify=True):
+        arr = self.copies[memType]
+        if arr is None:
+            src = self.copies[1 - memType]
+            if src is None:
+                arr = AllocArray(self.shape, self.dtype, memType, zero=True)
+            elif not backend.UseGPU():
+                arr = src           # host and device memory is the same on CPU backend
+            elif memType == self.mem['GPU']:
+                arr = backend.ToDevice(src)
+            else:
+                arr = backend.ToHost(src)
+            self.copies[memType] = arr
+        if modify:
+            apool.ReleaseIfUnused(self.copies, 1 - memType)
+        return arr
+
+    # returns uninitialized array which will be overwritten (nothing is transferred)
+    def GetForWrite(self, memType):
+        # released array is reused by the pool if nothing else refers to it
+        self.Release()
+        arr = AllocArray(self.shape, self.dtype, memType, zero=False)
+        self.copies[memType] = arr
+        return arr
+
+    # drops copy which is not in memType memory (e.g. host copy made only for reading)
+    def Compact(self, memType):
+        if self.copies[memType] is not None:
+            apool.ReleaseIfUnused(self.copies, 1 - memType)
+
+#-------------------------------------------------------------------
+
+def AllocArray(shape, dtype, memType=DualArray.mem['CPU'], zero=True):
+    return apool.Get(shape, dtype, memType, zero)
+
+#-------------------------------------------------------------------
+
+# runs conversion kernel in memory where the arrays are (on host it does not need GPU)
+def RunKernel(kernel, memType, shape, *args):
+    if memType == DualArray.mem['CPU']:
+        kernel.GetCpuKernel()(*args)
+    else:
+        blockDim, gridDim = ccfg.DetermineCudaConfigNew(shape)
+        kernel[gridDim, blockDim](*args)
+
+#-------------------------------------------------------------------
+
 class ComplexAmPhMatrix:
+    # arrays are allocated when they are accessed for the first time
+    __slots__ = ('memType', 'amArr', 'phArr')
     mem = {'CPU': 0, 'GPU': 1}
 
     def __init__(self, height, width, memType=mem['CPU']):
-        if memType == self.mem['CPU']:
-            # self.am = np.empty((height, width), dtype=np.float32)
-            # self.ph = np.empty((height, width), dtype=np.float32)
-            self.am = np.zeros((height, width), dtype=np.float32)
-            self.ph = np.zeros((height, width), dtype=np.float32)
-        else:
-            # self.am = cuda.device_array((height, width), dtype=np.float32)
-            # self.ph = cuda.device_array((height, width), dtype=np.float32)
-            self.am = cuda.to_device(np.zeros((height, width), dtype=np.float32))
-            self.ph = cuda.to_device(np.zeros((height, width), dtype=np.float32))
+        self.memType = memType
+        self.amArr = DualArray((height, width), np.float32)
+        self.phArr = DualArray((height, width), np.float32)
 
     def __del__(self):
-        del self.am
-        del self.ph
+        del self.amArr
+        del self.phArr
+
+    def Drop(self):
+        self.amArr.Release()
+        self.phArr.Release()
+
+    @property
+    def am(self):
+        return self.amArr.Get(self.memType)
+
+    @am.setter
+    def am(self, am):
+        self.amArr.Set(am, self.memType)
+
+    @property
+    def ph(self):
+        return self.phArr.Get(self.memType)
+
+    @ph.setter
+    def ph(self, ph):
+        self.phArr.Set(ph, self.memType)
 
     # def FillMatrix(self, amMat, phMat):
     #     self.am = amMat
@@ -33,15 +138,25 @@ class ComplexAmPhMatrix:
 
 #-------------------------------------------------------------------
 
-def ConjugateAmPhMatrix(ap):
+# new matrix for results of kernels (arrays are not zeroed, they are overwritten)
+def AllocAmPhMatrix(height, width, memType=ComplexAmPhMatrix.mem['GPU']):
+    ap = ComplexAmPhMatrix(height, width, memType)
+    ap.amArr.GetForWrite(memType)
+    ap.phArr.GetForWrite(memType)
+    return ap
+
+#-------------------------------------------------------------------
+
+# out can be ap (conjugation in place)
+def ConjugateAmPhMatrix(ap, out=None):
     blockDim, gridDim = ccfg.DetermineCudaConfig(ap.am.shape[0])
-    apConj = ComplexAmPhMatrix(ap.am.shape[0], ap.am.shape[1], ComplexAmPhMatrix.mem['GPU'])
+    apConj = AllocAmPhMatrix(ap.am.shape[0], ap.am.shape[1]) if out is None else out
     ConjugateAmPhMatrix_dev[gridDim, blockDim](ap.am, ap.ph, apConj.am, apConj.ph)
     return apConj
 
 #-------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], float32[:, :], float32[:, :], float32[:, :])')
+@backend.jit('void(float32[:, :], float32[:, :], float32[:, :], float32[:, :])')
 def ConjugateAmPhMatrix_dev(am, ph, amConj, phConj):
     x, y = cuda.grid(2)
     if x >= am.shape[0] or y >= am.shape[1]:
@@ -49,17 +164,23 @@ def ConjugateAmPhMatrix_dev(am, ph, amConj, phConj):
     amConj[x, y] = am[x, y]
     phConj[x, y] = -ph[x, y]
 
+@ConjugateAmPhMatrix_dev.numpy
+def ConjugateAmPhMatrix_cpu(am, ph, amConj, phConj):
+    np.copyto(amConj, am)
+    np.negative(ph, out=phConj)
+
 # -------------------------------------------------------------------
 
-def MultAmPhMatrices(ap1, ap2):
+# out can be ap1 or ap2 (ap1 *= ap2 is MultAmPhMatrices(ap1, ap2, out=ap1))
+def MultAmPhMatrices(ap1, ap2, out=None):
     blockDim, gridDim = ccfg.DetermineCudaConfig(ap1.am.shape[0])
-    apRes = ComplexAmPhMatrix(ap1.am.shape[0], ap1.am.shape[1], ComplexAmPhMatrix.mem['GPU'])
+    apRes = AllocAmPhMatrix(ap1.am.shape[0], ap1.am.shape[1]) if out is None else out
     MultAmPhMatrices_dev[gridDim, blockDim](ap1.am, ap1.ph, ap2.am, ap2.ph, apRes.am, apRes.ph)
     return apRes
 
 # -------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], float32[:, :], float32[:, :], float32[:, :], float32[:, :], float32[:, :])')
+@backend.jit('void(float32[:, :], float32[:, :], float32[:, :], float32[:, :], float32[:, :], float32[:, :])')
 def MultAmPhMatrices_dev(am1, ph1, am2, ph2, amRes, phRes):
     x, y = cuda.grid(2)
     if x >= am1.shape[0] or y >= am1.shape[1]:
@@ -67,37 +188,114 @@ def MultAmPhMatrices_dev(am1, ph1, am2, ph2, amRes, phRes):
     amRes[x, y] = am1[x, y] * am2[x, y]
     phRes[x, y] = ph1[x, y] + ph2[x, y]
 
+@MultAmPhMatrices_dev.numpy
+def MultAmPhMatrices_cpu(am1, ph1, am2, ph2, amRes, phRes):
+    np.multiply(am1, am2, out=amRes)
+    np.add(ph1, ph2, out=phRes)
+
 #-------------------------------------------------------------------
 
 class Image:
+    '''Complex image stored as real and imaginary part (reIm) and/or as amplitude and phase (amPh).
+    cmpRepr and memType say which representation and which memory is currently used. Conversions
+    between representations and transfers between memories are done only when data is accessed
+    and it is not up to date (ReIm2AmPh(), MoveToGPU() etc. only change the flags).
+    Accessed representation is brought up to date first. Accessing current representation invalidates
+    the other one (array can be modified by the caller) and arrays of invalid representation are dropped.
+    Arrays are allocated when they are needed and Compact() drops what can be recalculated.
+    Amplitude-only image (ampOnly=True, e.g. measured data) has zero phase, which is not stored.
+    Its reIm is calculated from amplitude when it is needed and it does not invalidate amplitude,
+    so it must not be modified (setting reIm turns amplitude-only mode off).'''
+    __slots__ = ('width', 'height', 'size', 'reImArr', 'amPhMat', 'reImValid', 'amPhValid', 'cmpRepr', 'memType',
+                 'defocus', 'numInSeries', 'prev', 'next', 'shift', 'pxWidth', 'ampOnly')
     cmp = {'CRI': 0, 'CAP': 1}
     capVar = {'AM': 0, 'PH': 1}
     criVar = {'RE': 0, 'IM': 1}
     mem = {'CPU': 0, 'GPU': 1}
-    pxWidth = const.pxWidth
 
-    def __init__(self, height, width, cmpRepr=cmp['CAP'], memType=mem['CPU'], defocus=0.0, num=1):
+    def __init__(self, height, width, cmpRepr=cmp['CAP'], memType=mem['CPU'], defocus=0.0, num=1, ampOnly=False):
         self.width = width
         self.height = height
         self.size = width * height
-        if memType == self.mem['CPU']:
-            # self.reIm = np.empty((height, width), dtype=np.complex64)
-            self.reIm = np.zeros((height, width), dtype=np.complex64)
-        elif memType == self.mem['GPU']:
-            # self.reIm = cuda.device_array((height, width), dtype=np.complex64)
-            self.reIm = cuda.to_device(np.zeros((height, width), dtype=np.complex64))
-        self.amPh = ComplexAmPhMatrix(height, width, memType)
+        # both representations are up to date (zeros, nothing is allocated yet)
+        self.reImArr = DualArray((height, width), np.complex64)
+        self.amPhMat = ComplexAmPhMatrix(height, width, memType)
+        self.reImValid = True
+        self.amPhValid = True
         self.cmpRepr = cmpRepr
         self.memType = memType
         self.defocus = defocus
         self.numInSeries = num
         self.prev = None
         self.next = None
-        # ClearImageData(self)
+        self.shift = [0, 0]
+        self.pxWidth = const.pxWidth
+        self.ampOnly = ampOnly
 
     def __del__(self):
-        del self.reIm
-        del self.amPh
+        del self.reImArr
+        del self.amPhMat
+
+    @property
+    def reIm(self):
+        self.UpdateReIm()
+        if self.cmpRepr == self.cmp['CRI'] and not self.ampOnly:
+            self.InvalidateAmPh()
+        return self.reImArr.Get(self.memType)
+
+    @reIm.setter
+    def reIm(self, reIm):
+        self.reImArr.Set(reIm, self.memType)
+        self.reImValid = self.cmpRepr == self.cmp['CRI']
+        if self.reImValid:
+            self.ampOnly = False
+            self.InvalidateAmPh()
+
+    @property
+    def amPh(self):
+        self.UpdateAmPh()
+        if self.cmpRepr == self.cmp['CAP']:
+            self.InvalidateReIm()
+        self.amPhMat.memType = self.memType
+        return self.amPhMat
+
+    @amPh.setter
+    def amPh(self, amPh):
+        if amPh is not self.amPhMat:
+            self.InvalidateAmPh()
+            self.amPhMat = amPh
+        self.amPhValid = self.cmpRepr == self.cmp['CAP']
+        if self.amPhValid:
+            self.ampOnly = self.ampOnly and not amPh.phArr.IsAllocated()
+            self.InvalidateReIm()
+
+    # reIm which will be overwritten by the caller (it is not converted, transferred or zeroed)
+    def GetReImForWrite(self):
+        self.cmpRepr = self.cmp['CRI']
+        self.reImValid = True
+        self.ampOnly = False
+        self.InvalidateAmPh()
+        return self.reImArr.GetForWrite(self.memType)
+
+    def InvalidateReIm(self):
+        self.reImValid = False
+        self.reImArr.Release()
+
+    def InvalidateAmPh(self):
+        self.amPhValid = False
+        self.amPhMat.Drop()
+
+    # keeps only current representation (and amplitude of amplitude-only image) in current memory
+    def Compact(self):
+        if self.ampOnly or self.cmpRepr == self.cmp['CAP']:
+            self.UpdateAmPh()
+            self.InvalidateReIm()
+        else:
+            self.UpdateReIm()
+            self.InvalidateAmPh()
+        self.reImArr.Compact(self.memType)
+        self.amPhMat.amArr.Compact(self.memType)
+        self.amPhMat.phArr.Compact(self.memType)
 
     def ChangeMemoryType(self, newType):
         if newType == self.mem['CPU']:
@@ -105,20 +303,11 @@ class Image:
         elif newType == self.mem['GPU']:
             self.MoveToGPU()
 
+    # arrays are transferred when they are accessed
     def MoveToGPU(self):
-        if self.memType == self.mem['GPU']:
-            return
-        self.reIm = cuda.to_device(self.reIm)
-        self.amPh.am = cuda.to_device(self.amPh.am)
-        self.amPh.ph = cuda.to_device(self.amPh.ph)
         self.memType = self.mem['GPU']
 
     def MoveToCPU(self):
-        if self.memType == self.mem['CPU']:
-            return
-        self.reIm = self.reIm.copy_to_host()
-        self.amPh.am = self.amPh.am.copy_to_host()
-        self.amPh.ph = self.amPh.ph.copy_to_host()
         self.memType = self.mem['CPU']
 
     def ChangeComplexRepr(self, newRepr):
@@ -127,69 +316,103 @@ class Image:
         elif newRepr == self.cmp['CRI']:
             self.AmPh2ReIm()
 
+    # amplitude and phase are calculated when they are accessed
     def ReIm2AmPh(self):
-        if self.cmpRepr == self.cmp['CAP']:
-            return
-        mt = self.memType
-        self.MoveToGPU()
-        blockDim, gridDim = ccfg.DetermineCudaConfigNew((self.height, self.width))
-        ReIm2AmPh_dev[gridDim, blockDim](self.reIm, self.amPh.am, self.amPh.ph)
         self.cmpRepr = self.cmp['CAP']
-        if mt == self.mem['CPU']:
-            self.MoveToCPU()
 
     def AmPh2ReIm(self):
-        if self.cmpRepr == self.cmp['CRI']:
-            return
-        mt = self.memType
-        self.MoveToGPU()
-        blockDim, gridDim = ccfg.DetermineCudaConfigNew((self.height, self.width))
-        AmPh2ReIm_dev[gridDim, blockDim](self.amPh.am, self.amPh.ph, self.reIm)
         self.cmpRepr = self.cmp['CRI']
-        if mt == self.mem['CPU']:
-            self.MoveToCPU()
+
+    def UpdateAmPh(self):
+        if self.amPhValid:
+            return
+        if not self.reImArr.IsAllocated():
+            self.amPhMat.Drop()
+        else:
+            reIm = self.reImArr.Get(self.memType, modify=False)
+            am = self.amPhMat.amArr.GetForWrite(self.memType)
+            ph = self.amPhMat.phArr.GetForWrite(self.memType)
+            RunKernel(ReIm2AmPh_dev, self.memType, reIm.shape, reIm, am, ph)
+        self.amPhValid = True
+
+    def UpdateReIm(self):
+        if self.reImValid:
+            return
+        amArr, phArr = self.amPhMat.amArr, self.amPhMat.phArr
+        if not amArr.IsAllocated():
+            self.reImArr.Release()
+        elif not phArr.IsAllocated():
+            # phase is zero (amplitude-only data)
+            am = amArr.Get(self.memType, modify=False)
+            reIm = self.reImArr.GetForWrite(self.memType)
+            RunKernel(Am2ReIm_dev, self.memType, am.shape, am, reIm)
+        else:
+            am = amArr.Get(self.memType, modify=False)
+            ph = phArr.Get(self.memType, modify=False)
+            reIm = self.reImArr.GetForWrite(self.memType)
+            RunKernel(AmPh2ReIm_dev, self.memType, am.shape, am, ph, reIm)
+        self.reImValid = True
 
 # -------------------------------------------------------------------
 
 class ImageWithBuffer(Image):
-    def __init__(self, height, width, cmpRepr=Image.cmp['CAP'], memType=Image.mem['CPU'], defocus=0.0, num=1):
-        super(ImageWithBuffer, self).__init__(height, width, cmpRepr, memType, defocus, num)
+    '''Image with amplitude buffer (e.g. for display).
+    Buffer of amplitude-only image is not copied by UpdateBuffer(): it follows the amplitude
+    and the copy is made when buffer is accessed or amplitude is going to be dropped.'''
+    __slots__ = ('parent', 'rot', 'bufferArr', 'bufferFromAm')
+
+    def __init__(self, height, width, cmpRepr=Image.cmp['CAP'], memType=Image.mem['CPU'], defocus=0.0, num=1,
+                 ampOnly=False):
+        super(ImageWithBuffer, self).__init__(height, width, cmpRepr, memType, defocus, num, ampOnly)
         self.parent = super(ImageWithBuffer, self)
-        self.shift = [0, 0]
         self.rot = 0
-        if self.memType == self.mem['CPU']:
-            self.buffer = np.zeros(self.amPh.am.shape, dtype=np.float32)
-        else:
-            self.buffer = cuda.to_device(np.zeros(self.amPh.am.shape, dtype=np.float32))
+        self.bufferArr = DualArray((height, width), np.float32)
+        self.bufferFromAm = False
+
+    @property
+    def buffer(self):
+        if self.bufferFromAm:
+            self.CopyAmToBuffer()
+        return self.bufferArr.Get(self.memType)
+
+    @buffer.setter
+    def buffer(self, buffer):
+        self.bufferFromAm = False
+        self.bufferArr.Set(buffer, self.memType)
 
     def LoadAmpData(self, ampData):
         self.amPh.am = np.copy(ampData)
-        self.buffer = np.copy(ampData)
+        self.UpdateBuffer()
 
     def UpdateBuffer(self):
-        if self.memType == self.mem['CPU']:
-            self.buffer = np.copy(self.amPh.am)
+        if self.ampOnly:
+            self.bufferArr.Release()
+            self.bufferFromAm = True
         else:
-            self.buffer.copy_to_device(self.amPh.am)
+            self.CopyAmToBuffer()
 
-    def UpdateImageFromBuffer(self):
+    def CopyAmToBuffer(self):
+        # amplitude is only read here, so it does not invalidate reIm
+        self.bufferFromAm = False
+        if self.cmpRepr == self.cmp['CAP']:
+            self.UpdateAmPh()
+        am = self.amPhMat.amArr.Get(self.memType, modify=False)
         if self.memType == self.mem['CPU']:
-            self.amPh.am = np.copy(self.buffer)
+            self.bufferArr.Set(np.copy(am), self.memType)
         else:
-            self.amPh.am = cuda.device_array(self.buffer.shape, dtype=np.float32)
-            self.amPh.am.copy_to_device(self.buffer)
+            backend.CopyInto(self.bufferArr.GetForWrite(self.memType), am)
 
-    def MoveToGPU(self):
-        if self.memType == self.mem['GPU']:
-            return
-        super(ImageWithBuffer, self).MoveToGPU()
-        self.buffer = cuda.to_device(self.buffer)
+    def InvalidateAmPh(self):
+        if self.bufferFromAm:
+            self.CopyAmToBuffer()
+        super(ImageWithBuffer, self).InvalidateAmPh()
 
-    def MoveToCPU(self):
+    def UpdateImageFromBuffer(self):
         if self.memType == self.mem['CPU']:
-            return
-        super(ImageWithBuffer, self).MoveToCPU()
-        self.buffer = self.buffer.copy_to_host()
+            self.amPh.am = np.copy(self.buffer)
+        else:
+            self.amPh.am = AllocArray(self.buffer.shape, np.float32, self.memType, zero=False)
+            backend.CopyInto(self.amPh.am, self.buffer)
 
     def ReIm2AmPh(self):
         if self.cmpRepr == self.cmp['CAP']:
@@ -212,7 +435,248 @@ class ImageList(list):
 
 #-------------------------------------------------------------------
 
-@cuda.jit('void(complex64[:, :], float32[:, :], float32[:, :])')
+class ImageStack:
+    '''Series of equal-sized images stored in one array for each representation (N x H x W),
+    in host or device memory. Representations and memory are handled in the same way as in Image
+    (the stack is kept as one Image of size N*H x W), so batch operations need one kernel launch
+    and one transfer for the whole series. Defocus and numInSeries of images are kept in arrays.
+    stack[idx] is an Image whose current representation is a view of the stack arrays in current memory
+    (it is valid until representation or memory of the stack changes).'''
+
+    def __init__(self, nImages, height, width, cmpRepr=Image.cmp['CAP'], memType=Image.mem['CPU'], ampOnly=False):
+        self.nImages = nImages
+        self.height = height
+        self.width = width
+        self.shape = (nImages, height, width)
+        self.data = Image(nImages * height, width, cmpRepr, memType, ampOnly=ampOnly)
+        self.defocus = np.zeros(nImages, dtype=np.float64)
+        self.numInSeries = np.arange(1, nImages + 1)
+        self.pxWidth = const.pxWidth
+
+    def __len__(self):
+        return self.nImages
+
+    def __iter__(self):
+        for idx in range(self.nImages):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        img = Image(self.height, self.width, self.cmpRepr, self.memType, float(self.defocus[idx]),
+                    int(self.numInSeries[idx]), self.data.ampOnly)
+        img.pxWidth = self.pxWidth
+        if self.cmpRepr == Image.cmp['CRI']:
+            img.reIm = self.reIm[idx]
+            img.ampOnly = self.data.ampOnly
+        else:
+            img.amPh.am = self.am[idx]
+            if self.data.amPhMat.phArr.IsAllocated():
+                img.amPh.ph = self.ph[idx]
+        return img
+
+    @property
+    def cmpRepr(self):
+        return self.data.cmpRepr
+
+    @property
+    def memType(self):
+        return self.data.memType
+
+    @property
+    def reIm(self):
+        return self.data.reIm.reshape(self.shape)
+
+    @property
+    def am(self):
+        return self.data.amPh.am.reshape(self.shape)
+
+    @property
+    def ph(self):
+        return self.data.amPh.ph.reshape(self.shape)
+
+    def ChangeMemoryType(self, newType):
+        self.data.ChangeMemoryType(newType)
+
+    def MoveToGPU(self):
+        self.data.MoveToGPU()
+
+    def MoveToCPU(self):
+        self.data.MoveToCPU()
+
+    def ChangeComplexRepr(self, newRepr):
+        self.data.ChangeComplexRepr(newRepr)
+
+    def ReIm2AmPh(self):
+        self.data.ReIm2AmPh()
+
+    def AmPh2ReIm(self):
+        self.data.AmPh2ReIm()
+
+    def Compact(self):
+        self.data.Compact()
+
+    def ToImageList(self):
+        imgList = ImageList([ self[idx] for idx in range(self.nImages) ])
+        for img, num in zip(imgList, self.numInSeries):
+            img.numInSeries = int(num)
+        return imgList
+
+    # stack of Fourier transforms of all images (one batched transform)
+    def FFT(self):
+        return self.TransformAll(ffteng.FFT2)
+
+    def IFFT(self):
+        return self.TransformAll(ffteng.IFFT2)
+
+    def TransformAll(self, transform):
+        mt = self.memType
+        dt = self.cmpRepr
+        self.MoveToGPU()
+        self.AmPh2ReIm()
+        stackTr = ImageStack(self.nImages, self.height, self.width, Image.cmp['CRI'], Image.mem['GPU'])
+        transform(self.reIm, stackTr.data.GetReImForWrite().reshape(self.shape))
+        stackTr.defocus[:] = self.defocus
+        stackTr.numInSeries[:] = self.numInSeries
+        stackTr.pxWidth = self.pxWidth
+        self.ChangeComplexRepr(dt)
+        self.ChangeMemoryType(mt)
+        return stackTr
+
+    # images resampled to dim x dim pixels by cropping (or zero-padding) their spectra;
+    # returned stack is in CRI (amplitude-only images are treated as complex images with zero phase)
+    def FourierResample(self, dim):
+        stackFFT = self.FFT()
+        stackRes = ImageStack(self.nImages, dim, dim, Image.cmp['CRI'], Image.mem['GPU'])
+        resReIm = stackRes.data.GetReImForWrite().reshape(stackRes.shape)
+        # inverse transform is not normalized
+        ResampleSpectra(stackFFT.reIm, resReIm, 1.0 / (self.height * self.width))
+        ffteng.IFFT2(resReIm, resReIm)
+        stackRes.defocus[:] = self.defocus
+        stackRes.numInSeries[:] = self.numInSeries
+        stackRes.pxWidth = self.pxWidth * self.width / dim
+        return stackRes
+
+    # multiplies all images (amplitudes in CAP, complex values in CRI) by scalar in one kernel launch
+    def MultByScalar(self, scalar):
+        if self.cmpRepr == Image.cmp['CRI']:
+            arrsup.ScaleArray(self.data.reIm, scalar)
+        else:
+            arrsup.ScaleArray(self.data.amPh.am, scalar)
+
+    # statistics of amplitude of every image (calculated on host after one transfer)
+    def GetAmpStats(self):
+        self.data.UpdateAmPh()
+        am = backend.ToHost(self.data.amPhMat.amArr.Get(self.memType, modify=False)).reshape(self.shape)
+        return {'min': am.min(axis=(1, 2)), 'max': am.max(axis=(1, 2)),
+                'mean': am.mean(axis=(1, 2)), 'std': am.std(axis=(1, 2))}
+
+    # the same as ScaleAmpImages(): amplitude of every image is scaled to the common range of all images
+    def ScaleAmp(self):
+        stats = self.GetAmpStats()
+        amMin, amMax = stats['min'].min(), stats['max'].max()
+        currMin = stats['min'][:, np.newaxis, np.newaxis]
+        currMax = stats['max'][:, np.newaxis, np.newaxis]
+        mt = self.memType
+        self.MoveToCPU()
+        am = self.am
+        am -= currMin
+        am *= (amMax - amMin) / (currMax - currMin)
+        am += amMin
+        self.ChangeMemoryType(mt)
+
+    @staticmethod
+    def FromImageList(images):
+        img0 = images[0]
+        ampOnly = all(img.ampOnly for img in images)
+        pxWidth = GetCommonPxWidth([ img.pxWidth for img in images ])
+        stack = ImageStack(len(images), img0.height, img0.width, Image.cmp['CAP'], Image.mem['CPU'], ampOnly)
+        stack.pxWidth = pxWidth
+        am = stack.am
+        ph = None if ampOnly else stack.ph
+        for idx, img in enumerate(images):
+            mt = img.memType
+            dt = img.cmpRepr
+            img.ReIm2AmPh()
+            img.MoveToCPU()
+            am[idx] = img.amPh.am
+            if ph is not None:
+                ph[idx] = img.amPh.ph
+            img.ChangeComplexRepr(dt)
+            img.ChangeMemoryType(mt)
+            stack.defocus[idx] = img.defocus
+            stack.numInSeries[idx] = img.numInSeries
+        return stack
+
+#-------------------------------------------------------------------
+
+# stack (and transfer functions of IWFR) has one pixel width, so images of series with mixed calibrations
+# cannot be put together
+def GetCommonPxWidth(pxWidths):
+    pxWidths = np.asarray(pxWidths, dtype=np.float64)
+    if not np.allclose(pxWidths, pxWidths[0], rtol=1e-6, atol=0.0):
+        raise ValueError('Images have different pixel widths ({0:.6g} - {1:.6g} m)'.format(pxWidths.min(), pxWidths.max()))
+    return float(pxWidths[0])
+
+#-------------------------------------------------------------------
+
+# spectra (in FFT order, N x H x W) are copied (and multiplied by scale) to spectra of other size;
+# frequencies which do not exist in source spectra are set to zero
+def ResampleSpectra(spectra, spectraRes, scale=1.0):
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(spectraRes.shape[1:])
+    ResampleSpectra_dev[gridDim, blockDim](spectra, spectraRes, scale)
+
+#-------------------------------------------------------------------
+
+# frequencies are found in FFT order (as in np.fft.fftfreq()):
+# index i of spectrum of size n is frequency i (i < n - n // 2) or i - n
+@backend.jit('void(complex64[:, :, :], complex64[:, :, :], float32)')
+def ResampleSpectra_dev(spectra, spectraRes, scale):
+    x, y = cuda.grid(2)
+    height, width = spectra.shape[1], spectra.shape[2]
+    resHeight, resWidth = spectraRes.shape[1], spectraRes.shape[2]
+    if x >= resHeight or y >= resWidth:
+        return
+    freqX = x
+    if x >= resHeight - resHeight // 2:
+        freqX = x - resHeight
+    freqY = y
+    if y >= resWidth - resWidth // 2:
+        freqY = y - resWidth
+    inside = -(height // 2) <= freqX < height - height // 2 and -(width // 2) <= freqY < width - width // 2
+    srcX = freqX if freqX >= 0 else freqX + height
+    srcY = freqY if freqY >= 0 else freqY + width
+    for k in range(spectraRes.shape[0]):
+        if inside:
+            spectraRes[k, x, y] = spectra[k, srcX, srcY] * scale
+        else:
+            spectraRes[k, x, y] = 0
+
+@ResampleSpectra_dev.numba
+def ResampleSpectra_cpu(spectra, spectraRes, scale):
+    height, width = spectra.shape[1], spectra.shape[2]
+    resHeight, resWidth = spectraRes.shape[1], spectraRes.shape[2]
+    # source row / column for every row / column of resampled spectra (-1 if frequency does not exist)
+    srcRows = np.full(resHeight, -1, np.int64)
+    for x in range(resHeight):
+        freq = x if x < resHeight - resHeight // 2 else x - resHeight
+        if -(height // 2) <= freq < height - height // 2:
+            srcRows[x] = freq if freq >= 0 else freq + height
+    srcCols = np.full(resWidth, -1, np.int64)
+    for y in range(resWidth):
+        freq = y if y < resWidth - resWidth // 2 else y - resWidth
+        if -(width // 2) <= freq < width - width // 2:
+            srcCols[y] = freq if freq >= 0 else freq + width
+
+    for x in numba.prange(resHeight):
+        for y in range(resWidth):
+            for k in range(spectraRes.shape[0]):
+                if srcRows[x] >= 0 and srcCols[y] >= 0:
+                    spectraRes[k, x, y] = spectra[k, srcRows[x], srcCols[y]] * scale
+                else:
+                    spectraRes[k, x, y] = 0
+
+#-------------------------------------------------------------------
+
+@backend.jit('void(complex64[:, :], float32[:, :], float32[:, :])')
 def ReIm2AmPh_dev(reIm, am, ph):
     x, y = cuda.grid(2)
     if x >= reIm.shape[0] or y >= reIm.shape[1]:
@@ -221,9 +685,28 @@ def ReIm2AmPh_dev(reIm, am, ph):
     # ph[x, y] = cm.phase(reIm[x, y])
     am[x, y], ph[x, y] = cmath.polar(reIm[x, y])
 
+@ReIm2AmPh_dev.numba
+def ReIm2AmPh_cpu(reIm, am, ph):
+    for x in numba.prange(reIm.shape[0]):
+        for y in range(reIm.shape[1]):
+            am[x, y], ph[x, y] = cmath.polar(reIm[x, y])
+
 #-------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], float32[:, :], complex64[:, :])')
+@backend.jit('void(float32[:, :], complex64[:, :])')
+def Am2ReIm_dev(am, reIm):
+    x, y = cuda.grid(2)
+    if x >= am.shape[0] or y >= am.shape[1]:
+        return
+    reIm[x, y] = complex(am[x, y], 0.0)
+
+@Am2ReIm_dev.numpy
+def Am2ReIm_cpu(am, reIm):
+    np.copyto(reIm, am)
+
+#-------------------------------------------------------------------
+
+@backend.jit('void(float32[:, :], float32[:, :], complex64[:, :])')
 def AmPh2ReIm_dev(am, ph, reIm):
     x, y = cuda.grid(2)
     if x >= am.shape[0] or y >= am.shape[1]:
@@ -231,6 +714,12 @@ def AmPh2ReIm_dev(am, ph, reIm):
     # reIm[x, y] = am[x, y] * cm.cos(ph[x, y]) + 1j * am[x, y] * cm.sin(ph[x, y])
     reIm[x, y] = cmath.rect(am[x, y], ph[x, y])
 
+@AmPh2ReIm_dev.numba
+def AmPh2ReIm_cpu(am, ph, reIm):
+    for x in numba.prange(am.shape[0]):
+        for y in range(am.shape[1]):
+            reIm[x, y] = cmath.rect(am[x, y], ph[x, y])
+
 #-------------------------------------------------------------------
 
 def PrepareImageMatrix(imgData, dimSize):
@@ -241,12 +730,13 @@ def PrepareImageMatrix(imgData, dimSize):
 
 #-------------------------------------------------------------------
 
-def FileToImage(fPath):
-    import Dm3Reader3 as dm3
-    imgData = dm3.ReadDm3File(fPath)
-    imgMatrix = PrepareImageMatrix(imgData, const.dimSize)
-    img = ImageWithBuffer(const.dimSize, const.dimSize, Image.cmp['CAP'], Image.mem['CPU'])
-    img.amPh.am = np.sqrt(imgMatrix).astype(np.float32)
+def FileToImage(fPath, frameIdx=0):
+    import Dm3Index as dm3idx
+    imgHeight, imgWidth = dm3idx.GetImageInfo(fPath)['shape'][-2:]
+    ampData = np.empty((imgHeight, imgWidth), dtype=np.float32)
+    dm3idx.ReadFrameInto(fPath, frameIdx, ampData)
+    img = ImageWithBuffer(imgHeight, imgWidth, Image.cmp['CAP'], Image.mem['CPU'], ampOnly=True)
+    img.amPh.am = np.sqrt(np.abs(ampData, out=ampData), out=ampData)
     img.UpdateBuffer()
     return img
 
@@ -268,8 +758,8 @@ def ScaleAmpImages(images):
     # amMin = np.max(images[0].amPh.am)
 
     for img in images:
-        amMaxCurr = cc.FindMaxInImage(img)
-        amMinCurr = cc.FindMinInImage(img)
+        img.ReIm2AmPh()
+        amMaxCurr, _, amMinCurr, _ = arrsup.FindExtrema(img.amPh.am)
         # amMaxCurr = np.max(img.amPh.am)
         # amMinCurr = np.min(img.amPh.am)
         if amMaxCurr >= amMax:
@@ -356,7 +846,7 @@ def CropImageROICoords(img, coords):
     dt = img.cmpRepr
     img.AmPh2ReIm()
     roi = Image(roiHeight, roiWidth, img.cmpRepr, Image.mem['GPU'])
-    topLeft_d = cuda.to_device(np.array(coords[:2], dtype=np.int32))
+    topLeft_d = backend.ToDevice(np.array(coords[:2], dtype=np.int32))
     blockDim, gridDim = ccfg.DetermineCudaConfigNew((roiHeight, roiWidth))
     CropImageROICoords_dev[gridDim, blockDim](img.reIm, roi.reIm, topLeft_d)
     img.ChangeComplexRepr(dt)
@@ -367,7 +857,7 @@ def CropImageROICoords(img, coords):
 
 # -------------------------------------------------------------------
 
-@cuda.jit('void(complex64[:, :], complex64[:, :], int32[:])')
+@backend.jit('void(complex64[:, :], complex64[:, :], int32[:])')
 def CropImageROICoords_dev(img, roi, topLeft):
     rx, ry = cuda.grid(2)
     if rx >= roi.shape[0] or ry >= roi.shape[1]:
@@ -383,6 +873,15 @@ def CropImageROICoords_dev(img, roi, topLeft):
 
     roi[rx, ry] = img[x, y]
 
+@CropImageROICoords_dev.numba
+def CropImageROICoords_cpu(img, roi, topLeft):
+    x0, y0 = topLeft[0], topLeft[1]
+    for ry in numba.prange(roi.shape[1]):
+        for rx in range(roi.shape[0]):
+            roiIdx = ry * roi.shape[0] + rx
+            imgIdx = roiIdx + ry * (img.shape[0] - roi.shape[0]) + img.shape[0] * y0 + x0
+            roi[rx, ry] = img[imgIdx % img.shape[0], imgIdx // img.shape[0]]
+
 
 # -------------------------------------------------------------------
 
@@ -390,7 +889,7 @@ def CropImageROI(img, roiOrig, roiDims, isOrigTopLeft):
     dt = img.cmpRepr
     img.AmPh2ReIm()
     roi = Image(roiDims[0], roiDims[1], img.cmpRepr, Image.mem['GPU'])
-    roiOrig_d = cuda.to_device(np.array(roiOrig))
+    roiOrig_d = backend.ToDevice(np.array(roiOrig, dtype=np.int32))
     blockDim, gridDim = ccfg.DetermineCudaConfigNew(roiDims)
     if isOrigTopLeft:
         CropImageROITopLeft_dev[gridDim, blockDim](img.reIm, roi.reIm, roiOrig_d)
@@ -403,7 +902,26 @@ def CropImageROI(img, roiOrig, roiDims, isOrigTopLeft):
 
 # -------------------------------------------------------------------
 
-@cuda.jit('void(complex64[:, :], complex64[:, :], int32[:])')
+# fragments (with top-left corners in roiOrigs) are cropped to one stack
+def CropImageROIsToStack(img, roiOrigs, roiDims):
+    dt = img.cmpRepr
+    img.AmPh2ReIm()
+    stack = ImageStack(len(roiOrigs), roiDims[0], roiDims[1], Image.cmp['CRI'], Image.mem['GPU'])
+    rois = stack.data.GetReImForWrite().reshape(stack.shape)
+    imgReIm = img.reIm
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(roiDims)
+    for idx, roiOrig in enumerate(roiOrigs):
+        roiOrig_d = backend.ToDevice(np.array(roiOrig, dtype=np.int32))
+        CropImageROITopLeft_dev[gridDim, blockDim](imgReIm, rois[idx], roiOrig_d)
+    img.ChangeComplexRepr(dt)
+    stack.ChangeComplexRepr(dt)
+    stack.defocus[:] = img.defocus
+    stack.pxWidth = img.pxWidth
+    return stack
+
+# -------------------------------------------------------------------
+
+@backend.jit('void(complex64[:, :], complex64[:, :], int32[:])')
 def CropImageROITopLeft_dev(img, roi, rStart):
     rx, ry = cuda.grid(2)
     if rx >= roi.shape[0] or ry >= roi.shape[1]:
@@ -418,9 +936,18 @@ def CropImageROITopLeft_dev(img, roi, rStart):
 
     roi[rx, ry] = img[x, y]
 
+@CropImageROITopLeft_dev.numba
+def CropImageROITopLeft_cpu(img, roi, rStart):
+    x0, y0 = rStart[0], rStart[1]
+    for ry in numba.prange(roi.shape[1]):
+        for rx in range(roi.shape[0]):
+            roiIdx = ry * roi.shape[0] + rx
+            imgIdx = roiIdx + ry * (img.shape[0] - roi.shape[0]) + img.shape[0] * y0 + x0
+            roi[rx, ry] = img[imgIdx % img.shape[0], imgIdx // img.shape[0]]
+
 # -------------------------------------------------------------------
 
-@cuda.jit('void(complex64[:, :], complex64[:, :], int32[:])')
+@backend.jit('void(complex64[:, :], complex64[:, :], int32[:])')
 def CropImageROIMid_dev(img, roi, rMid):
     rx, ry = cuda.grid(2)
     if rx >= roi.shape[0] or ry >= roi.shape[1]:
@@ -446,6 +973,26 @@ def CropImageROIMid_dev(img, roi, rMid):
 
     roi[rx, ry] = img[x, y]
 
+@CropImageROIMid_dev.numba
+def CropImageROIMid_cpu(img, roi, rMid):
+    for ry in numba.prange(roi.shape[1]):
+        for rx in range(roi.shape[0]):
+            x0 = rMid[0] - roi.shape[0] // 2
+            y0 = rMid[1] - roi.shape[1] // 2
+
+            if x0 + rx < 0:
+                x0 += img.shape[0]
+            elif x0 + rx >= img.shape[0]:
+                x0 -= img.shape[0]
+            if y0 + ry < 0:
+                y0 += img.shape[1]
+            elif y0 + ry >= img.shape[1]:
+                y0 -= img.shape[1]
+
+            roiIdx = ry * roi.shape[0] + rx
+            imgIdx = roiIdx + ry * (img.shape[0] - roi.shape[0]) + img.shape[0] * y0 + x0
+            roi[rx, ry] = img[imgIdx % img.shape[0], imgIdx // img.shape[0]]
+
 # -------------------------------------------------------------------
 
 def PasteROIToImage(img, roi, roiOrig):
@@ -453,7 +1000,7 @@ def PasteROIToImage(img, roi, roiOrig):
     img.AmPh2ReIm()
     imgNew = Image(img.height, img.width, Image.cmp['CRI'], Image.mem['GPU'])
     imgNew.reIm = img.reIm
-    roiOrig_d = cuda.to_device(np.array(roiOrig))
+    roiOrig_d = backend.ToDevice(np.array(roiOrig, dtype=np.int32))
     blockDim, gridDim = ccfg.DetermineCudaConfigNew(roi.reIm.shape)
     PasteROIToImage_dev[gridDim, blockDim](imgNew.reIm, roi.reIm, roiOrig_d)
     img.ChangeComplexRepr(dt)
@@ -470,7 +1017,7 @@ def PasteROIToImageTopLeft(img, roi, roiTopLeft, spot=False):
     roi.AmPh2ReIm()
 
     roiOrig = np.array(roiTopLeft) + np.array(roi.reIm.shape) // 2      # !!!
-    roiOrig_d = cuda.to_device(roiOrig)
+    roiOrig_d = backend.ToDevice(roiOrig.astype(np.int32))
     blockDim, gridDim = ccfg.DetermineCudaConfigNew(roi.reIm.shape)
     if not spot:
         PasteROIToImage_dev[gridDim, blockDim](imgNew.reIm, roi.reIm, roiOrig_d)
@@ -482,7 +1029,7 @@ def PasteROIToImageTopLeft(img, roi, roiTopLeft, spot=False):
 # -------------------------------------------------------------------
 
 # prawie to samo co w CropImageROIMid_dev(...)
-@cuda.jit('void(complex64[:, :], complex64[:, :], int32[:])')
+@backend.jit('void(complex64[:, :], complex64[:, :], int32[:])')
 def PasteROIToImage_dev(img, roi, rMid):
     rx, ry = cuda.grid(2)
     if rx >= roi.shape[0] or ry >= roi.shape[1]:
@@ -508,9 +1055,29 @@ def PasteROIToImage_dev(img, roi, rMid):
 
     img[x, y] = roi[rx, ry]
 
+@PasteROIToImage_dev.numba
+def PasteROIToImage_cpu(img, roi, rMid):
+    for ry in numba.prange(roi.shape[1]):
+        for rx in range(roi.shape[0]):
+            x0 = rMid[0] - roi.shape[0] // 2
+            y0 = rMid[1] - roi.shape[1] // 2
+
+            if x0 + rx < 0:
+                x0 += img.shape[0]
+            elif x0 + rx >= img.shape[0]:
+                x0 -= img.shape[0]
+            if y0 + ry < 0:
+                y0 += img.shape[1]
+            elif y0 + ry >= img.shape[1]:
+                y0 -= img.shape[1]
+
+            roiIdx = ry * roi.shape[0] + rx
+            imgIdx = roiIdx + ry * (img.shape[0] - roi.shape[0]) + img.shape[0] * y0 + x0
+            img[imgIdx % img.shape[0], imgIdx // img.shape[0]] = roi[rx, ry]
+
 # -------------------------------------------------------------------
 
-@cuda.jit('void(complex64[:, :], complex64[:, :], int32[:])')
+@backend.jit('void(complex64[:, :], complex64[:, :], int32[:])')
 def PasteSpotToImage_dev(img, roi, rMid):
     rx, ry = cuda.grid(2)
     if rx >= roi.shape[0] or ry >= roi.shape[1]:
@@ -531,6 +1098,20 @@ def PasteSpotToImage_dev(img, roi, rMid):
 
     img[x, y] = roi[rx, ry]
 
+@PasteSpotToImage_dev.numba
+def PasteSpotToImage_cpu(img, roi, rMid):
+    rw, rh = roi.shape
+    x0 = rMid[0] - roi.shape[0] // 2
+    y0 = rMid[1] - roi.shape[1] // 2
+    for ry in numba.prange(roi.shape[1]):
+        for rx in range(roi.shape[0]):
+            radius = math.sqrt(float((rw // 2 - rx) ** 2 + (rh // 2 - ry) ** 2))
+            if radius > roi.shape[0] // 2:
+                continue
+            roiIdx = ry * roi.shape[0] + rx
+            imgIdx = roiIdx + ry * (img.shape[0] - roi.shape[0]) + img.shape[0] * y0 + x0
+            img[imgIdx % img.shape[0], imgIdx // img.shape[0]] = roi[rx, ry]
+
 #-------------------------------------------------------------------
 
 def DetermineCropCoords(width, height, shift):
@@ -606,15 +1187,12 @@ def MakeSquareCoords(coords):
 #-------------------------------------------------------------------
 
 def ClearImageData(img):
-    shape = img.reIm.shape
-    if img.memType == Image.mem['CPU']:
-        img.reIm = np.zeros(shape, dtype=np.complex64)
-        img.amPh.am = np.zeros(shape, dtype=np.float32)
-        img.amPh.ph = np.zeros(shape, dtype=np.float32)
-    elif img.memType == Image.mem['GPU']:
-        img.reIm = cuda.to_device(np.zeros(shape, dtype=np.complex64))
-        img.amPh.am = cuda.to_device(np.zeros(shape, dtype=np.float32))
-        img.amPh.ph = cuda.to_device(np.zeros(shape, dtype=np.float32))
+    # arrays are dropped (zeros are allocated when image is accessed)
+    img.InvalidateAmPh()
+    img.reImArr = DualArray((img.height, img.width), np.complex64)
+    img.amPhMat = ComplexAmPhMatrix(img.height, img.width, img.memType)
+    img.reImValid = True
+    img.amPhValid = True
 
     # mt = img.memType
     # img.MoveToGPU()
@@ -631,7 +1209,7 @@ def CopyImage(img):
     img.MoveToGPU()
     img.AmPh2ReIm()
     imgCopy = ImageWithBuffer(img.height, img.width, img.cmpRepr, img.memType, img.defocus, img.numInSeries)
-    imgCopy.reIm.copy_to_device(img.reIm)
+    backend.CopyInto(imgCopy.reIm, img.reIm)
     # imgCopy.ReIm2AmPh()         # !!!
     # imgCopy.UpdateBuffer()      # !!!
     img.ChangeComplexRepr(dt)
@@ -753,7 +1331,7 @@ def RotateImage(img, deltaPhi):
     rotWidth = int(np.ceil(2 * rMax * np.cos(angle)))
     rotHeight = rotWidth
     imgRotated = Image(rotHeight, rotWidth, img.cmpRepr, img.memType)
-    filled = cuda.to_device(np.zeros(imgRotated.amPh.am.shape, dtype=np.int32))
+    filled = apool.Get(imgRotated.amPh.am.shape, np.int32, Image.mem['GPU'], zero=True)
 
     # rotation
 
@@ -762,6 +1340,7 @@ def RotateImage(img, deltaPhi):
     imgRotated.MoveToGPU()
     blockDim, gridDim = ccfg.DetermineCudaConfigNew(imgRotated.amPh.am.shape)
     InterpolateMissingPixels_dev[gridDim, blockDim](imgRotated.amPh.am, filled)
+    apool.Release(filled)
 
     imgRotated = CreateImageWithBufferFromImage(imgRotated)
     img.ChangeMemoryType(mt)
@@ -777,7 +1356,7 @@ def RotateImage(img, deltaPhi):
 
 #-------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], float32[:, :], int32[:, :], float32)')
+@backend.jit('void(float32[:, :], float32[:, :], int32[:, :], float32)')
 def RotateImage_dev(img, imgRot, filled, deltaPhi):
     x0, y0 = cuda.grid(2)
     if x0 >= img.shape[0] or y0 >= img.shape[1]:
@@ -791,9 +1370,20 @@ def RotateImage_dev(img, imgRot, filled, deltaPhi):
     imgRot[y1, x1] = img[y0, x0]
     filled[y1, x1] = 1
 
+# pixels of rotated image can be hit more than once, so scattering is done serially on CPU
+@RotateImage_dev.numba(parallel=False)
+def RotateImage_cpu(img, imgRot, filled, deltaPhi):
+    for x0 in range(img.shape[0]):
+        for y0 in range(img.shape[1]):
+            r0, phi0 = cmath.polar(complex(x0 - img.shape[0] / 2, y0 - img.shape[1] / 2))
+            x1 = int(r0 * math.cos(phi0 - deltaPhi) + imgRot.shape[0] / 2)
+            y1 = int(r0 * math.sin(phi0 - deltaPhi) + imgRot.shape[1] / 2)
+            imgRot[y1, x1] = img[y0, x0]
+            filled[y1, x1] = 1
+
 #-------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], int32[:, :])')
+@backend.jit('void(float32[:, :], int32[:, :])')
 def InterpolateMissingPixels_dev(img, filled):
     x, y = cuda.grid(2)
     if x >= img.shape[0] or y >= img.shape[1]:
@@ -822,6 +1412,27 @@ def InterpolateMissingPixels_dev(img, filled):
 
     img[y, x] = nHoodSum / nPixels
 
+@InterpolateMissingPixels_dev.numba
+def InterpolateMissingPixels_cpu(img, filled):
+    for y in numba.prange(img.shape[1]):
+        for x in range(img.shape[0]):
+            if filled[y, x] > 0:
+                continue
+
+            x1 = x - (x > 0)
+            y1 = y - (y > 0)
+            x2 = x + (x < img.shape[0]-1)
+            y2 = y + (y < img.shape[1]-1)
+
+            nHoodSum = 0.0
+            nPixels = 0
+            for yy in range(y1, y2):
+                for xx in range(x1, x2):
+                    nHoodSum += img[yy, xx] * filled[yy, xx]
+                    nPixels += filled[yy, xx]
+
+            img[y, x] = nHoodSum / nPixels
+
 #-------------------------------------------------------------------
 
 def DetermineCropCoordsAfterRotation(imgDim, rotDim, angle):
@@ -857,7 +1468,7 @@ def MagnifyImage(img, factor):
     magHeight = int(factor * img.height)
     magWidth = int(factor * img.width)
     imgScaled = Image(magHeight, magWidth, img.cmpRepr, img.memType)
-    filled = cuda.to_device(np.zeros(imgScaled.amPh.am.shape, dtype=np.int32))
+    filled = apool.Get(imgScaled.amPh.am.shape, np.int32, Image.mem['GPU'], zero=True)
 
     # magnification
 
@@ -867,12 +1478,13 @@ def MagnifyImage(img, factor):
     imgScaled.MoveToGPU()
     blockDim, gridDim = ccfg.DetermineCudaConfigNew(imgScaled.amPh.am.shape)
     InterpolateMissingPixels_dev[gridDim, blockDim](imgScaled.amPh.am, filled)
+    apool.Release(filled)
 
     return imgScaled
 
 #-------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], float32[:, :], int32[:, :], float32)')
+@backend.jit('void(float32[:, :], float32[:, :], int32[:, :], float32)')
 def MagnifyImage_dev(img, imgMag, filled, factor):
     x0, y0 = cuda.grid(2)
     if x0 >= img.shape[0] or y0 >= img.shape[1]:
@@ -882,6 +1494,15 @@ def MagnifyImage_dev(img, imgMag, filled, factor):
     imgMag[y1, x1] = img[y0, x0]
     filled[y1, x1] = 1
 
+@MagnifyImage_dev.numba(parallel=False)
+def MagnifyImage_cpu(img, imgMag, filled, factor):
+    for x0 in range(img.shape[0]):
+        for y0 in range(img.shape[1]):
+            x1 = int(factor * x0)
+            y1 = int(factor * y0)
+            imgMag[y1, x1] = img[y0, x0]
+            filled[y1, x1] = 1
+
 #-------------------------------------------------------------------
 
 def FillImageWithValue(img, value):
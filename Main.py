@@ -1,12 +1,16 @@
 from numba import cuda
 import Constants as const
+import Backend as backend
 import GUI2 as gui
 import ImageSupport as imsup
 import CrossCorr as cc
 import time
 
-cuda.select_device(0)
-dev = cuda.get_current_device()
-print('CUDA device in use: ' + dev.name.decode())
+if backend.UseGPU():
+    cuda.select_device(0)
+    dev = cuda.get_current_device()
+    print('CUDA device in use: ' + dev.name.decode())
+else:
+    print('CPU backend in use ({0} threads)'.format(backend.GetNumberOfThreads()))
 
-gui.RunLatticeAnalyzer()
\ No newline at end of file
+gui.RunLatticeAnalyzer()
@@ -1,11 +1,17 @@
+import threading
+import collections
 import numpy as np
+import numba
 from numba import cuda
-import math
+import math, cmath
 import Constants as const
 import CudaConfig as ccfg
-import ArraySupport as arrsup
+import Backend as backend
+import ArrayPool as apool
+import FFTEngine as ffteng
 import ImageSupport as imsup
 import CrossCorr as cc
+import ResultWriter as rwriter
 
 # -------------------------------------------------------------------
 
@@ -19,20 +25,144 @@ def CalcTransferFunction(imgDim, pxDim, defocusChange):
 
 # -------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], int32, int32)')
+class TransferFunction:
+    '''CTF in complex form and in FFT order (not centred), ready to multiply spectra (reIm is in GPU memory).'''
+    __slots__ = ('reIm', 'defocus', 'pxWidth')
+
+    def __init__(self, reIm, defocus, pxWidth):
+        self.reIm = reIm
+        self.defocus = defocus
+        self.pxWidth = pxWidth
+
+# -------------------------------------------------------------------
+
+class TransferFunctionCache:
+    '''CTFs kept by (shape, pixel width, wavelength, defocus change).
+    Least recently used CTFs are removed when they take more than maxBytes.
+    CTFs from the cache are shared, so they must not be modified.'''
+
+    def __init__(self, maxBytes=256 << 20):
+        self.maxBytes = maxBytes
+        self.ctfs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.bytesHeld = 0
+        self.hits = 0
+        self.misses = 0
+
+    def Get(self, imgDim, pxDim, defocusChange, wavelength=const.ewfLambda):
+        key = (imgDim, imgDim, float(pxDim), float(wavelength), float(defocusChange))
+        with self.lock:
+            ctf = self.ctfs.get(key)
+            if ctf is not None:
+                self.ctfs.move_to_end(key)
+                self.hits += 1
+                return ctf
+            self.misses += 1
+
+        ctf = CalcTransferFunctionFFT(imgDim, pxDim, defocusChange, wavelength)
+        with self.lock:
+            if key not in self.ctfs:
+                self.ctfs[key] = ctf
+                self.bytesHeld += ctf.reIm.nbytes
+            # the newest CTF is always kept
+            while self.bytesHeld > self.maxBytes and len(self.ctfs) > 1:
+                oldKey, oldCtf = self.ctfs.popitem(last=False)
+                self.bytesHeld -= oldCtf.reIm.nbytes
+        return ctf
+
+    def Clear(self):
+        with self.lock:
+            self.ctfs = collections.OrderedDict()
+            self.bytesHeld = 0
+
+    def GetStats(self):
+        with self.lock:
+            return {'ctfs': len(self.ctfs), 'bytesHeld': self.bytesHeld, 'hits': self.hits, 'misses': self.misses}
+
+# -------------------------------------------------------------------
+
+def CalcTransferFunctionFFT(imgDim, pxDim, defocusChange, wavelength=const.ewfLambda):
+    rsd = GetRecSquareDistances(imgDim, pxDim)
+    ctfArr = imsup.AllocArray((imgDim, imgDim), np.complex64, imsup.Image.mem['GPU'], zero=False)
+    ctfCoeff = np.pi * wavelength * defocusChange
+    blockDim, gridDim = ccfg.DetermineCudaConfig(imgDim)
+    CalcTransferFunctionFFT_dev[gridDim, blockDim](ctfArr, rsd, ctfCoeff)
+    return TransferFunction(ctfArr, defocusChange, pxDim)
+
+# -------------------------------------------------------------------
+
+# the same as CalcTransferFunction_dev followed by AmPh2ReIm and Diff2FFT (rsd from GetRecSquareDistances())
+@backend.jit('void(complex64[:, :], float32[:, :], float32)')
+def CalcTransferFunctionFFT_dev(ctf, rsd, ctfCoeff):
+    x, y = cuda.grid(2)
+    if x >= ctf.shape[0] or y >= ctf.shape[1]:
+        return
+    ctf[x, y] = cmath.rect(1.0, ctfCoeff * rsd[x, y])
+
+@CalcTransferFunctionFFT_dev.numba
+def CalcTransferFunctionFFT_cpu(ctf, rsd, ctfCoeff):
+    for x in numba.prange(ctf.shape[0]):
+        for y in range(ctf.shape[1]):
+            ctf[x, y] = cmath.rect(1.0, ctfCoeff * rsd[x, y])
+
+# -------------------------------------------------------------------
+
+ctfCache = TransferFunctionCache()
+
+def GetTransferFunction(imgDim, pxDim, defocusChange, wavelength=const.ewfLambda):
+    return ctfCache.Get(imgDim, pxDim, defocusChange, wavelength)
+
+# -------------------------------------------------------------------
+
+# squared reciprocal distances (q^2) depend only on image size and pixel width,
+# so they are calculated once (in FFT order) and shared by CTFs for all defocus values
+
+rsdCache = {}
+rsdCacheLock = threading.Lock()
+
+def GetRecSquareDistances(imgDim, pxDim):
+    key = (imgDim, float(pxDim))
+    with rsdCacheLock:
+        rsd = rsdCache.get(key)
+    if rsd is not None:
+        return rsd
+
+    rsd = imsup.AllocArray((imgDim, imgDim), np.float32, imsup.Image.mem['GPU'], zero=False)
+    blockDim, gridDim = ccfg.DetermineCudaConfig(imgDim)
+    CalcRecSquareDistances_dev[gridDim, blockDim](rsd, imgDim, pxDim)
+    with rsdCacheLock:
+        return rsdCache.setdefault(key, rsd)
+
+def ClearRecSquareDistances():
+    with rsdCacheLock:
+        rsdCache.clear()
+
+# -------------------------------------------------------------------
+
+@backend.jit('void(float32[:, :], int32, float32)')
 def CalcRecSquareDistances_dev(rsd, imgDim, pxDim):
     x, y = cuda.grid(2)
     if x >= imgDim or y >= imgDim:
         return
     recPxWidth = 1.0 / (imgDim * pxDim)
     recOrigin = -1.0 / (2.0 * pxDim)
-    recXDist = recOrigin + x * recPxWidth
-    recYDist = recOrigin + y * recPxWidth
+    recXDist = recOrigin + ((x + imgDim // 2) % imgDim) * recPxWidth
+    recYDist = recOrigin + ((y + imgDim // 2) % imgDim) * recPxWidth
     rsd[x, y] = recXDist * recXDist + recYDist * recYDist
 
+@CalcRecSquareDistances_dev.numba
+def CalcRecSquareDistances_cpu(rsd, imgDim, pxDim):
+    recPxWidth = 1.0 / (imgDim * pxDim)
+    recOrigin = -1.0 / (2.0 * pxDim)
+    for x in numba.prange(imgDim):
+        for y in range(imgDim):
+            recXDist = recOrigin + ((x + imgDim // 2) % imgDim) * recPxWidth
+            recYDist = recOrigin + ((y + imgDim // 2) % imgDim) * recPxWidth
+            rsd[x, y] = recXDist * recXDist + recYDist * recYDist
+
 # -------------------------------------------------------------------
 
-@cuda.jit('void(float32[:, :], float32[:, :], int32, float32, float32)')
+@backend.jit('void(float32[:, :], float32[:, :], int32, float32, float32)')
 def CalcTransferFunction_dev(ctfAm, ctfPh, imgDim, pxDim, ctfCoeff):
     x, y = cuda.grid(2)
     if x >= imgDim or y >= imgDim:
@@ -48,98 +178,531 @@ def CalcTransferFunction_dev(ctfAm, ctfPh, imgDim, pxDim, ctfCoeff):
     ctfAm[x, y] = 1.0
     ctfPh[x, y] = ctfCoeff * recSquareDist
 
+@CalcTransferFunction_dev.numba
+def CalcTransferFunction_cpu(ctfAm, ctfPh, imgDim, pxDim, ctfCoeff):
+    recPxWidth = 1.0 / (imgDim * pxDim)
+    recOrigin = -1.0 / (2.0 * pxDim)
+    for x in numba.prange(imgDim):
+        for y in range(imgDim):
+            recXDist = recOrigin + x * recPxWidth
+            recYDist = recOrigin + y * recPxWidth
+            recSquareDist = recXDist * recXDist + recYDist * recYDist
+            ctfAm[x, y] = 1.0
+            ctfPh[x, y] = ctfCoeff * recSquareDist
+
 # -------------------------------------------------------------------
 
 def PropagateWave(img, ctf):
     fft = cc.FFT(img)
-    fft.ReIm2AmPh()
+    MultByTransferFunction(fft, ctf)
+
+    imgProp = cc.IFFT(fft)
+    imgProp.ReIm2AmPh()
+    imgProp.defocus = img.defocus + ctf.defocus
+    return imgProp
 
-    ctf = cc.Diff2FFT(ctf)     # !!!
-    ctf.ReIm2AmPh()
+# -------------------------------------------------------------------
 
-    fftProp = imsup.Image(img.height, img.width, imsup.Image.cmp['CAP'], imsup.Image.mem['GPU'])
-    fftProp.amPh = imsup.MultAmPhMatrices(fft.amPh, ctf.amPh)
+# propagation by defocusChange without calculating CTF (e.g. for defocus sweeps, where CTFs are not reused)
+def PropagateWaveByDefocus(img, defocusChange, wavelength=const.ewfLambda):
+    fft = cc.FFT(img)
+    rsd = GetRecSquareDistances(img.width, img.pxWidth)
+    ctfCoeff = np.pi * wavelength * defocusChange
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(fft.reIm.shape)
+    MultByDefocusPhase_dev[gridDim, blockDim](fft.reIm, rsd, ctfCoeff)
 
-    imgProp = cc.IFFT(fftProp)
+    imgProp = cc.IFFT(fft)
     imgProp.ReIm2AmPh()
-    imgProp.defocus = img.defocus + ctf.defocus
+    imgProp.defocus = img.defocus + defocusChange
     return imgProp
 
 # -------------------------------------------------------------------
 
+@backend.jit('void(complex64[:, :], float32[:, :], float32)')
+def MultByDefocusPhase_dev(fft, rsd, ctfCoeff):
+    x, y = cuda.grid(2)
+    if x >= fft.shape[0] or y >= fft.shape[1]:
+        return
+    fft[x, y] *= cmath.rect(1.0, ctfCoeff * rsd[x, y])
+
+@MultByDefocusPhase_dev.numba
+def MultByDefocusPhase_cpu(fft, rsd, ctfCoeff):
+    for x in numba.prange(fft.shape[0]):
+        for y in range(fft.shape[1]):
+            fft[x, y] *= cmath.rect(1.0, ctfCoeff * rsd[x, y])
+
+# -------------------------------------------------------------------
+
+# fft (in CRI) is multiplied in place by ctf (TransferFunction from the cache
+# or centred CTF calculated by CalcTransferFunction())
+def MultByTransferFunction(fft, ctf):
+    blockDim, gridDim = ccfg.DetermineCudaConfigNew(fft.reIm.shape)
+    if isinstance(ctf, TransferFunction):
+        MultByTransferFunctionFFT_dev[gridDim, blockDim](fft.reIm, ctf.reIm)
+        return
+    mt = ctf.memType
+    dt = ctf.cmpRepr
+    ctf.MoveToGPU()
+    ctf.AmPh2ReIm()
+    MultByTransferFunction_dev[gridDim, blockDim](fft.reIm, ctf.reIm, fft.width)
+    ctf.ChangeComplexRepr(dt)
+    ctf.ChangeMemoryType(mt)
+
+# -------------------------------------------------------------------
+
+@backend.jit('void(complex64[:, :], complex64[:, :])')
+def MultByTransferFunctionFFT_dev(fft, ctf):
+    x, y = cuda.grid(2)
+    if x >= fft.shape[0] or y >= fft.shape[1]:
+        return
+    fft[x, y] *= ctf[x, y]
+
+@MultByTransferFunctionFFT_dev.numpy
+def MultByTransferFunctionFFT_cpu(fft, ctf):
+    np.multiply(fft, ctf, out=fft)
+
+# -------------------------------------------------------------------
+
+# ctf is shifted to fft order (as by Diff2FFT()) when it is read
+@backend.jit('void(complex64[:, :], complex64[:, :], int32)')
+def MultByTransferFunction_dev(fft, ctf, dim):
+    x, y = cuda.grid(2)
+    if x >= fft.shape[0] or y >= fft.shape[1]:
+        return
+    fft[x, y] *= ctf[(x + dim // 2) % dim, (y + dim // 2) % dim]
+
+@MultByTransferFunction_dev.numba
+def MultByTransferFunction_cpu(fft, ctf, dim):
+    for x in numba.prange(fft.shape[0]):
+        for y in range(fft.shape[1]):
+            fft[x, y] *= ctf[(x + dim // 2) % dim, (y + dim // 2) % dim]
+
+# -------------------------------------------------------------------
+
 def PropagateToFocus(img):
-    ctf = CalcTransferFunction(img.width, img.pxWidth, -img.defocus)
+    ctf = GetTransferFunction(img.width, img.pxWidth, -img.defocus)
     return PropagateWave(img, ctf)
 
 # -------------------------------------------------------------------
 
 def PropagateBackToDefocus(img, defocus):
-    ctf = CalcTransferFunction(img.width, img.pxWidth, defocus)
+    ctf = GetTransferFunction(img.width, img.pxWidth, defocus)
     # img.defocus = 0.0
     return PropagateWave(img, ctf)
 
 # -------------------------------------------------------------------
 
-def PerformIWFR(images, N):
-    imgHeight, imgWidth = images[0].height, images[0].width
+# IWFR stops after N iterations or when relative change of exit wave is smaller than tol;
+# returns exit wave and history of residuals (see IwfrEngine.Iterate()).
+# Pyramid mode: first nCoarseIter iterations are done on each of Fourier-cropped series of sizes from
+# pyramidDims (e.g. (512, 1024)), and N iterations at full size start from the upsampled coarse exit wave.
+# Series file (SeriesStore) is not loaded to memory, but streamed in batches of batchSize images (no pyramid mode).
+# Exit waves are saved in background by writer (ResultWriter, which also decides how often and in which formats);
+# default writer saves PNG images in every iteration
+def PerformIWFR(images, N=const.nIterations, tol=const.iwfrTolerance, pyramidDims=(),
+                nCoarseIter=const.nCoarseIterations, batchSize=4, writer=None):
     ewfResultsDir = 'results/ewf/'
     ewfAmName = 'am'
     ewfPhName = 'ph'
-    backCTFunctions = []
-    forwCTFunctions = []
+    ownWriter = writer is None
+    if ownWriter:
+        writer = rwriter.ResultWriter()
 
     print('Starting IWFR...')
 
-    # storing contrast transfer functions
+    if isinstance(images, (list, imsup.ImageStack)):
+        iwfr, coarseHistory = PrepareIWFRPyramid(images, pyramidDims, nCoarseIter, tol)
+    elif len(pyramidDims) > 0:
+        raise ValueError('Pyramid mode is not available for series streamed from file')
+    else:
+        iwfr, coarseHistory = IwfrStreamEngine(images, batchSize), []
+    for i in range(0, N):
+        print('Iteration no {0}...'.format(i+1))
+        metrics = iwfr.Iterate()
+        print('Amplitude residual = {0:.3e}, exit wave change = {1:.3e}'.format(metrics['ampResidual'],
+                                                                            metrics['ewfChange']))
+        converged = iwfr.IsConverged(tol)
+
+        # exit wave is calculated only if it is saved in this iteration
+        if writer.ShouldWrite(i+1, final=converged or i == N-1):
+            ewfPaths = {'am': ewfResultsDir + ewfAmName + str(i+1),
+                        'ph': ewfResultsDir + ewfPhName + str(i+1),
+                        'phAmpl': ewfResultsDir + ewfPhName + 'Ampl' + str(i+1)}
+            writer.Submit(iwfr.GetExitWave(), ewfPaths, final=True)
+
+        if converged:
+            print('Converged after {0} iterations'.format(i+1))
+            break
+
+    exitWave = iwfr.GetExitWave()
+    if ownWriter:
+        writer.Close()
+    else:
+        writer.Flush()
+    print('All done')
 
-    for img in images:
-        # print(imgWidth, img.pxWidth, -img.defocus)
-        ctf = CalcTransferFunction(imgWidth, img.pxWidth, -img.defocus)
-        ctf.AmPh2ReIm()
-        # ctf.reIm = ccc.Diff2FFT(ctf.reIm)
-        backCTFunctions.append(ctf)
+    return exitWave, coarseHistory + iwfr.history
 
-        ctf = CalcTransferFunction(imgWidth, img.pxWidth, img.defocus)
-        ctf.AmPh2ReIm()
-        # ctf.reIm = ccc.Diff2FFT(ctf.reIm)
-        forwCTFunctions.append(ctf)
+# -------------------------------------------------------------------
 
-    # start IWFR procedure
+# IWFR of series after its edit (images added or removed), starting from exit wave reconstructed from the previous
+# series (prevDefoci: its defocus values, e.g. [img.defocus for img in prevImages]). In the first iteration
+# prevExitWave is propagated to the planes of the new series, so only few iterations are needed until convergence
+# (instead of N iterations from zero exit wave). images can be series file (it is streamed in batches then)
+def PerformIncrementalIWFR(images, prevExitWave, prevDefoci, N=const.nIncrementalIterations,
+                           tol=const.iwfrTolerance, batchSize=4):
+    if isinstance(images, (list, imsup.ImageStack)):
+        stack = images if isinstance(images, imsup.ImageStack) else imsup.ImageStack.FromImageList(images)
+        defoci, pxWidth, width = stack.defocus, stack.pxWidth, stack.width
+    else:
+        defoci, pxWidth, width = images.defocus, imsup.GetCommonPxWidth(images.pxWidth), images.width
 
-    exitWave = imsup.Image(imgHeight, imgWidth, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU'])
+    # exit wave can have other size (it is resampled), but it must show the same area
+    if not np.isclose(prevExitWave.pxWidth * prevExitWave.width, pxWidth * width, rtol=1e-3):
+        raise ValueError('Previous exit wave and series have different fields of view')
 
-    for i in range(0, N):
-        print('Iteration no {0}...'.format(i+1))
-        imsup.ClearImageData(exitWave)
+    prevDefoci = np.asarray(prevDefoci, dtype=np.float64)
+    nAdded = sum(1 for df in defoci if not np.any(np.isclose(df, prevDefoci, rtol=0.0, atol=1e-12)))
+    nRemoved = sum(1 for df in prevDefoci if not np.any(np.isclose(df, defoci, rtol=0.0, atol=1e-12)))
+    print('Starting incremental IWFR ({0} images added, {1} removed)...'.format(nAdded, nRemoved))
 
-        # backpropagation (to in-focus plane)
+    if isinstance(images, (list, imsup.ImageStack)):
+        iwfr = IwfrEngine(stack, exitWave=prevExitWave)
+    else:
+        iwfr = IwfrStreamEngine(images, batchSize, exitWave=prevExitWave)
+    history = iwfr.Run(N, tol)
+    print('Done after {0} iterations'.format(iwfr.nIterations))
+    return iwfr.GetExitWave(), history
 
-        for img, idx in zip(images, range(0, len(images))):
-            img = PropagateWave(img, backCTFunctions[idx])
-            # img = PropagateToFocus(img)
-            img.AmPh2ReIm()
-            exitWave.reIm = arrsup.AddTwoArrays(exitWave.reIm, img.reIm)
+# -------------------------------------------------------------------
 
-        exitWave.reIm = arrsup.MultArrayByScalar(exitWave.reIm, 1/len(images))
+# runs IWFR on series Fourier-cropped to sizes from pyramidDims (from the smallest one);
+# returns IWFR engine for the full-size series (starting from the exit wave of the last level) and history of levels
+def PrepareIWFRPyramid(images, pyramidDims, nIterPerLevel, tol=const.iwfrTolerance):
+    stack = images if isinstance(images, imsup.ImageStack) else imsup.ImageStack.FromImageList(images)
+    history = []
+    prevIwfr = None
+    for dim in sorted(set(dim for dim in pyramidDims if dim < stack.width)):
+        print('IWFR on {0} x {0} images...'.format(dim))
+        iwfr = IwfrEngine(stack.FourierResample(dim))
+        if prevIwfr is not None:
+            iwfr.SetExitWaveSpectrum(prevIwfr.ewfSpectrum)
+        history += iwfr.Run(nIterPerLevel, tol)
+        prevIwfr = iwfr
+
+    iwfr = IwfrEngine(stack)
+    if prevIwfr is not None:
+        iwfr.SetExitWaveSpectrum(prevIwfr.ewfSpectrum)
+    return iwfr, history
 
-        ewfAmPath = ewfResultsDir + ewfAmName + str(i+1) + '.png'
-        ewfPhPath = ewfAmPath.replace(ewfAmName, ewfPhName)
-        ewfAmplPhPath = ewfPhPath.replace(ewfPhName, ewfPhName + 'Ampl')
-        imsup.SaveAmpImage(exitWave, ewfAmPath)
-        imsup.SavePhaseImage(exitWave, ewfPhPath)
-        amplifExitPhase = FilterPhase(exitWave)
-        imsup.SavePhaseImage(amplifExitPhase, ewfAmplPhPath)
+# -------------------------------------------------------------------
 
-        # forward propagation (to the original focus plane)
+class IwfrEngine:
+    '''IWFR done in Fourier space. Spectra of waves in all image planes are kept in one N x H x W array.
+    Exit wave spectrum is the average of spectra multiplied by back-propagation phase factors
+    (propagation is linear, so waves do not have to be back-propagated one by one).
+    Forward propagation is done in Fourier space too, and only amplitude constraint (measured amplitudes,
+    calculated phases) needs waves in real space. So one iteration takes 2N batched transforms
+    (instead of 4N) and one more IFFT when exit wave is needed (GetExitWave()).
+    Last forward propagation is not done until the next iteration.
+    Every iteration adds to history: amplitude residual (relative RMS difference between amplitudes of
+    forward-propagated waves and measured amplitudes, i.e. how well the previous exit wave explains the series;
+    nan in the first iteration) and relative change of exit wave. Both are summed in the same kernels
+    which do the propagation (exit wave change is calculated in Fourier space, which gives the same ratio).
+    Reconstruction can start from a given exit wave (e.g. upsampled result of IWFR on binned series),
+    see SetExitWave() and SetExitWaveSpectrum().'''
+
+    def __init__(self, images, wavelength=const.ewfLambda, exitWave=None):
+        stack = images if isinstance(images, imsup.ImageStack) else imsup.ImageStack.FromImageList(images)
+        self.shape = stack.shape
+        self.nImages, self.height, self.width = stack.shape
+        self.pxWidth = stack.pxWidth
+        self.defocus = np.array(stack.defocus)
+        # back-propagation (to focus) of image with defocus df: exp(i * pi * lambda * (-df) * q^2)
+        self.ctfCoeffs = backend.ToDevice((np.pi * wavelength * -self.defocus).astype(np.float32))
+        self.rsd = GetRecSquareDistances(self.width, self.pxWidth)
+
+        gpuMem = imsup.Image.mem['GPU']
+        self.amps = imsup.AllocArray(self.shape, np.float32, gpuMem, zero=False)
+        self.spectra = imsup.AllocArray(self.shape, np.complex64, gpuMem, zero=False)
+        self.ewfSpectrum = imsup.AllocArray((self.height, self.width), np.complex64, gpuMem, zero=True)
+        self.ewfSum = imsup.AllocArray((self.height, self.width), np.complex64, gpuMem, zero=False)
+
+        mt = stack.memType
+        dt = stack.cmpRepr
+        stack.MoveToGPU()
+        stack.ReIm2AmPh()
+        backend.CopyInto(self.amps, stack.am)
+        stack.AmPh2ReIm()
+        backend.CopyInto(self.spectra, stack.reIm)
+        stack.ChangeComplexRepr(dt)
+        stack.ChangeMemoryType(mt)
+
+        ffteng.FFT2(self.spectra, self.spectra)
+        self.nTransforms = self.nImages
+        self.nIterations = 0
+        self.history = []
+        # exit wave spectrum is valid (back-propagated or set), so the next iteration starts with forward propagation
+        self.hasExitWave = False
+        if exitWave is not None:
+            self.SetExitWave(exitWave)
+
+    def Iterate(self):
+        ampResidual = self.PropagateForward() if self.hasExitWave else np.nan
+        self.BackPropagate()
+        ewfChange = self.UpdateExitWaveSpectrum()
+        return self.AddToHistory(ampResidual, ewfChange)
+
+    def AddToHistory(self, ampResidual, ewfChange):
+        self.hasExitWave = True
+        self.nIterations += 1
+        metrics = {'iteration': self.nIterations, 'dim': self.width, 'ampResidual': ampResidual,
+                   'ewfChange': ewfChange}
+        self.history.append(metrics)
+        return metrics
+
+    def IsConverged(self, tol):
+        return len(self.history) > 0 and self.history[-1]['ewfChange'] < tol
+
+    # exit wave (as returned by GetExitWave(), of any size, it is resampled in Fourier space) is the starting guess
+    def SetExitWave(self, exitWave):
+        ewfFFT = cc.FFT(exitWave)
+        # GetExitWave() does not normalize inverse transform
+        self.SetExitWaveSpectrum(ewfFFT.reIm, 1.0 / (exitWave.height * exitWave.width))
+        self.nTransforms += 1
+
+    # spectrum (in FFT order, e.g. ewfSpectrum of IWFR at lower resolution) is zero-padded or cropped
+    def SetExitWaveSpectrum(self, ewfSpectrum, scale=1.0):
+        srcHeight, srcWidth = ewfSpectrum.shape
+        # values of unnormalized transform are proportional to the number of pixels
+        scale *= (self.height * self.width) / (srcHeight * srcWidth)
+        imsup.ResampleSpectra(ewfSpectrum.reshape((1, srcHeight, srcWidth)),
+                              self.ewfSpectrum.reshape((1, self.height, self.width)), scale)
+        self.hasExitWave = True
+
+    # runs until convergence (or maxIterations iterations in total) and returns history
+    def Run(self, maxIterations=const.nIterations, tol=const.iwfrTolerance):
+        while self.nIterations < maxIterations:
+            self.Iterate()
+            if self.IsConverged(tol):
+                break
+        return self.history
+
+    # spectra -> sum of back-propagated spectra
+    def BackPropagate(self):
+        apool.ZeroArray(self.ewfSum, imsup.Image.mem['GPU'])
+        blockDim, gridDim = ccfg.DetermineCudaConfigNew(self.ewfSpectrum.shape)
+        AccumulateBackPropagated_dev[gridDim, blockDim](self.spectra, self.rsd, self.ctfCoeffs, self.ewfSum)
+
+    # sum of back-propagated spectra -> exit wave spectrum (returns relative change of exit wave)
+    def UpdateExitWaveSpectrum(self):
+        blockDim, gridDim = ccfg.DetermineCudaConfigNew(self.ewfSpectrum.shape)
+        rowSums = imsup.AllocArray((2, self.height), np.float32, imsup.Image.mem['GPU'])
+        UpdateExitWaveSpectrum_dev[gridDim, blockDim](self.ewfSum, 1.0 / self.nImages, self.ewfSpectrum, rowSums)
+        return GetRelativeNorm(rowSums)
+
+    # exit wave spectrum -> spectra of waves with measured amplitudes in all image planes
+    # (returns amplitude residual)
+    def PropagateForward(self):
+        blockDim, gridDim = ccfg.DetermineCudaConfigNew(self.ewfSpectrum.shape)
+        rowSums = imsup.AllocArray((2, self.height), np.float32, imsup.Image.mem['GPU'])
+        PropagateSpectrumForward_dev[gridDim, blockDim](self.ewfSpectrum, self.rsd, self.ctfCoeffs, self.spectra)
+        ffteng.IFFT2(self.spectra, self.spectra)
+        # inverse transform is not normalized
+        ampScale = 1.0 / (self.height * self.width)
+        ApplyAmplitudes_dev[gridDim, blockDim](self.spectra, self.amps, ampScale, rowSums)
+        ffteng.FFT2(self.spectra, self.spectra)
+        self.nTransforms += 2 * self.nImages
+        return GetRelativeNorm(rowSums)
+
+    def GetExitWave(self):
+        exitWave = imsup.Image(self.height, self.width, imsup.Image.cmp['CRI'], imsup.Image.mem['GPU'])
+        exitWave.pxWidth = self.pxWidth
+        ffteng.IFFT2(self.ewfSpectrum, exitWave.GetReImForWrite())
+        self.nTransforms += 1
+        return exitWave
 
-        for img, idx in zip(images, range(0, len(images))):
-            images[idx] = PropagateWave(exitWave, forwCTFunctions[idx])
-            # images[idx] = PropagateBackToDefocus(exitWave, img.defocus)
-            images[idx].amPh.am = img.amPh.am           # restore original amplitude
+# -------------------------------------------------------------------
 
-    print('All done')
+class IwfrStreamEngine(IwfrEngine):
+    '''IWFR of series which does not fit in memory: measured amplitudes are read from series file
+    (SeriesStore, memory-mapped) batch by batch in every iteration.
+    Waves in image planes are not kept between iterations. Exit wave is propagated forward to planes of the batch,
+    amplitude constraint is applied and waves are back-propagated and added to the sum of exit wave spectra
+    (phase factors are calculated from the q^2 grid, so no CTFs are stored either).
+    Only the exit wave spectrum, the sum and one batch of amplitudes and waves are in memory,
+    whatever the length of the series. Number of transforms is the same as in IwfrEngine.'''
+
+    def __init__(self, store, batchSize=4, wavelength=const.ewfLambda, exitWave=None):
+        self.store = store
+        self.shape = (len(store), store.height, store.width)
+        self.nImages, self.height, self.width = self.shape
+        self.batchSize = max(1, min(batchSize, self.nImages))
+        self.pxWidth = imsup.GetCommonPxWidth(store.pxWidth)
+        self.defocus = np.array(store.defocus, dtype=np.float64)
+        self.ctfCoeffs = backend.ToDevice((np.pi * wavelength * -self.defocus).astype(np.float32))
+        self.rsd = GetRecSquareDistances(self.width, self.pxWidth)
+
+        gpuMem = imsup.Image.mem['GPU']
+        batchShape = (self.batchSize, self.height, self.width)
+        self.amps = imsup.AllocArray(batchShape, np.float32, gpuMem, zero=False)
+        # on CPU backend amplitudes are read directly to "device" array
+        self.ampsHost = self.amps
+        if backend.UseGPU():
+            self.ampsHost = imsup.AllocArray(batchShape, np.float32, imsup.Image.mem['CPU'], zero=False)
+        self.spectra = imsup.AllocArray(batchShape, np.complex64, gpuMem, zero=False)
+        self.ewfSpectrum = imsup.AllocArray((self.height, self.width), np.complex64, gpuMem, zero=True)
+        self.ewfSum = imsup.AllocArray((self.height, self.width), np.complex64, gpuMem, zero=False)
+
+        self.nTransforms = 0
+        self.nIterations = 0
+        self.history = []
+        self.hasExitWave = False
+        if exitWave is not None:
+            self.SetExitWave(exitWave)
+
+    def Iterate(self):
+        gpuMem = imsup.Image.mem['GPU']
+        # the first iteration (without exit wave) starts from measured amplitudes and zero phases
+        propagate = self.hasExitWave
+        apool.ZeroArray(self.ewfSum, gpuMem)
+        rowSums = imsup.AllocArray((2, self.height), np.float32, gpuMem)
+        blockDim, gridDim = ccfg.DetermineCudaConfigNew(self.ewfSpectrum.shape)
+        ampScale = 1.0 / (self.height * self.width)
+
+        for start in range(0, self.nImages, self.batchSize):
+            end = min(start + self.batchSize, self.nImages)
+            amps, spectra, ctfCoeffs = self.amps[:end-start], self.spectra[:end-start], self.ctfCoeffs[start:end]
+            for idx in range(start, end):
+                self.store.GetAmplitude(idx, out=self.ampsHost[idx-start])
+            if self.ampsHost is not self.amps:
+                backend.CopyInto(amps, self.ampsHost[:end-start])
+
+            if propagate:
+                PropagateSpectrumForward_dev[gridDim, blockDim](self.ewfSpectrum, self.rsd, ctfCoeffs, spectra)
+                ffteng.IFFT2(spectra, spectra)
+            else:
+                apool.ZeroArray(spectra, gpuMem)
+            ApplyAmplitudes_dev[gridDim, blockDim](spectra, amps, ampScale, rowSums)
+            ffteng.FFT2(spectra, spectra)
+            AccumulateBackPropagated_dev[gridDim, blockDim](spectra, self.rsd, ctfCoeffs, self.ewfSum)
+            self.nTransforms += (2 if propagate else 1) * (end - start)
+
+        ampResidual = GetRelativeNorm(rowSums)
+        ewfChange = self.UpdateExitWaveSpectrum()
+        return self.AddToHistory(ampResidual if propagate else np.nan, ewfChange)
+
+# -------------------------------------------------------------------
+
+# sqrt(sum(rowSums[0]) / sum(rowSums[1])) (rowSums are released)
+def GetRelativeNorm(rowSums):
+    diffNorm, norm = np.sum(backend.ToHost(rowSums), axis=1, dtype=np.float64)
+    apool.Release(rowSums)
+    return float(np.sqrt(diffNorm / norm)) if norm > 0 else 0.0
+
+# -------------------------------------------------------------------
 
-    return exitWave
+# ewfSum += sum of spectra multiplied by back-propagation phase factors
+@backend.jit('void(complex64[:, :, :], float32[:, :], float32[:], complex64[:, :])')
+def AccumulateBackPropagated_dev(spectra, rsd, ctfCoeffs, ewfSum):
+    x, y = cuda.grid(2)
+    if x >= ewfSum.shape[0] or y >= ewfSum.shape[1]:
+        return
+    ewf = ewfSum[x, y]
+    for k in range(spectra.shape[0]):
+        ewf += spectra[k, x, y] * cmath.rect(1.0, ctfCoeffs[k] * rsd[x, y])
+    ewfSum[x, y] = ewf
+
+@AccumulateBackPropagated_dev.numba
+def AccumulateBackPropagated_cpu(spectra, rsd, ctfCoeffs, ewfSum):
+    for x in numba.prange(ewfSum.shape[0]):
+        for y in range(ewfSum.shape[1]):
+            ewf = ewfSum[x, y]
+            for k in range(spectra.shape[0]):
+                ewf += spectra[k, x, y] * cmath.rect(1.0, ctfCoeffs[k] * rsd[x, y])
+            ewfSum[x, y] = ewf
+
+# -------------------------------------------------------------------
+
+# ewfSpectrum = ewfSum * scale;
+# rowSums[0, x] and rowSums[1, x] are sums of |ewfNew - ewfOld|^2 and |ewfNew|^2 in row x
+@backend.jit('void(complex64[:, :], float32, complex64[:, :], float32[:, :])')
+def UpdateExitWaveSpectrum_dev(ewfSum, scale, ewfSpectrum, rowSums):
+    x, y = cuda.grid(2)
+    if x >= ewfSpectrum.shape[0] or y >= ewfSpectrum.shape[1]:
+        return
+    ewf = ewfSum[x, y] * scale
+    ewfDiff = ewf - ewfSpectrum[x, y]
+    ewfSpectrum[x, y] = ewf
+    cuda.atomic.add(rowSums, (0, x), ewfDiff.real * ewfDiff.real + ewfDiff.imag * ewfDiff.imag)
+    cuda.atomic.add(rowSums, (1, x), ewf.real * ewf.real + ewf.imag * ewf.imag)
+
+@UpdateExitWaveSpectrum_dev.numba
+def UpdateExitWaveSpectrum_cpu(ewfSum, scale, ewfSpectrum, rowSums):
+    for x in numba.prange(ewfSpectrum.shape[0]):
+        for y in range(ewfSpectrum.shape[1]):
+            ewf = ewfSum[x, y] * scale
+            ewfDiff = ewf - ewfSpectrum[x, y]
+            ewfSpectrum[x, y] = ewf
+            rowSums[0, x] += ewfDiff.real * ewfDiff.real + ewfDiff.imag * ewfDiff.imag
+            rowSums[1, x] += ewf.real * ewf.real + ewf.imag * ewf.imag
+
+# -------------------------------------------------------------------
+
+@backend.jit('void(complex64[:, :], float32[:, :], float32[:], complex64[:, :, :])')
+def PropagateSpectrumForward_dev(ewfSpectrum, rsd, ctfCoeffs, spectra):
+    x, y = cuda.grid(2)
+    if x >= ewfSpectrum.shape[0] or y >= ewfSpectrum.shape[1]:
+        return
+    for k in range(spectra.shape[0]):
+        spectra[k, x, y] = ewfSpectrum[x, y] * cmath.rect(1.0, -ctfCoeffs[k] * rsd[x, y])
+
+@PropagateSpectrumForward_dev.numba
+def PropagateSpectrumForward_cpu(ewfSpectrum, rsd, ctfCoeffs, spectra):
+    for x in numba.prange(ewfSpectrum.shape[0]):
+        for y in range(ewfSpectrum.shape[1]):
+            for k in range(spectra.shape[0]):
+                spectra[k, x, y] = ewfSpectrum[x, y] * cmath.rect(1.0, -ctfCoeffs[k] * rsd[x, y])
+
+# -------------------------------------------------------------------
+
+# amplitudes of waves (multiplied by ampScale) are replaced with measured ones (phases are kept);
+# rowSums[0, x] and rowSums[1, x] are (added) sums of squared amplitude differences and squared measured amplitudes
+# in row x of all waves
+@backend.jit('void(complex64[:, :, :], float32[:, :, :], float32, float32[:, :])')
+def ApplyAmplitudes_dev(waves, amps, ampScale, rowSums):
+    x, y = cuda.grid(2)
+    if x >= waves.shape[1] or y >= waves.shape[2]:
+        return
+    ampDiffSum = 0.0
+    ampSum = 0.0
+    for k in range(waves.shape[0]):
+        wave = waves[k, x, y]
+        waveAm = abs(wave)
+        ampDiff = waveAm * ampScale - amps[k, x, y]
+        ampDiffSum += ampDiff * ampDiff
+        ampSum += amps[k, x, y] * amps[k, x, y]
+        if waveAm > 0.0:
+            waves[k, x, y] = wave * (amps[k, x, y] / waveAm)
+        else:
+            waves[k, x, y] = amps[k, x, y]
+    cuda.atomic.add(rowSums, (0, x), ampDiffSum)
+    cuda.atomic.add(rowSums, (1, x), ampSum)
+
+@ApplyAmplitudes_dev.numba
+def ApplyAmplitudes_cpu(waves, amps, ampScale, rowSums):
+    for x in numba.prange(waves.shape[1]):
+        for y in range(waves.shape[2]):
+            for k in range(waves.shape[0]):
+                wave = waves[k, x, y]
+                waveAm = abs(wave)
+                ampDiff = waveAm * ampScale - amps[k, x, y]
+                rowSums[0, x] += ampDiff * ampDiff
+                rowSums[1, x] += amps[k, x, y] * amps[k, x, y]
+                if waveAm > 0.0:
+                    waves[k, x, y] = wave * (amps[k, x, y] / waveAm)
+                else:
+                    waves[k, x, y] = amps[k, x, y]
 
 # -------------------------------------------------------------------
 
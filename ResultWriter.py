@@ -0,0 +1,159 @@
+import os
+import atexit
+import threading
+import concurrent.futures
+import numpy as np
+from PIL import Image as im
+import Backend as backend
+import ImageSupport as imsup
+
+# -------------------------------------------------------------------
+# Results (amplitudes and phases of images, e.g. exit waves from IWFR iterations or correlation functions)
+# are written in background threads. Submit() only takes a snapshot (copy of image in host memory);
+# calculation of amplitude and phase, scaling, encoding and writing to disk are done by the thread pool.
+# At most maxQueued snapshots wait for writing (Submit() blocks when the queue is full, so memory use is bounded).
+# Cadence: every k-th iteration (every=k) or only the final result (every=0).
+# Formats: 'png' (8-bit, scaled to 0-255), 'npy' and 'tiff' (float32, lossless).
+# All writers are flushed on exit.
+# -------------------------------------------------------------------
+
+formats = {'png': '.png', 'npy': '.npy', 'tiff': '.tif'}
+variables = ('am', 'ph', 'phAmpl')
+
+# -------------------------------------------------------------------
+
+class ResultWriter:
+    def __init__(self, fileFormats=('png',), every=1, nThreads=2, maxQueued=4, stdFactor=1.0):
+        for fmt in fileFormats:
+            if fmt not in formats:
+                raise ValueError('Unknown format "{0}" (available: {1})'.format(fmt, ', '.join(formats)))
+        self.formats = tuple(fileFormats)
+        self.every = every
+        self.stdFactor = stdFactor
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=nThreads)
+        self.queueSlots = threading.BoundedSemaphore(maxQueued)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.nWritten = 0
+        self.nFailed = 0
+        self.closed = False
+        atexit.register(self.Close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.Close()
+
+    def ShouldWrite(self, iteration=None, final=False):
+        if final or iteration is None:
+            return True
+        return self.every > 0 and iteration % self.every == 0
+
+    # paths: {variable: file path without extension}, variable is 'am', 'ph' or 'phAmpl'
+    # (phase clipped to mean +- stdFactor * std, as in FilterPhase());
+    # returns False if the result is skipped (because of cadence)
+    def Submit(self, img, paths, iteration=None, final=False):
+        if not self.ShouldWrite(iteration, final):
+            return False
+        for var in paths:
+            if var not in variables:
+                raise ValueError('Unknown variable "{0}" (available: {1})'.format(var, ', '.join(variables)))
+
+        # slot is taken before the copy, so that at most maxQueued snapshots exist at a time
+        self.queueSlots.acquire()
+        try:
+            reIm = img.reIm
+            snapshot = reIm.copy_to_host() if backend.IsDeviceArray(reIm) else np.array(reIm)
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError('Result writer is closed')
+                future = self.executor.submit(self.Write, snapshot, dict(paths))
+                self.pending.add(future)
+        except BaseException:
+            self.queueSlots.release()
+            raise
+        future.add_done_callback(self.OnWritten)
+        return True
+
+    def Write(self, reIm, paths):
+        for var, fPath in paths.items():
+            arr = GetVariable(reIm, var, self.stdFactor)
+            dirPath = os.path.dirname(fPath)
+            if dirPath:
+                os.makedirs(dirPath, exist_ok=True)
+            for fmt in self.formats:
+                SaveArray(arr, fPath + formats[fmt], fmt)
+
+    def OnWritten(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if future.exception() is None:
+                self.nWritten += 1
+            else:
+                self.nFailed += 1
+        self.queueSlots.release()
+        if future.exception() is not None:
+            print('Could not write result: {0}'.format(future.exception()))
+
+    # waits until all submitted results are written
+    def Flush(self):
+        with self.lock:
+            pending = list(self.pending)
+        concurrent.futures.wait(pending)
+
+    def Close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.executor.shutdown(wait=True)
+        atexit.unregister(self.Close)
+
+    def GetStats(self):
+        with self.lock:
+            return {'pending': len(self.pending), 'written': self.nWritten, 'failed': self.nFailed}
+
+# -------------------------------------------------------------------
+
+def GetVariable(reIm, var, stdFactor=1.0):
+    if var == 'am':
+        return np.abs(reIm).astype(np.float32)
+    ph = np.angle(reIm).astype(np.float32)
+    if var == 'phAmpl':
+        phAvg = np.average(ph)
+        phStd = np.std(ph)
+        np.clip(ph, phAvg - stdFactor * phStd, phAvg + stdFactor * phStd, out=ph)
+    return ph
+
+# -------------------------------------------------------------------
+
+def SaveArray(arr, fPath, fmt):
+    if fmt == 'npy':
+        np.save(fPath, arr)
+    elif fmt == 'tiff':
+        im.fromarray(arr, mode='F').save(fPath)
+    else:
+        arrScaled = imsup.ScaleImage(arr, 0.0, 255.0)
+        im.fromarray(arrScaled.astype(np.uint8)).save(fPath)
+
+# -------------------------------------------------------------------
+
+# writer for results which are saved occasionally (e.g. correlation functions in alignment);
+# it is created on first use (so that importing the module does not start threads)
+writer = None
+writerLock = threading.Lock()
+
+def GetWriter():
+    global writer
+    with writerLock:
+        if writer is None:
+            writer = ResultWriter()
+        return writer
+
+def Submit(img, paths, iteration=None, final=False):
+    return GetWriter().Submit(img, paths, iteration, final)
+
+def Flush():
+    if writer is not None:
+        writer.Flush()
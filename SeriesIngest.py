@@ -0,0 +1,168 @@
+import os
+import re
+import struct
+import time
+import threading
+import numpy as np
+import Constants as const
+import Dm3Reader3 as dm3
+import ImageSupport as imsup
+import SeriesLoader as sload
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# -------------------------------------------------------------------
+
+class SeriesIngest:
+    '''Watches directory for new dm3 files written by the microscope.
+    Every new file is read as soon as it is complete, preprocessed in the same way as in SeriesLoader
+    (sqrt + RemovePixelArtifacts) and appended to a growing series (ImageList and optionally SeriesWriter,
+    which then commits every frame, so that the series file is readable even if ingest is interrupted).
+    numInSeries is the position of image in series (it is used as index, e.g. in GUI), numbers of files are only checked
+    for gaps (e.g. skipped acquisition), which are reported.
+    onImage(img, images) callback is called for every new image, e.g. to align it with the previous one
+    while the next images are still being acquired.'''
+
+    def __init__(self, dirPath=const.inputDir, filePattern=r'([0-9]+)\.dm[34]$', removeArtifacts=True,
+                 writer=None, onImage=None, pollInterval=0.5, settleTime=1.0):
+        self.dirPath = dirPath
+        self.filePattern = re.compile(filePattern)
+        self.removeArtifacts = removeArtifacts
+        self.writer = writer
+        if writer is not None:
+            writer.commitFrames = True
+        self.onImage = onImage
+        self.pollInterval = pollInterval
+        self.settleTime = settleTime
+        self.images = imsup.ImageList()
+        self.ingested = set()
+        self.lastFileNum = None
+        self.pending = {}           # file name -> (size, time when the size was seen for the first time)
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def FindNewFiles(self):
+        newFiles = []
+        for fName in os.listdir(self.dirPath):
+            fMatch = self.filePattern.search(fName)
+            if fMatch is not None and fName not in self.ingested:
+                newFiles.append((int(fMatch.group(1)), fName))
+        return [ fName for num, fName in sorted(newFiles) ]
+
+    def IsFileComplete(self, fName):
+        fPath = os.path.join(self.dirPath, fName)
+        try:
+            fSize = os.path.getsize(fPath)
+        except OSError:
+            return False
+
+        now = time.time()
+        lastSize, since = self.pending.get(fName, (-1, now))
+        if fSize != lastSize:
+            self.pending[fName] = (fSize, now)
+            return False
+        if now - since < self.settleTime:
+            return False
+
+        # size did not change for some time: file is complete if its image data is already there
+        try:
+            dataInfo = dm3.FindDm3ImageData(fPath)
+        except (ValueError, EOFError, IndexError, OSError, struct.error):
+            return False
+        dataEnd = dataInfo['offset'] + dataInfo['dtype'].itemsize * int(np.prod(dataInfo['shape']))
+        return dataEnd <= fSize
+
+    def IngestFile(self, fName):
+        fPath = os.path.join(self.dirPath, fName)
+        img = sload.LoadImage(fPath, self.removeArtifacts)
+        fileNum = int(self.filePattern.search(fName).group(1))
+        img.numInSeries = fileNum
+        if len(self.images) > 0:
+            img.prev = self.images[-1]
+            self.images[-1].next = img
+            img.numInSeries = self.images[-1].numInSeries + 1
+            if fileNum != self.lastFileNum + 1:
+                print('Gap in series: file number {0} follows {1} (image {2} in series)'.format(
+                      fileNum, self.lastFileNum, img.numInSeries))
+        self.lastFileNum = fileNum
+        self.images.append(img)
+        self.ingested.add(fName)
+        self.pending.pop(fName, None)
+        print('Ingested file "{0}"'.format(fPath))
+
+        if self.writer is not None:
+            self.writer.AppendFrame(img.amPh.am, img.defocus, img.pxWidth, img.numInSeries)
+        if self.onImage is not None:
+            self.onImage(img, self.images)
+        return img
+
+    def Poll(self):
+        nIngested = 0
+        for fName in self.FindNewFiles():
+            # files are appended in order of their numbers
+            if not self.IsFileComplete(fName):
+                break
+            self.IngestFile(fName)
+            nIngested += 1
+        return nIngested
+
+    def WaitForChanges(self, watcher):
+        if watcher is None:
+            self.stopEvent.wait(self.pollInterval)
+        else:
+            watcher.read(timeout=int(self.pollInterval * 1000))
+
+    def Run(self, nImages=None, timeout=None):
+        watcher = CreateWatcher(self.dirPath)
+        startTime = time.time()
+        try:
+            while not self.stopEvent.is_set():
+                self.Poll()
+                if nImages is not None and len(self.images) >= nImages:
+                    break
+                if timeout is not None and time.time() - startTime > timeout:
+                    break
+                self.WaitForChanges(watcher)
+        finally:
+            if watcher is not None:
+                watcher.close()
+        return self.images
+
+    def Start(self, nImages=None, timeout=None):
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self.Run, args=(nImages, timeout), daemon=True)
+        self.thread.start()
+
+    def Stop(self):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+# -------------------------------------------------------------------
+
+def CreateWatcher(dirPath):
+    # inotify is used only to wake up when something changes in the directory (polling is the fallback)
+    if inotify_simple is None:
+        return None
+    try:
+        watcher = inotify_simple.INotify()
+        flags = inotify_simple.flags
+        watcher.add_watch(dirPath, flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO)
+    except OSError:
+        return None
+    return watcher
+
+# -------------------------------------------------------------------
+
+def MakePairAligner(dfPars, alignedPairs):
+    import CrossCorr as cc
+
+    def AlignWithPrevious(img, images):
+        if img.prev is not None:
+            alignedPairs.append(cc.AlignTwoImages(img.prev, img, dfPars))
+
+    return AlignWithPrevious
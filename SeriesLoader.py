@@ -0,0 +1,76 @@
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import Constants as const
+import Dm3Index as dm3idx
+import ImageSupport as imsup
+
+# -------------------------------------------------------------------
+
+def FindSeriesFiles(firstPath):
+    dirPath, firstName = os.path.split(firstPath)
+    nameMatch = re.match(r'(.*?)([0-9]+)(\.dm[34])$', firstName)
+    prefix, firstNum, ext = nameMatch.group(1), int(nameMatch.group(2)), nameMatch.group(3)
+    filePattern = re.compile(re.escape(prefix) + r'([0-9]+)' + re.escape(ext) + '$')
+
+    numberedFiles = {}
+    for fName in os.listdir(dirPath or '.'):
+        fMatch = filePattern.match(fName)
+        if fMatch is not None:
+            numberedFiles.setdefault(int(fMatch.group(1)), os.path.join(dirPath, fName))
+
+    # series ends at the first missing number
+    seriesFiles = []
+    fNum = firstNum
+    while fNum in numberedFiles:
+        seriesFiles.append(numberedFiles[fNum])
+        fNum += 1
+    return seriesFiles, firstNum
+
+# -------------------------------------------------------------------
+
+def LoadImage(fPath, removeArtifacts=True, frameIdx=0):
+    imgHeight, imgWidth = dm3idx.GetImageInfo(fPath)['shape'][-2:]
+    intData = np.empty((imgHeight, imgWidth), dtype=np.float32)
+    dm3idx.ReadFrameInto(fPath, frameIdx, intData)
+    return IntensityToImage(intData, removeArtifacts)
+
+# -------------------------------------------------------------------
+
+def IterStackImages(fPath, removeArtifacts=True):
+    imgHeight, imgWidth = dm3idx.GetImageInfo(fPath)['shape'][-2:]
+    intData = np.empty((imgHeight, imgWidth), dtype=np.float32)
+    for frameIdx, frame in enumerate(dm3idx.IterFrames(fPath, intData)):
+        img = IntensityToImage(frame, removeArtifacts)
+        img.numInSeries = frameIdx + 1
+        yield img
+
+# -------------------------------------------------------------------
+
+# intData is overwritten (amplitude is calculated in place)
+def IntensityToImage(intData, removeArtifacts=True):
+    ampData = np.sqrt(np.abs(intData, out=intData), out=intData)
+    img = imsup.ImageWithBuffer(ampData.shape[0], ampData.shape[1], imsup.Image.cmp['CAP'], imsup.Image.mem['CPU'],
+                                ampOnly=True)
+    img.LoadAmpData(ampData)
+    if removeArtifacts:
+        imsup.RemovePixelArtifacts(img, const.minPxThreshold, const.maxPxThreshold)
+    img.UpdateBuffer()
+    return img
+
+# -------------------------------------------------------------------
+
+def LoadImageSeries(firstPath, removeArtifacts=True, nWorkers=None):
+    seriesFiles, firstNum = FindSeriesFiles(firstPath)
+    if nWorkers is None:
+        nWorkers = min(len(seriesFiles), os.cpu_count() or 1)
+
+    with ThreadPoolExecutor(max_workers=max(nWorkers, 1)) as executor:
+        images = list(executor.map(lambda fPath: LoadImage(fPath, removeArtifacts), seriesFiles))
+    dm3idx.Flush()
+
+    print('Loaded {0} images (starting from "{1}")'.format(len(images), firstPath))
+    if images:
+        images[0].numInSeries = firstNum
+    return imsup.ImageList(images)
@@ -0,0 +1,263 @@
+import sys
+import zlib
+import struct
+import numpy as np
+import Constants as const
+import Dm3Index as dm3idx
+import ImageSupport as imsup
+import SeriesLoader as sload
+
+# -------------------------------------------------------------------
+# Series file layout:
+#   fixed header (64 bytes): magic, format version, dtype, number of frames, height, width,
+#                            capacity of frame table, compression (0 - none, 1 - zlib), offset of frame block
+#   frame table (capacity records): defocus [m], pixel width [m], numInSeries, offset and size of frame data
+#   frame block (aligned to 4096 bytes): contiguous (N, H, W) array or compressed frames one after another
+# -------------------------------------------------------------------
+
+storeMagic = b'LASERIES'
+storeVersion = 1
+headerStruct = struct.Struct('<8sI4sQQQQIQ4x')
+frameRecord = np.dtype([('defocus', '<f8'), ('pxWidth', '<f8'), ('numInSeries', '<i8'), ('offset', '<u8'), ('size', '<u8')])
+blockAlignment = 4096
+compression = {'NONE': 0, 'ZLIB': 1}
+storeDtypes = [np.dtype('<f4'), np.dtype('<u2')]
+
+# -------------------------------------------------------------------
+
+# commitFrames: header and frame table are updated after every frame (not only on Close()),
+# so that the file can be read even if writing is interrupted (e.g. series which is still being acquired)
+class SeriesWriter:
+    def __init__(self, fPath, height, width, dtype=np.float32, capacity=1, compress=False, commitFrames=False):
+        self.fPath = fPath
+        self.height = height
+        self.width = width
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        if self.dtype not in storeDtypes:
+            raise ValueError('Series can be stored only as float32 or uint16 frames')
+        self.capacity = capacity
+        self.compress = compress
+        self.commitFrames = commitFrames
+        self.frameTable = np.zeros(capacity, dtype=frameRecord)
+        self.nFrames = 0
+        tableEnd = headerStruct.size + capacity * frameRecord.itemsize
+        self.dataOffset = -(-tableEnd // blockAlignment) * blockAlignment
+        self.dataEnd = self.dataOffset
+        self.file = open(fPath, 'wb')
+        self.WriteHeader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.Close()
+
+    def PackHeader(self):
+        comp = compression['ZLIB'] if self.compress else compression['NONE']
+        return headerStruct.pack(storeMagic, storeVersion, self.dtype.str.encode().ljust(4), self.nFrames,
+                                 self.height, self.width, self.capacity, comp, self.dataOffset)
+
+    def WriteHeader(self):
+        self.file.seek(0)
+        self.file.write(self.PackHeader())
+        self.file.write(self.frameTable.tobytes())
+
+    # record of the last frame is written before the header, which counts it only when its data and record are there
+    def CommitFrame(self):
+        lastIdx = self.nFrames - 1
+        self.file.seek(headerStruct.size + lastIdx * frameRecord.itemsize)
+        self.file.write(self.frameTable[lastIdx].tobytes())
+        self.file.flush()
+        self.file.seek(0)
+        self.file.write(self.PackHeader())
+        self.file.flush()
+
+    def AppendFrame(self, frame, defocus=0.0, pxWidth=const.pxWidth, numInSeries=None):
+        if self.nFrames == self.capacity:
+            raise IndexError('Series file "{0}" is full ({1} frames)'.format(self.fPath, self.capacity))
+        if frame.shape != (self.height, self.width):
+            raise ValueError('Frame shape {0} does not match series shape {1}'.format(frame.shape, (self.height, self.width)))
+        frameData = np.ascontiguousarray(frame, dtype=self.dtype)
+        if self.dtype.kind == 'u' and not np.array_equal(frameData, frame):
+            raise ValueError('Frame cannot be stored losslessly as {0}'.format(self.dtype.name))
+
+        frameBytes = frameData.tobytes()
+        if self.compress:
+            frameBytes = zlib.compress(frameBytes, 1)
+        record = self.frameTable[self.nFrames]
+        record['defocus'] = defocus
+        record['pxWidth'] = pxWidth
+        record['numInSeries'] = self.nFrames + 1 if numInSeries is None else numInSeries
+        record['offset'] = self.dataEnd
+        record['size'] = len(frameBytes)
+
+        self.file.seek(self.dataEnd)
+        self.file.write(frameBytes)
+        self.dataEnd += len(frameBytes)
+        self.nFrames += 1
+        if self.commitFrames:
+            self.CommitFrame()
+
+    def Close(self):
+        if self.file.closed:
+            return
+        self.WriteHeader()
+        self.file.close()
+
+# -------------------------------------------------------------------
+
+class SeriesStore:
+    def __init__(self, fPath):
+        self.fPath = fPath
+        with open(fPath, 'rb') as storeFile:
+            header = headerStruct.unpack(storeFile.read(headerStruct.size))
+            magic, version, dtypeStr, self.nFrames, self.height, self.width, capacity, comp, self.dataOffset = header
+            if magic != storeMagic or version != storeVersion:
+                raise ValueError('"{0}" is not a series file'.format(fPath))
+            self.frameTable = np.fromfile(storeFile, dtype=frameRecord, count=self.nFrames)
+        self.dtype = np.dtype(dtypeStr.decode().strip())
+        self.compressed = comp == compression['ZLIB']
+        self.defocus = self.frameTable['defocus']
+        self.pxWidth = self.frameTable['pxWidth']
+        self.numInSeries = self.frameTable['numInSeries']
+        self.frames = None
+        if not self.compressed and self.nFrames > 0:
+            self.frames = np.memmap(fPath, dtype=self.dtype, mode='c', offset=self.dataOffset,
+                                    shape=(self.nFrames, self.height, self.width))
+
+    def __len__(self):
+        return self.nFrames
+
+    def GetFrame(self, idx, out=None):
+        if out is None:
+            out = np.empty((self.height, self.width), dtype=self.dtype)
+        if not self.compressed:
+            out[...] = self.frames[idx]
+            return out
+        record = self.frameTable[idx]
+        with open(self.fPath, 'rb') as storeFile:
+            storeFile.seek(int(record['offset']))
+            frameBytes = zlib.decompress(storeFile.read(int(record['size'])))
+        out[...] = np.frombuffer(frameBytes, dtype=self.dtype).reshape(self.height, self.width)
+        return out
+
+    def GetAmplitude(self, idx, out=None):
+        # float32 series store amplitudes, uint16 series store raw intensities
+        if self.dtype == np.float32:
+            if out is None and not self.compressed:
+                return self.frames[idx]
+            return self.GetFrame(idx, out)
+        if out is None:
+            out = np.empty((self.height, self.width), dtype=np.float32)
+        out[...] = self.frames[idx] if not self.compressed else self.GetFrame(idx)
+        return np.sqrt(out, out=out)
+
+    def GetImage(self, idx):
+        img = imsup.ImageWithBuffer(self.height, self.width, imsup.Image.cmp['CAP'], imsup.Image.mem['CPU'],
+                                    float(self.defocus[idx]), int(self.numInSeries[idx]), ampOnly=True)
+        img.pxWidth = float(self.pxWidth[idx])
+        img.amPh.am = self.GetAmplitude(idx)
+        img.UpdateBuffer()
+        return img
+
+    def ToImageList(self):
+        imgList = imsup.ImageList([ self.GetImage(idx) for idx in range(self.nFrames) ])
+        for img, num in zip(imgList, self.numInSeries):
+            img.numInSeries = int(num)
+        return imgList
+
+    # whole series in one array (it can be moved to GPU with one transfer)
+    def ToImageStack(self):
+        stack = imsup.ImageStack(self.nFrames, self.height, self.width, imsup.Image.cmp['CAP'], imsup.Image.mem['CPU'],
+                                 ampOnly=True)
+        am = stack.am
+        for idx in range(self.nFrames):
+            self.GetAmplitude(idx, out=am[idx])
+        stack.defocus[:] = self.defocus
+        stack.numInSeries[:] = self.numInSeries
+        stack.pxWidth = imsup.GetCommonPxWidth(self.pxWidth) if self.nFrames > 0 else const.pxWidth
+        return stack
+
+# -------------------------------------------------------------------
+
+def OpenSeries(fPath):
+    return SeriesStore(fPath)
+
+# -------------------------------------------------------------------
+
+def WriteImageList(fPath, images, dtype=np.float32, compress=False):
+    with SeriesWriter(fPath, images[0].height, images[0].width, dtype, len(images), compress) as writer:
+        for img in images:
+            mt = img.memType
+            dt = img.cmpRepr
+            img.ReIm2AmPh()
+            img.MoveToCPU()
+            writer.AppendFrame(img.amPh.am, img.defocus, img.pxWidth, img.numInSeries)
+            img.ChangeMemoryType(mt)
+            img.ChangeComplexRepr(dt)
+
+# -------------------------------------------------------------------
+
+# defocus of frames: from the list of defoci, from the defocus step (frame i has defocus i * dfStep)
+# or from microscope tags of files (0 if there is no defocus tag)
+def ConvertSeries(firstPath, outPath, dtype=np.float32, compress=False, removeArtifacts=True, defoci=None, dfStep=None):
+    seriesFiles, firstNum = sload.FindSeriesFiles(firstPath)
+    imgInfos = [ dm3idx.GetImageInfo(fPath) for fPath in seriesFiles ]
+    dm3idx.Flush()
+    nFramesInFiles = [ int(np.prod(info['shape'][:-2])) for info in imgInfos ]
+    if defoci is not None and len(defoci) != sum(nFramesInFiles):
+        raise ValueError('Number of defoci ({0}) differs from number of frames ({1})'.format(len(defoci), sum(nFramesInFiles)))
+    height, width = imgInfos[0]['shape'][-2:]
+    storeAmplitude = np.dtype(dtype) == np.float32
+
+    frameBuffer = np.empty((height, width), dtype=np.float32 if storeAmplitude else imgInfos[0]['dtype'])
+    with SeriesWriter(outPath, height, width, dtype, sum(nFramesInFiles), compress) as writer:
+        for fPath, info, nFrames in zip(seriesFiles, imgInfos, nFramesInFiles):
+            pxWidth = info['px_width'] if info['px_width'] is not None else const.pxWidth
+            for frameIdx in range(nFrames):
+                dm3idx.ReadFrameInto(fPath, frameIdx, frameBuffer)
+                frameNum = writer.nFrames
+                defocus = GetFrameDefocus(frameNum, info, defoci, dfStep)
+                if storeAmplitude:
+                    img = sload.IntensityToImage(frameBuffer, removeArtifacts)
+                    writer.AppendFrame(img.amPh.am, defocus, pxWidth, firstNum + frameNum)
+                else:
+                    writer.AppendFrame(frameBuffer, defocus, pxWidth, firstNum + frameNum)
+            print('Converted "{0}"'.format(fPath))
+
+    return OpenSeries(outPath)
+
+# -------------------------------------------------------------------
+
+def GetFrameDefocus(frameNum, imgInfo, defoci=None, dfStep=None):
+    if defoci is not None:
+        return defoci[frameNum]
+    if dfStep is not None:
+        return frameNum * dfStep
+    return imgInfo['defocus'] if imgInfo.get('defocus') is not None else 0.0
+
+# -------------------------------------------------------------------
+
+def Main(args):
+    import argparse
+    parser = argparse.ArgumentParser(description='Pack numbered dm3/dm4 series into one memory-mappable series file.')
+    parser.add_argument('firstFile', help='first file of the series, e.g. input/d1.dm3')
+    parser.add_argument('outFile', help='output series file')
+    parser.add_argument('--dtype', choices=['float32', 'uint16'], default='float32',
+                        help='float32: preprocessed amplitudes, uint16: raw intensities (default: float32)')
+    parser.add_argument('--compress', action='store_true', help='compress frames with zlib (file is not memory-mappable then)')
+    parser.add_argument('--keep-artifacts', action='store_true', help='do not remove pixel artifacts')
+    dfGroup = parser.add_mutually_exclusive_group()
+    dfGroup.add_argument('--defocus-step', type=float, help='defocus step between frames in meters, e.g. 2e-9 '
+                                                            '(default: defocus from microscope tags)')
+    dfGroup.add_argument('--defoci', help='comma-separated defoci of all frames in meters')
+    pars = parser.parse_args(args)
+    defoci = [ float(df) for df in pars.defoci.split(',') ] if pars.defoci is not None else None
+    store = ConvertSeries(pars.firstFile, pars.outFile, np.dtype(pars.dtype), pars.compress, not pars.keep_artifacts,
+                          defoci, pars.defocus_step)
+    print('Saved {0} frames ({1} x {2}) to "{3}"'.format(len(store), store.height, store.width, pars.outFile))
+
+# -------------------------------------------------------------------
+
+if __name__ == '__main__':
+    Main(sys.argv[1:])
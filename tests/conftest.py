@@ -0,0 +1,6 @@
+import os
+import sys
+
+# modules are in the main directory of repository; tests run on CPU backend unless LA_BACKEND is set
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LA_BACKEND', 'cpu')
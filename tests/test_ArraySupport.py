@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import Backend as backend
+import ArraySupport as arrsup
+
+# -------------------------------------------------------------------
+
+def test_FindExtrema():
+    arr = np.random.default_rng(0).random((37, 53)).astype(np.float32)
+    maxVal, maxPos, minVal, minPos = arrsup.FindExtrema(backend.ToDevice(arr))
+    assert maxVal == arr.max() and maxPos == np.unravel_index(arr.argmax(), arr.shape)
+    assert minVal == arr.min() and minPos == np.unravel_index(arr.argmin(), arr.shape)
+
+# -------------------------------------------------------------------
+
+def test_FindExtrema_SkipsNaN():
+    arr = np.arange(12, dtype=np.float32).reshape(3, 4)
+    arr[0, 0] = arr[2, 3] = np.nan
+    maxVal, maxPos, minVal, minPos = arrsup.FindExtrema(backend.ToDevice(arr))
+    assert (maxVal, maxPos, minVal, minPos) == (10.0, (2, 2), 1.0, (0, 1))
+
+# -------------------------------------------------------------------
+
+def test_FindExtrema_AllNaN():
+    arr = np.full((16, 16), np.nan, dtype=np.float32)
+    maxVal, maxPos, minVal, minPos = arrsup.FindExtrema(backend.ToDevice(arr))
+    assert np.isnan(maxVal) and np.isnan(minVal)
+    assert maxPos == minPos == (0, 0)
+
+# -------------------------------------------------------------------
+
+@pytest.mark.parametrize('value', [np.inf, -np.inf])
+def test_FindExtrema_AllInf(value):
+    arr = np.full((4, 4), value, dtype=np.float32)
+    assert arrsup.FindExtrema(backend.ToDevice(arr)) == (value, (0, 0), value, (0, 0))
+
+# -------------------------------------------------------------------
+
+def test_FindExtrema_NaNAndInf():
+    arr = np.array([[np.nan, np.inf]], dtype=np.float32)
+    assert arrsup.FindExtrema(backend.ToDevice(arr)) == (np.inf, (0, 1), np.inf, (0, 1))
+    arr = np.full(1000, np.nan, dtype=np.float32)
+    arr[700], arr[900] = -np.inf, np.inf
+    assert arrsup.FindExtrema(backend.ToDevice(arr)) == (np.inf, (900,), -np.inf, (700,))
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import Backend as backend
+import ImageSupport as imsup
+
+# -------------------------------------------------------------------
+
+# resampled spectrum keeps every frequency which exists in both sizes (np.fft.fftfreq() order), other ones are 0
+def ResampleSpectraReference(spectra, resShape, scale):
+    resHeight, resWidth = resShape
+    height, width = spectra.shape[1:]
+    rowFreqs = np.rint(np.fft.fftfreq(height) * height).astype(int).tolist()
+    colFreqs = np.rint(np.fft.fftfreq(width) * width).astype(int).tolist()
+    spectraRes = np.zeros((spectra.shape[0], resHeight, resWidth), dtype=spectra.dtype)
+    for x, xFreq in enumerate(np.rint(np.fft.fftfreq(resHeight) * resHeight).astype(int)):
+        for y, yFreq in enumerate(np.rint(np.fft.fftfreq(resWidth) * resWidth).astype(int)):
+            if xFreq in rowFreqs and yFreq in colFreqs:
+                spectraRes[:, x, y] = spectra[:, rowFreqs.index(xFreq), colFreqs.index(yFreq)] * scale
+    return spectraRes
+
+# -------------------------------------------------------------------
+
+@pytest.mark.parametrize('shape, resShape', [((31, 31), (64, 64)), ((64, 64), (31, 31)), ((31, 20), (17, 48)),
+                                             ((32, 32), (64, 64)), ((33, 33), (33, 33))])
+def test_ResampleSpectra(shape, resShape):
+    rng = np.random.default_rng(1)
+    spectra = (rng.random((2,) + shape) + 1j * rng.random((2,) + shape)).astype(np.complex64)
+    spectraRes = backend.DeviceArray((2,) + resShape, np.complex64)
+    imsup.ResampleSpectra(backend.ToDevice(spectra), spectraRes, 0.5)
+    assert np.array_equal(backend.ToHost(spectraRes), ResampleSpectraReference(spectra, resShape, 0.5))
+
+# -------------------------------------------------------------------
+
+def test_FromImageList_MixedPxWidths():
+    images = []
+    for pxWidth in (10e-12, 10e-12, 20e-12):
+        img = imsup.Image(8, 8, imsup.Image.cmp['CAP'], imsup.Image.mem['CPU'])
+        img.amPh.am = np.ones((8, 8), dtype=np.float32)
+        img.pxWidth = pxWidth
+        images.append(img)
+    assert imsup.ImageStack.FromImageList(images[:2]).pxWidth == 10e-12
+    with pytest.raises(ValueError):
+        imsup.ImageStack.FromImageList(images)